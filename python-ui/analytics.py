@@ -0,0 +1,195 @@
+import argparse
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+# Columnar, array-backed tables of the exported histories (exporter.py / sync.py output). Every string column is
+# dictionary encoded: the table holds small integer codes and a list of the distinct values. Parsing the JSON happens
+# once, after save() the tables reopen as memory-mapped arrays in milliseconds.
+
+NAT: np.datetime64 = np.datetime64("NaT", "ms")
+
+
+def parse_timestamps(timestamps: list[str | type(None)]) -> np.ndarray:
+    # JS Date JSON (2024-05-01T12:00:00.000Z) to datetime64[ms]. numpy parses the whole column at once, only a
+    # column with malformed values falls back to parsing one by one.
+    cleaned = [t[:-1] if t and t.endswith("Z") else (t or "NaT") for t in timestamps]
+    try:
+        return np.array(cleaned, dtype="datetime64[ms]")
+    except ValueError:
+        def parse(t: str) -> np.datetime64:
+            try:
+                return np.datetime64(t, "ms")
+            except ValueError:
+                return NAT
+        return np.array([parse(t) for t in cleaned], dtype="datetime64[ms]")
+
+
+def encode(values: list[str], dictionary: dict[str, int] = None) -> tuple[np.ndarray, list[str]]:
+    dictionary = {} if dictionary is None else dictionary
+    codes = np.fromiter((dictionary.setdefault(v, len(dictionary)) for v in values), dtype=np.int32, count=len(values))
+    return codes, list(dictionary)
+
+
+@dataclass
+class Table:
+    columns: dict[str, np.ndarray]
+    dictionaries: dict[str, list[str]]  # column name -> the values its codes refer to
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.columns[column]
+
+    def code_of(self, column: str, value: str) -> int:
+        try:
+            return self.dictionaries[column].index(value)
+        except ValueError:
+            return -1
+
+    def save(self, table_dir: Path):
+        table_dir = Path(table_dir)
+        table_dir.mkdir(parents=True, exist_ok=True)
+        for name, values in self.columns.items():
+            np.save(table_dir / f"{name}.npy", values)
+        (table_dir / "dictionaries.json").write_text(json.dumps(self.dictionaries, ensure_ascii=False),
+                                                     encoding="utf-8")
+
+    @classmethod
+    def open(cls, table_dir: Path) -> "Table":
+        table_dir = Path(table_dir)
+        columns = {path.stem: np.load(path, mmap_mode="r") for path in sorted(table_dir.glob("*.npy"))}
+        dictionaries = json.loads((table_dir / "dictionaries.json").read_text(encoding="utf-8"))
+        return cls(columns, dictionaries)
+
+
+def iter_jsonl(path: Path) -> Iterable[dict]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_messages(messages_jsonl: Path) -> Table:
+    user_ids, roles, timestamps, lengths = [], [], [], []
+    for record in iter_jsonl(messages_jsonl):
+        user_ids.append(str(record.get("userId")))
+        roles.append(record.get("role") or "")
+        timestamps.append(record.get("timestamp"))
+        lengths.append(len(record.get("message") or ""))
+    user_codes, users = encode(user_ids)
+    role_codes, role_values = encode(roles)
+    return Table({"user": user_codes, "role": role_codes.astype(np.int8), "timestamp": parse_timestamps(timestamps),
+                  "length": np.array(lengths, dtype=np.int32)},
+                 {"user": users, "role": role_values})
+
+
+def load_ratings(profiles_jsonl: Path, users: list[str] = None) -> Table:
+    # One row per satisfactionLevel entry. The last profile line of a user wins (sync.py appends new versions).
+    # Pass the users dictionary of the messages table to share user codes between the tables.
+    profiles: dict[str, dict] = {}
+    for profile in iter_jsonl(profiles_jsonl):
+        profiles[str(profile.get("id"))] = profile
+    user_ids, timestamps, levels = [], [], []
+    for user_id, profile in profiles.items():
+        for rating in profile.get("satisfactionLevel") or []:
+            user_ids.append(user_id)
+            timestamps.append(rating.get("timestamp"))
+            levels.append(rating.get("level", np.nan))
+    user_codes, user_values = encode(user_ids, {u: i for i, u in enumerate(users or [])})
+    return Table({"user": user_codes, "timestamp": parse_timestamps(timestamps),
+                  "level": np.array(levels, dtype=np.float32)},
+                 {"user": user_values})
+
+
+def messages_per_user(messages: Table, role: str = None) -> np.ndarray:
+    # Indexed by user code
+    mask = slice(None) if role is None else messages["role"] == messages.code_of("role", role)
+    return np.bincount(messages["user"][mask], minlength=len(messages.dictionaries["user"]))
+
+
+def length_distribution(messages: Table, role: str = "CHATBOT",
+                        percentiles: tuple[float, ...] = (50, 90, 95, 99)) -> dict[str, float]:
+    lengths = messages["length"][messages["role"] == messages.code_of("role", role)]
+    if not len(lengths):
+        return {}
+    return {"count": float(len(lengths)), "mean": float(lengths.mean()), "max": float(lengths.max())} \
+        | {f"p{p:g}": float(v) for p, v in zip(percentiles, np.percentile(lengths, percentiles))}
+
+
+def turn_gaps(messages: Table, from_role: str = None, to_role: str = None) -> np.ndarray:
+    # Seconds between consecutive messages of the same user. With from_role="USER" and to_role="CHATBOT" this is the
+    # bot's response time, the other way around it's the user's.
+    valid = ~np.isnat(messages["timestamp"])
+    users, roles = messages["user"][valid], messages["role"][valid]
+    timestamps = messages["timestamp"][valid].astype(np.int64)
+    order = np.lexsort((timestamps, users))
+    users, roles, timestamps = users[order], roles[order], timestamps[order]
+    same_user = users[1:] == users[:-1]
+    if from_role is not None:
+        same_user &= roles[:-1] == messages.code_of("role", from_role)
+    if to_role is not None:
+        same_user &= roles[1:] == messages.code_of("role", to_role)
+    return np.diff(timestamps)[same_user] / 1000
+
+
+WEEK_ALIGNMENT = np.timedelta64(3, "D")  # From Monday, 1969-12-29, to the epoch
+
+
+def satisfaction_trend(ratings: Table, period: str = "W") -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Mean satisfaction level per period ("D", "W" or "M"). Returns (period starts, mean level, number of ratings).
+    # Weeks start on Monday: numpy's weeks count from the epoch, a Thursday, so the timestamps are shifted by the
+    # three days in between before truncating, and the week starts are dates.
+    valid = ~np.isnat(ratings["timestamp"]) & ~np.isnan(ratings["level"])
+    timestamps = ratings["timestamp"][valid]
+    if period == "W":
+        buckets = (timestamps + WEEK_ALIGNMENT).astype("datetime64[W]").astype("datetime64[D]") - WEEK_ALIGNMENT
+    else:
+        buckets = timestamps.astype(f"datetime64[{period}]")
+    if not len(buckets):
+        return buckets, np.empty(0), np.empty(0, dtype=np.int64)
+    starts, bucket_codes = np.unique(buckets, return_inverse=True)
+    counts = np.bincount(bucket_codes)
+    sums = np.bincount(bucket_codes, weights=ratings["level"][valid])
+    return starts, sums / counts, counts
+
+
+def build(store_dir: Path, tables_dir: Path) -> tuple[Table, Table]:
+    messages = load_messages(store_dir / "messages.jsonl")
+    messages.save(tables_dir / "messages")
+    profiles_path = store_dir / "profiles.jsonl"
+    ratings = load_ratings(profiles_path, messages.dictionaries["user"]) if profiles_path.exists() \
+        else Table({}, {"user": []})
+    if len(ratings):
+        ratings.save(tables_dir / "ratings")
+    return messages, ratings
+
+
+def open_tables(tables_dir: Path) -> tuple[Table, Table | type(None)]:
+    ratings_dir = tables_dir / "ratings"
+    return Table.open(tables_dir / "messages"), Table.open(ratings_dir) if ratings_dir.exists() else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggregate statistics over exported conversation histories.")
+    parser.add_argument("--store", type=Path, default=Path("export"), help="Directory with messages.jsonl")
+    parser.add_argument("--tables", type=Path, default=Path("analytics_tables"))
+    parser.add_argument("--rebuild", action="store_true", help="Parse the JSONL again instead of reopening tables")
+    args = parser.parse_args()
+    if args.rebuild or not (args.tables / "messages").exists():
+        build(args.store, args.tables)
+    messages_table, ratings_table = open_tables(args.tables)
+    per_user = messages_per_user(messages_table, "USER")
+    print(f"{len(messages_table)} messages of {len(per_user)} users, "
+          f"median {np.median(per_user) if len(per_user) else 0:g} user messages per user")
+    print("Reply lengths:", length_distribution(messages_table, "CHATBOT"))
+    gaps = turn_gaps(messages_table, "CHATBOT", "USER")
+    if len(gaps):
+        print("User reply time (s): p50 {:.0f}, p90 {:.0f}".format(*np.percentile(gaps, [50, 90])))
+    if ratings_table is not None:
+        for start, level, n in zip(*satisfaction_trend(ratings_table)):
+            print(f"Week of {start}: mean satisfaction {level:.2f} ({n} ratings)")
@@ -0,0 +1,288 @@
+import asyncio
+from asyncio import FIRST_COMPLETED
+from collections import Counter
+from contextlib import asynccontextmanager
+from copy import copy
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Any, Callable
+from uuid import UUID
+
+import aiohttp
+import numpy as np
+from stamina import retry
+
+from cohere_tools import (EMBED_BATCH_SIZE, RERANK_MAX_DOCUMENTS, ChatReplay, CohereHandler, ConvHist, ConvManager,
+                          Document, EndpointModelMap, GenCfg, RawJson, StandardRoles, dumps_payload)
+from metrics import ClientMetrics, conversation
+from rate_limiting import Priority, current_priority
+
+
+class OverloadedError(RuntimeError):
+    # Raised when a reply isn't admitted within AsyncConvManager.admission_timeout
+    pass
+
+
+def is_retryable(exc: Exception) -> bool:
+    # Same as cohere_tools.is_retryable: connection errors, timeouts, 429s and 5xx
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status == 429 or exc.status >= 500
+    return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+@dataclass
+class AsyncCohereHandler:
+    # The asyncio counterpart of CohereHandler, to serve many conversations on one event loop. The model catalog,
+    # headers, caches and rate limits are the wrapped sync handler's, so both can be used side by side.
+    handler: CohereHandler = field(default_factory=CohereHandler)
+    max_concurrency: int = 64  # API calls in flight, also the size of the connection pool
+    _session: aiohttp.ClientSession | type(None) = field(init=False, default=None, repr=False)
+    _semaphore: asyncio.Semaphore = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    @property
+    def metrics(self) -> ClientMetrics | type(None):
+        return self.handler.metrics
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Created on first use, a ClientSession belongs to the running event loop
+        if self._session is None or self._session.closed:
+            cfg = self.handler.transport_cfg
+            self._session = aiohttp.ClientSession(
+                headers=self.handler.model_headers,
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(sock_connect=cfg.connect_timeout, sock_read=cfg.read_timeout),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def __aenter__(self) -> "AsyncCohereHandler":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def raise_for_status(self, endpoint: EndpointModelMap, response: aiohttp.ClientResponse,
+                               data: dict[str, Any] = None):
+        if response.status == 200:
+            return
+        conversation_lost = response.status == 404 and data is not None and "conversation_id" in data
+        if response.status in (401, 404) and not conversation_lost:
+            # Same as CohereHandler.raise_for_status, the catalog is revalidated (in a thread) for the next call
+            self.handler.catalog_cache.invalidate(self.handler.catalog_key)
+            await asyncio.to_thread(self.handler.revalidate_catalog)
+        raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status,
+                                          message=f"Received status code {response.status} when calling the "
+                                                  f"{endpoint} endpoint")
+
+    # Same policy as CohereHandler.call_endpoint: 429s wait on the shared rate limiter, an open circuit breaker and
+    # other 4xx aren't retried.
+    @retry(on=is_retryable, attempts=5, wait_initial=0.5, wait_max=10, timeout=120)
+    async def call_endpoint(self, endpoint: EndpointModelMap, data: dict[str, Any], model: str = None,
+                            priority: Priority = None) -> dict:
+        self.handler.set_model(endpoint, data, model)
+        limiter = self.handler.rate_limits[endpoint.name]
+        default = Priority.interactive if endpoint is EndpointModelMap.chat else Priority.batch
+        metrics = self.metrics
+        async with self._semaphore:
+            data_bytes = dumps_payload(data).encode()
+            await limiter.before_call_async(priority if priority is not None else current_priority(default),
+                                            self.handler.rate_limits.acquire_timeout)
+            started = perf_counter()
+            try:
+                async with self.session.post(f"{self.handler.endpoint_prefix}{endpoint.name}",
+                                             data=data_bytes) as response:
+                    limiter.after_response(response.status, response.headers)
+                    body = await response.read()
+                    if metrics is not None:
+                        metrics.record_call(endpoint.name, data.get("model"), response.status,
+                                            perf_counter() - started, len(data_bytes), len(body))
+                    await self.raise_for_status(endpoint, response, data)
+                    reply = await response.json(content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                limiter.record_failure()
+                if metrics is not None:
+                    metrics.record_call(endpoint.name, data.get("model"), 0, perf_counter() - started,
+                                        len(data_bytes), 0)
+                raise
+            except BaseException:  # E.g. cancelled, the losing attempt of a hedged call
+                limiter.abandon()
+                raise
+        if metrics is not None:
+            metrics.record_tokens(endpoint.name, data.get("model"), reply)
+        return reply
+
+    async def call_chat(self, data: dict[str, Any], model: str = None) -> ChatReplay:
+        # See CohereHandler.call_chat, here the losing attempt is cancelled
+        policy = self.handler.hedging
+        if policy is None or "conversation_id" in data:
+            return await self.call_endpoint(EndpointModelMap.chat, data, model)
+        policy.start()
+        delay = policy.delay()
+
+        async def attempt(attempt_model: str | type(None)) -> ChatReplay:
+            started = perf_counter()
+            reply = await self.call_endpoint(EndpointModelMap.chat, dict(data), attempt_model)
+            policy.observe(perf_counter() - started)
+            return reply
+
+        if delay is None:
+            return await attempt(model)
+        primary = asyncio.create_task(attempt(model))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done or not policy.try_fire():
+                return await primary
+            hedge = asyncio.create_task(attempt(self.handler.hedge_model(model)))
+            pending.add(hedge)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            policy.record_win()
+                        return task.result()
+            return await primary  # Both failed, raises the primary's error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def chat_from_dict(self, data: dict | str, cfg: GenCfg = None, model: str = None) -> ChatReplay:
+        context_data = {"message": data} if isinstance(data, str) else data
+        cfg = cfg or GenCfg()
+        gen_data: dict = context_data | cfg.parse()
+        response_cache = self.handler.response_cache
+        if response_cache is None or "conversation_id" in gen_data:  # See CohereHandler.chat_from_dict
+            return await self.call_chat(gen_data, model)
+
+        self.handler.set_model(EndpointModelMap.chat, gen_data, model)  # The resolved model is part of the cache key
+        cache_key, reply = response_cache.get(gen_data)
+        if reply is not None:
+            return copy(reply)
+        reply = await self.call_chat(gen_data, model)
+        if cache_key is not None:
+            response_cache.put(cache_key, reply)
+        return copy(reply)
+
+    async def chat(self, msg: str, conv_hist: ConvHist | UUID = None, sys_msg: str | bool = True,
+                   documents: list[Document] | RawJson = None, cfg: GenCfg = None, model: str = None,
+                   search_queries_only: bool = False) -> ChatReplay:
+        chat_data = self.handler.build_chat_data(msg, conv_hist, sys_msg, documents, search_queries_only)
+        return await self.chat_from_dict(chat_data, cfg, model)
+
+    async def rerank(self, query: str, documents: list[str | Document], model: str = None) -> dict:
+        documents = [doc.parse() if isinstance(doc, Document) else doc for doc in documents]
+        return await self.call_endpoint(EndpointModelMap.rerank, {"query": query, "documents": documents}, model)
+
+    async def rerank_large(self, query: str, documents: list[str | Document], top_n: int = None, model: str = None,
+                           chunk_size: int = RERANK_MAX_DOCUMENTS) -> dict:
+        # See CohereHandler.rerank_large, the chunks are reranked concurrently
+        keys, scores, missing = self.handler.plan_rerank(query, documents, model)
+        missing_keys = list(missing)
+        chunks = [missing_keys[i:i + chunk_size] for i in range(0, len(missing_keys), chunk_size)]
+        replies = await asyncio.gather(*(
+            self.call_endpoint(EndpointModelMap.rerank, {"query": query, "documents": [missing[k] for k in chunk]},
+                               model)
+            for chunk in chunks))
+        for chunk_keys, reply in zip(chunks, replies):
+            self.handler.store_rerank_scores(chunk_keys, reply, scores)
+        return self.handler.merge_rerank_scores(keys, scores, top_n)
+
+    async def embed(self, texts: list[str], input_type: str = "search_document", model: str = None,
+                    batch_size: int = EMBED_BATCH_SIZE) -> np.ndarray:
+        # See CohereHandler.embed, the batches are embedded concurrently
+        keys, vectors, missing = self.handler.plan_embed(texts, input_type, model)
+        missing_keys = list(missing)
+        batches = [missing_keys[i:i + batch_size] for i in range(0, len(missing_keys), batch_size)]
+        replies = await asyncio.gather(*(
+            self.call_endpoint(EndpointModelMap.embed, self.handler.embed_data([missing[k] for k in batch],
+                                                                               input_type), model)
+            for batch in batches))
+        for batch_keys, reply in zip(batches, replies):
+            self.handler.store_embeddings(batch_keys, self.handler.parse_embeddings(reply), vectors)
+        return self.handler.stack_embeddings(keys, vectors)
+
+
+@dataclass
+class AsyncConvManager:
+    # Serves the conversations of a ConvManager (or RedisConvManager) concurrently on one event loop.
+    # Replies within one conversation run one at a time in arrival order, so they never race on its history, while
+    # different conversations run concurrently with at most llm.max_concurrency API calls in flight. At most
+    # max_pending replies are admitted (running or waiting for their conversation), further callers wait up to
+    # admission_timeout and then get an OverloadedError, so a burst is pushed back instead of piling up in memory.
+    # The histories of a RedisConvManager are loaded (and flushed) by blocking calls, which run in the default
+    # executor so a cache miss never stalls the event loop.
+    conv_manager: ConvManager = field(default_factory=ConvManager)
+    llm: AsyncCohereHandler = None  # Defaults to one wrapping conv_manager.llm_handler
+    max_pending: int = 10_000
+    admission_timeout: float | type(None) = 5.0
+    _admission: asyncio.Semaphore = field(init=False, repr=False)
+    _conv_locks: dict[UUID, asyncio.Lock] = field(init=False, default_factory=dict, repr=False)
+    _conv_users: Counter = field(init=False, default_factory=Counter, repr=False)
+
+    def __post_init__(self):
+        if self.llm is None:
+            self.llm = AsyncCohereHandler(self.conv_manager.llm_handler)
+        self._admission = asyncio.Semaphore(self.max_pending)
+
+    @property
+    def pending(self) -> int:
+        return sum(self._conv_users.values())
+
+    async def off_loop(self, func: Callable, *args) -> Any:
+        # In-memory histories (a plain dict) are used directly, anything else may do I/O
+        if type(self.conv_manager.histories) is dict:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def new_conv(self, sys_prompt: str = None, init_history: ConvHist = None) -> UUID:
+        return await self.off_loop(self.conv_manager.new_conv, sys_prompt, init_history)
+
+    def commit_turn(self, conv_id: UUID, msg: str, reply_text: str):
+        self.conv_manager.add_msg(conv_id, msg, StandardRoles.user)
+        self.conv_manager.add_msg(conv_id, reply_text, StandardRoles.assistant)
+        self.conv_manager.compact_history_in_background(conv_id)
+
+    @asynccontextmanager
+    async def admitted(self):
+        try:
+            await asyncio.wait_for(self._admission.acquire(), self.admission_timeout)
+        except asyncio.TimeoutError:
+            raise OverloadedError(f"{self.max_pending} replies are already pending") from None
+        try:
+            yield
+        finally:
+            self._admission.release()
+
+    @asynccontextmanager
+    async def conv_lock(self, conv_id: UUID):
+        # asyncio.Lock wakes its waiters first come first served. The lock is dropped with its last user.
+        lock = self._conv_locks.setdefault(conv_id, asyncio.Lock())
+        self._conv_users[conv_id] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._conv_users[conv_id] -= 1
+            if not self._conv_users[conv_id]:
+                del self._conv_users[conv_id], self._conv_locks[conv_id]
+
+    async def reply_to_msg(self, conv_id: UUID, msg: str, sys_msg: str = None, update_hist: bool = True,
+                           return_json: bool = False) -> str | ChatReplay:
+        async with self.admitted(), self.conv_lock(conv_id):
+            conv_hist = await self.off_loop(self.conv_manager.histories.__getitem__, conv_id)
+            with conversation(conv_id):
+                bot_reply = await self.llm.chat(msg, conv_hist, sys_msg)
+            if update_hist:
+                await self.off_loop(self.commit_turn, conv_id, msg, bot_reply["text"])
+        return bot_reply if return_json else bot_reply["text"]
+
+    async def close(self):
+        await self.llm.close()
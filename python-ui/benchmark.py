@@ -0,0 +1,193 @@
+import argparse
+import json
+import threading
+import tracemalloc
+from dataclasses import dataclass, field, asdict
+from itertools import count
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Callable
+
+import numpy as np
+
+from cohere_tools import ChatLenLimiter, CohereHandler, ConvManager
+from fake_cohere import FakeCohereCfg, fake_cohere_process, fetch_stats
+from hedging import HedgePolicy
+from rate_limiting import ApiRateLimits
+
+# Repeatable load benchmarks of the client against the local stand-in of fake_cohere.py, no network or API spend:
+#   python benchmark.py --concurrency 1 8 32 --ops 300 --json bench.json
+# Compare the JSON of two runs to catch regressions. Latencies include the stand-in's simulated latency, so compare
+# runs with the same --latency. The stand-in runs in a child process, the numbers are the client's alone.
+
+
+@dataclass
+class BenchResult:
+    scenario: str
+    concurrency: int
+    ops: int
+    errors: int
+    seconds: float
+    throughput: float  # Ops per second
+    latency_ms: dict[str, float]  # mean, p50, p95, p99
+    peak_memory_mb: float | type(None)  # Peak Python allocations during the run (tracemalloc), None if not traced
+    extra: dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class BenchContext:
+    url: str  # Of the stand-in server
+    concurrency: int
+    real_rate_limits: bool = False
+
+    def handler(self, hedging: HedgePolicy = None) -> CohereHandler:
+        # By default the client side rate limits are lifted, so they don't dominate the numbers
+        limits = None if self.real_rate_limits else \
+            ApiRateLimits({endpoint: (1e9, 1e6) for endpoint in ("chat", "embed", "rerank", "classify")})
+        return CohereHandler(endpoint_prefix=self.url, rate_limits=limits, hedging=hedging)
+
+
+# A scenario sets up its state and returns the op, called with (worker index, op index). Ops of one worker run
+# sequentially, so per worker state like a conversation is never shared between threads.
+Scenario = Callable[[BenchContext], tuple[Callable[[int, int], Any], Callable[[], dict[str, Any]]]]
+
+
+def chat_scenario(ctx: BenchContext):
+    handler = ctx.handler()
+    return lambda worker, i: handler.chat(f"How do I stay calm? ({i})"), dict
+
+
+def chat_hedged_scenario(ctx: BenchContext):
+    # Compare its p99 with the chat scenario's, best with a --slow-rate tail
+    policy = HedgePolicy(min_samples=10)
+    handler = ctx.handler(policy)
+    return lambda worker, i: handler.chat(f"How do I stay calm? ({i})"), lambda: asdict(policy.stats)
+
+
+def chat_stream_scenario(ctx: BenchContext):
+    handler = ctx.handler()
+
+    def op(worker: int, i: int):
+        for _ in handler.chat_stream(f"How do I stay calm? ({i})"):
+            pass
+    return op, dict
+
+
+def embed_scenario(ctx: BenchContext):
+    handler = ctx.handler()
+    handler.embedding_cache = None  # Every op sends a full batch
+    return lambda worker, i: handler.embed([f"document {i}.{j}" for j in range(96)]), dict
+
+
+def rerank_scenario(ctx: BenchContext):
+    handler = ctx.handler()
+    handler.rerank_score_cache = None
+    documents = [f"passage {j} about {'breathing' if j % 7 == 0 else 'walking'} and the mind" for j in range(500)]
+    return lambda worker, i: handler.rerank_large(f"breathing {i}", documents, top_n=10, chunk_size=100), dict
+
+
+def conv_manager_scenario(ctx: BenchContext):
+    manager = ConvManager(llm_handler=ctx.handler())
+    conversations = [manager.new_conv("You are a calm spiritual teacher.") for _ in range(ctx.concurrency)]
+
+    def extra() -> dict[str, Any]:
+        return {"history_bytes": sum(manager.memory_usage().values()),
+                "messages": sum(len(manager[c].msgs) for c in conversations)}
+    return lambda worker, i: manager.reply_to_msg(conversations[worker], f"Tell me more ({i})"), extra
+
+
+def len_limiter_scenario(ctx: BenchContext):
+    handler = ctx.handler()
+    limiter = ChatLenLimiter(handler.chat, max_words=25)
+    return lambda worker, i: limiter.limit_chat_len(f"Explain meditation ({i})"), lambda: asdict(limiter.stats)
+
+
+SCENARIOS: dict[str, Scenario] = {
+    "chat": chat_scenario,
+    "chat-hedged": chat_hedged_scenario,
+    "chat-stream": chat_stream_scenario,
+    "embed": embed_scenario,
+    "rerank": rerank_scenario,
+    "conv-manager": conv_manager_scenario,
+    "len-limiter": len_limiter_scenario,
+}
+
+
+def run(scenario: str, ctx: BenchContext, ops: int, trace_memory: bool = True) -> BenchResult:
+    op, extra = SCENARIOS[scenario](ctx)
+    op(0, -1)  # Warm up: the catalog, connections and imports aren't part of the numbers
+    next_op = count()
+    latencies: list[list[float]] = [[] for _ in range(ctx.concurrency)]
+    errors: list[int] = [0] * ctx.concurrency
+    server_before = fetch_stats(ctx.url)
+
+    def worker(w: int):
+        while (i := next(next_op)) < ops:
+            started = perf_counter()
+            try:
+                op(w, i)
+            except Exception:
+                errors[w] += 1
+                continue
+            latencies[w].append(perf_counter() - started)
+
+    if trace_memory:
+        tracemalloc.start()
+    started = perf_counter()
+    threads = [threading.Thread(target=worker, args=(w,), name=f"bench-{w}") for w in range(ctx.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = perf_counter() - started
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+
+    all_latencies = np.array([x for worker_latencies in latencies for x in worker_latencies]) * 1000
+    latency_ms = {"mean": float(all_latencies.mean())} | {
+        f"p{p}": float(v) for p, v in zip((50, 95, 99), np.percentile(all_latencies, (50, 95, 99)))
+    } if len(all_latencies) else {}
+    server_calls = fetch_stats(ctx.url) - server_before
+    return BenchResult(scenario, ctx.concurrency, ops, sum(errors), seconds, len(all_latencies) / seconds, latency_ms,
+                       peak_memory, extra() | {"server_calls": dict(server_calls)})
+
+
+HEADER: str = (f"{'scenario':<14}{'conc':>5}{'ops/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}"
+               f"{'peak MB':>9}")
+
+
+def format_result(r: BenchResult) -> str:
+    memory = f"{r.peak_memory_mb:.1f}" if r.peak_memory_mb is not None else "-"
+    return (f"{r.scenario:<14}{r.concurrency:>5}{r.throughput:>9.1f}{r.latency_ms.get('p50', 0):>9.1f}"
+            f"{r.latency_ms.get('p95', 0):>9.1f}{r.latency_ms.get('p99', 0):>9.1f}{r.errors:>8}{memory:>9}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Cohere client against a local stand-in server.")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--ops", type=int, default=200, help="Ops per scenario and concurrency level")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean seconds per call of the stand-in")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Share of calls taking --slow-latency")
+    parser.add_argument("--slow-latency", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--real-rate-limits", action="store_true", help="Keep the client side rate limits")
+    parser.add_argument("--no-memory", action="store_true", help="Don't trace allocations (tracemalloc slows runs)")
+    parser.add_argument("--json", type=Path, help="Also write the results to this file")
+    args = parser.parse_args()
+
+    server_cfg = FakeCohereCfg(latency=args.latency, slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+                               error_rate=args.error_rate, throttle_rate=args.throttle_rate, retry_after=0.1)
+    bench_results: list[BenchResult] = []
+    print(HEADER)
+    with fake_cohere_process(server_cfg) as server_url:
+        for scenario_name in args.scenarios:
+            for concurrency in args.concurrency:
+                bench_ctx = BenchContext(server_url, concurrency, args.real_rate_limits)
+                bench_results.append(run(scenario_name, bench_ctx, args.ops, not args.no_memory))
+                print(format_result(bench_results[-1]))
+    if args.json:
+        args.json.write_text(json.dumps([asdict(r) for r in bench_results], indent=2), encoding="utf-8")
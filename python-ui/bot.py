@@ -1,15 +1,16 @@
+from typing import Callable
+
 from cohere_tools import CohereHandler, ConvHistoriesManager
 
 llm_handler = CohereHandler()
 histories = ConvHistoriesManager()
 conv_id = histories.new_conv()
 
-def chat(user_response):
-    histories.add_msg(conv_id, user_response, 'USER')
+def chat(user_response, should_commit: Callable[[], bool] = None):
     bot_response = llm_handler.chat(user_response, histories[conv_id])
+    # A cancelled request leaves the history untouched, so the next message doesn't see the dropped exchange
+    if should_commit is not None and not should_commit():
+        return None
+    histories.add_msg(conv_id, user_response, 'USER')
     histories.add_msg(conv_id, bot_response['text'], 'CHATBOT')
     return bot_response['text']
-
-
-    
-
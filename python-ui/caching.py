@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import time
+from typing import Any, Callable
+
+
+def canonical_hash(obj: Any) -> str:
+    # Key order and whitespace don't change the hash, so equal payloads built in a different order share an entry
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False,
+                                     default=str).encode()).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    disk_hits: int = 0
+    skipped: int = 0  # Requests that bypassed the cache, e.g. high temperature chat requests
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+@dataclass
+class LruTtlCache:
+    # Thread-safe in-memory LRU with a time to live, bounded both by the number of entries and their total size
+    max_entries: int = 1024
+    max_bytes: int = 0  # 0 means unbounded. Sizes are measured with size_of.
+    ttl: float = 0  # Seconds, 0 means entries never expire
+    size_of: Callable[[Any], int] = field(default=lambda v: 1, repr=False)
+    stats: CacheStats = field(default_factory=CacheStats)
+    _entries: OrderedDict = field(init=False, default_factory=OrderedDict, repr=False)  # key -> (expiry, size, value)
+    _bytes: int = field(init=False, default=0)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock, repr=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._bytes
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return default
+            expiry, size, value = entry
+            if expiry and expiry < time():
+                del self._entries[key]
+                self._bytes -= size
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return value
+
+    def put(self, key: str, value: Any):
+        size = self.size_of(value)
+        if self.max_bytes and size > self.max_bytes:
+            return  # Would evict everything else and still not fit
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._bytes -= old_entry[1]
+            self._entries[key] = (time() + self.ttl if self.ttl else 0, size, value)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes):
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.stats.evictions += 1
+
+    def discard(self, key: str):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+@dataclass
+class DiskJsonCache:
+    # One JSON file per key, sharded by the key prefix. Writes go through a temp file so readers never see a partial
+    # entry, which also makes the cache safe to share between processes.
+    cache_dir: Path
+    ttl: float = 0  # Seconds, 0 means entries never expire
+
+    def __post_init__(self):
+        self.cache_dir = Path(self.cache_dir)
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def get(self, key: str, default: Any = None) -> Any:
+        path = self._path(key)
+        try:
+            if self.ttl and path.stat().st_mtime + self.ttl < time():
+                path.unlink(missing_ok=True)
+                return default
+            return json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return default
+
+    def put(self, key: str, value: Any):
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp_path.write_text(json.dumps(value, ensure_ascii=False), encoding="utf-8")
+            tmp_path.replace(path)
+        except OSError:
+            pass  # The disk tier is best-effort, the in-memory tier still has the entry
+
+    def discard(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+
+
+@dataclass
+class ResponseCache:
+    # Opt-in cache for deterministic-enough requests. The key is a canonical hash of the full request payload,
+    # including the model and the generation config, so any change in the request is a different entry.
+    max_entries: int = 1024
+    max_bytes: int = 32 * 1024 * 1024
+    ttl: float = 60 * 60  # Seconds
+    max_temperature: float = 0.3  # Requests sampled with a higher temperature aren't cached
+    disk_dir: Path | type(None) = None  # Optional second tier, shared between processes
+    memory: LruTtlCache = field(init=False)
+    disk: DiskJsonCache | type(None) = field(init=False, default=None)
+
+    def __post_init__(self):
+        self.memory = LruTtlCache(self.max_entries, self.max_bytes, self.ttl,
+                                  size_of=lambda v: len(json.dumps(v, ensure_ascii=False)))
+        if self.disk_dir is not None:
+            self.disk = DiskJsonCache(self.disk_dir, self.ttl)
+
+    @property
+    def stats(self) -> CacheStats:
+        return self.memory.stats
+
+    def is_cacheable(self, payload: dict[str, Any]) -> bool:
+        if payload.get("stream"):
+            return False
+        temperature = payload.get("temperature")
+        return temperature is None or temperature <= self.max_temperature
+
+    def get(self, payload: dict[str, Any]) -> tuple[str | type(None), Any]:
+        # Returns (key, cached value). The key is None if the payload isn't cacheable.
+        if not self.is_cacheable(payload):
+            self.stats.skipped += 1
+            return None, None
+        key = canonical_hash(payload)
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.stats.disk_hits += 1
+                self.memory.put(key, value)
+        return key, value
+
+    def put(self, key: str, value: Any):
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def clear(self):
+        self.memory.clear()
@@ -0,0 +1,118 @@
+import queue
+import threading
+from dataclasses import dataclass, field
+from itertools import count
+from time import perf_counter
+from typing import Callable
+
+# chat_func(msg, should_commit) -> reply. should_commit() must be called right before the reply is committed to the
+# conversation history, and the history must be left untouched if it returns False (the request was cancelled).
+ChatFunc = Callable[[str, Callable[[], bool]], str]
+
+
+@dataclass
+class ChatRequest:
+    msg: str
+    request_id: int
+    submitted_at: float = field(default_factory=perf_counter)
+    started_at: float | type(None) = None
+    _committed: bool = False
+    _cancelled: bool = False
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def try_commit(self) -> bool:
+        with self._lock:
+            if self._cancelled:
+                return False
+            self._committed = True
+            return True
+
+    def try_cancel(self) -> bool:
+        # A request whose reply was already committed to the history can't be cancelled anymore
+        with self._lock:
+            if self._committed:
+                return False
+            self._cancelled = True
+            return True
+
+
+@dataclass
+class ChatResult:
+    request: ChatRequest
+    reply: str | type(None) = None
+    error: Exception | type(None) = None
+    latency: float = 0.0  # Seconds from submission to reply, including the time spent waiting in the queue
+    service_time: float = 0.0  # Seconds spent on the LLM round trip (including retries)
+
+
+@dataclass
+class ChatExecutor:
+    # Runs the chat calls on a single worker thread, so messages of the conversation are answered in order and the Tk
+    # main thread never blocks. Results are pushed to a thread-safe queue, which the GUI drains with after() polling.
+    chat_func: ChatFunc
+    results: queue.Queue = field(init=False, default_factory=queue.Queue)
+    _jobs: queue.Queue = field(init=False, default_factory=queue.Queue)
+    _ids: count = field(init=False, default_factory=count)
+    _current: ChatRequest | type(None) = field(init=False, default=None)
+    _pending: list[ChatRequest] = field(init=False, default_factory=list)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    _worker: threading.Thread = field(init=False)
+
+    def __post_init__(self):
+        self._worker = threading.Thread(target=self._run, name="chat-executor", daemon=True)
+        self._worker.start()
+
+    def submit(self, msg: str) -> ChatRequest:
+        request = ChatRequest(msg, next(self._ids))
+        with self._lock:
+            self._pending.append(request)
+        self._jobs.put(request)
+        return request
+
+    @property
+    def busy(self) -> bool:
+        with self._lock:
+            return self._current is not None or bool(self._pending)
+
+    @property
+    def queued(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def cancel_current(self) -> bool:
+        # The HTTP call itself can't be interrupted, but its reply is dropped and never reaches the history
+        with self._lock:
+            current = self._current
+        return current.try_cancel() if current is not None else False
+
+    def cancel_all(self) -> int:
+        with self._lock:
+            requests = ([self._current] if self._current else []) + self._pending
+        return sum(request.try_cancel() for request in requests)
+
+    def shutdown(self):
+        self.cancel_all()
+        self._jobs.put(None)
+
+    def _run(self):
+        while (request := self._jobs.get()) is not None:
+            with self._lock:
+                self._pending.remove(request)
+                self._current = request
+            if not request.cancelled:
+                request.started_at = perf_counter()
+                try:
+                    reply = self.chat_func(request.msg, request.try_commit)
+                    result = ChatResult(request, reply=reply)
+                except Exception as e:
+                    result = ChatResult(request, error=e)
+                result.service_time = perf_counter() - request.started_at
+                result.latency = perf_counter() - request.submitted_at
+                if not request.cancelled:
+                    self.results.put(result)
+            with self._lock:
+                self._current = None
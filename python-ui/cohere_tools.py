@@ -1,27 +1,55 @@
+import hashlib
+import inspect
 import json
 import os
+import re
+import sys
+import threading
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextvars import copy_context
 from copy import copy
-from dataclasses import dataclass, field, asdict
+from dataclasses import dataclass, field, asdict, replace
 from enum import Enum
 from functools import wraps
-from itertools import chain
-from time import sleep
-from typing import Any, Callable
+from itertools import chain, cycle, islice
+from pathlib import Path
+from time import monotonic, perf_counter, sleep, time
+from typing import Any, Callable, ClassVar, Iterable, Iterator
 from uuid import uuid4, UUID
 from warnings import warn
 
+import numpy as np
 import requests
 from requests import Response
 from stamina import retry
 
+from caching import LruTtlCache, ResponseCache, canonical_hash
+from hedging import HedgePolicy
+from http_transport import DeadlineExceeded, HttpTransport, TransportCfg, deadline
+from metrics import ClientMetrics, conversation
+from rate_limiting import ApiRateLimits, Priority, current_priority, lane, shared_rate_limits
+
 ENDPOINT_PREFIX: str = "https://api.cohere.com/v1/"
+CATALOG_CACHE_DIR: Path = Path(os.environ.get("CohereCatalogCacheDir", Path.home() / ".cache" / "roga"))
 
 
 class EndpointModelMap(Enum):
-    classify = 'embed-multilingual-light-v3.0'
-    embed = 'embed-multilingual-light-v3.0'
-    chat = 'c4ai-aya-23'
-    rerank = 'rerank-multilingual-v3.0'
+    # The endpoint name is part of the value, otherwise endpoints sharing a model (embed and classify) would be
+    # merged into a single enum member.
+    classify = ('classify', 'embed-multilingual-light-v3.0')
+    embed = ('embed', 'embed-multilingual-light-v3.0')
+    chat = ('chat', 'c4ai-aya-23')
+    rerank = ('rerank', 'rerank-multilingual-v3.0')
+
+    @property
+    def model(self) -> str:
+        return self.value[1]
+
+
+EMBED_BATCH_SIZE: int = 96  # Max texts per embed request
+RERANK_MAX_DOCUMENTS: int = 1000  # Max documents per rerank request
+CLASSIFY_BATCH_SIZE: int = 96  # Max inputs per classify request
 
 
 @dataclass
@@ -34,6 +62,7 @@ class GenCfg:
     presence_penalty: float = 0.0
     prompt_truncation: str = None  # Options are "OFF", "AUTO_PRESERVE_ORDER" or "AUTO"
     citation_quality: str = "accurate"   # Options are "accurate" or "fast"
+    max_tokens: int = None  # Max generated tokens, the reply is cut off (finish_reason MAX_TOKENS) past it
 
     def parse(self) -> dict[str, Any]:
         return {k: v for k, v in asdict(self).items() if v is not None}
@@ -50,6 +79,15 @@ class Document:
         return {k: v for k, v in asdict(self).items() if v is not None}
 
 
+@dataclass
+class ClassifyExample:
+    text: str
+    label: str
+
+    def parse(self):
+        return asdict(self)
+
+
 class StandardRoles(Enum):
     system = "SYSTEM"
     user = "USER"
@@ -57,34 +95,150 @@ class StandardRoles(Enum):
     tool = "TOOL"
 
 
-@dataclass
+class RawJson(str):
+    # An already serialized JSON value. dumps_payload splices it into the request body as is.
+    pass
+
+
+def dumps_payload(data: dict[str, Any]) -> str:
+    # json.dumps for request bodies, except that top-level RawJson values aren't serialized again
+    if not any(isinstance(v, RawJson) for v in data.values()):
+        return json.dumps(data)
+    return "{" + ", ".join(f"{json.dumps(k)}: {v if isinstance(v, RawJson) else json.dumps(v)}"
+                           for k, v in data.items()) + "}"
+
+
+@dataclass(slots=True)
 class ConvMsg:
     role: StandardRoles | str
     msg: str
 
+    def __post_init__(self):
+        # Every message of a role shares one role string (enum members are singletons already)
+        if isinstance(self.role, str):
+            self.role = sys.intern(self.role)
+
+    @property
+    def role_value(self) -> str:
+        return self.role.value if isinstance(self.role, StandardRoles) else self.role
+
     def parse(self) -> dict[str, str]:
-        d = asdict(self)
-        if isinstance(self.role, StandardRoles):
-            d["role"] = self.role.value
-        return d
+        # API reference: https://docs.cohere.com/reference/chat (chat_history items)
+        return {"role": self.role_value, "message": self.msg}
+
+    def to_json(self) -> str:
+        return json.dumps(self.parse())
+
+
+def estimate_tokens(text: str) -> int:
+    # A fast local upper-bound-ish estimate. ~4 bytes per token holds for English, and counting UTF-8 bytes instead of
+    # characters accounts for scripts like Hebrew that take more tokens per character.
+    return len(text.encode("utf-8")) // 4 + 1
 
 
 @dataclass
 class ConvHist:
-    def __init__(self, sys_msg: str = None, msgs: list[ConvMsg] = None):
+    def __init__(self, sys_msg: str = None, msgs: list[ConvMsg] = None, max_tokens: int = 0):
         self.msgs: list[ConvMsg] = msgs or []
         self.sys_msg = sys_msg or ""
-
-    def parse(self, include_sys_msg: bool = False) -> dict[str, str | list[dict[str, str]]]:
+        # History token budget, 0 means the whole history is always sent. With a budget the most recent messages that
+        # fit are sent, pinned messages are always sent, and the older ones are represented by a summary.
+        self.max_tokens: int = max_tokens
+        self.pinned: set[int] = set()  # Indices into msgs
+        self.summary: str = ""
+        self.summarized_upto: int = 0  # The summary covers the unpinned messages before this index
+        self.window_start: int = 0  # The oldest unpinned message sent by the last parse
+        # Append-only caches parallel to msgs: the serialized JSON of each message and its token estimate.
+        # Messages are never edited in place, so an entry stays valid until update_msgs replaces the list.
+        self._fragments: list[str] = []
+        self._token_counts: list[int] = []
+
+    def _sync_caches(self):
+        for m in self.msgs[len(self._fragments):]:
+            self._fragments.append(m.to_json())
+            self._token_counts.append(estimate_tokens(m.msg))
+
+    def parse(self, include_sys_msg: bool = False, raw: bool = False
+              ) -> dict[str, str | list[dict[str, str]] | RawJson]:
         # API reference: https://docs.cohere.com/reference/chat
+        # With raw=True chat_history is a RawJson built by joining the cached message fragments, so nothing is
+        # serialized again. Send it with dumps_payload.
         chat_hist_json = {}
-        if self.msgs:
-            chat_hist_json["chat_history"] = [m.parse() for m in self.get_all_msgs(include_sys_msg=False)]
+        indices = self.get_budgeted_indices() if self.max_tokens else range(len(self.msgs))
+        summary_msg = self.get_summary_msg()
+        if indices or summary_msg:
+            if raw:
+                self._sync_caches()
+                fragments = [summary_msg.to_json()] if summary_msg else []
+                fragments.extend(self._fragments[i] for i in indices)
+                chat_hist_json["chat_history"] = RawJson(f"[{', '.join(fragments)}]")
+            else:
+                msgs = [summary_msg] if summary_msg else []
+                msgs.extend(self.msgs[i] for i in indices)
+                chat_hist_json["chat_history"] = [m.parse() for m in msgs]
         if self.sys_msg and include_sys_msg:
             chat_hist_json["preamble"] = self.sys_msg
         return chat_hist_json
 
-    def add_msg(self, msg: str | ConvMsg, role: str | StandardRoles = None):
+    def get_summary_msg(self) -> ConvMsg | type(None):
+        if not (self.max_tokens and self.summary and self.summarized_upto):
+            return None
+        return ConvMsg(StandardRoles.system, f"Summary of the earlier conversation: {self.summary}")
+
+    def get_budgeted_indices(self) -> list[int]:
+        self._sync_caches()
+        budget = self.max_tokens - sum(self._token_counts[i] for i in self.pinned)
+        if self.summary:
+            budget -= estimate_tokens(self.summary)
+        kept: set[int] = set(self.pinned)
+        self.window_start = len(self.msgs)
+        for i in range(len(self.msgs) - 1, -1, -1):
+            if i in self.pinned:
+                continue
+            cost = self._token_counts[i]
+            if cost > budget:
+                break
+            budget -= cost
+            kept.add(i)
+            self.window_start = i
+        return sorted(kept)
+
+    def get_budgeted_msgs(self) -> list[ConvMsg]:
+        summary_msg = self.get_summary_msg()
+        return ([summary_msg] if summary_msg else []) + [self.msgs[i] for i in self.get_budgeted_indices()]
+
+    def memory_usage(self) -> int:
+        # Approximate bytes held by this conversation, including the serialization caches
+        strings = [m.msg for m in self.msgs] + self._fragments + [self.sys_msg, self.summary]
+        return (sys.getsizeof(self.msgs) + sum(sys.getsizeof(m) for m in self.msgs)
+                + sum(sys.getsizeof(x) for x in strings)
+                + sys.getsizeof(self._fragments) + sys.getsizeof(self._token_counts)
+                + len(self._token_counts) * sys.getsizeof(0) + sys.getsizeof(self.pinned))
+
+    def needs_compaction(self) -> bool:
+        # True if unpinned messages fell out of the budget window and aren't covered by the summary yet
+        if not self.max_tokens:
+            return False
+        self.get_budgeted_indices()
+        return any(i not in self.pinned for i in range(self.summarized_upto, self.window_start))
+
+    def msgs_to_compact(self) -> tuple[list[ConvMsg], int]:
+        # The messages the next summary should add, and the summarized_upto value to set once it's done
+        upto = self.window_start
+        return [self.msgs[i] for i in range(self.summarized_upto, upto) if i not in self.pinned], upto
+
+    def pin(self, index: int = -1):
+        self.pinned.add(self._msg_index(index))
+
+    def unpin(self, index: int):
+        self.pinned.discard(self._msg_index(index))
+
+    def _msg_index(self, index: int) -> int:
+        if not -len(self.msgs) <= index < len(self.msgs):
+            raise IndexError(f"Message index {index} is out of range for a history of {len(self.msgs)} messages")
+        return index % len(self.msgs)
+
+    def add_msg(self, msg: str | ConvMsg, role: str | StandardRoles = None, pinned: bool = False):
         if role and isinstance(msg, str):
             parsed_msg = ConvMsg(role, msg)
         elif role is None and isinstance(msg, ConvMsg):
@@ -93,6 +247,8 @@ class ConvHist:
             raise ValueError(f"A new message must be with a ConvMsg with role=None, or a string with role. "
                              f"Received {role=} of type {type(role)}, and {msg=} of type {type(msg)}.")
         self.msgs.append(parsed_msg)
+        if pinned:
+            self.pinned.add(len(self.msgs) - 1)
 
     def get_all_msgs(self, include_sys_msg: bool = False) -> list[ConvMsg]:
         if include_sys_msg:
@@ -101,6 +257,8 @@ class ConvHist:
 
     def update_msgs(self, msgs: list[ConvMsg], sys_msg: str = None, update_sys_msg: bool = False):
         self.msgs = msgs
+        self.pinned, self.summary, self.summarized_upto, self.window_start = set(), "", 0, 0
+        self._fragments, self._token_counts = [], []
         if update_sys_msg:
             self.sys_msg = sys_msg if isinstance(sys_msg, str) else ""
 
@@ -108,17 +266,24 @@ class ConvHist:
 @dataclass
 class ConvHistoriesManager:
     histories: dict[UUID, ConvHist] = field(default_factory=dict)
+    max_history_tokens: int = 0  # History token budget of new conversations, 0 means unbounded
 
     def new_conv(self, sys_prompt: str = None, init_history: ConvHist=None) -> UUID:
         conv_id: UUID = uuid4()
-        self.histories[conv_id] = ConvHist(sys_prompt, init_history)
+        self.histories[conv_id] = ConvHist(sys_prompt, init_history, self.max_history_tokens)
         return conv_id
 
     def update_sys_prompt(self, conv_id: UUID, sys_prompt: str):
         self.histories[conv_id].sys_msg = sys_prompt
 
-    def add_msg(self, conv_id: UUID, msg: ConvMsg | str, role: StandardRoles | str = None):
-        self.histories[conv_id].add_msg(msg, role)
+    def add_msg(self, conv_id: UUID, msg: ConvMsg | str, role: StandardRoles | str = None, pinned: bool = False):
+        self.histories[conv_id].add_msg(msg, role, pinned)
+
+    def pin(self, conv_id: UUID, index: int = -1):
+        self.histories[conv_id].pin(index)
+
+    def unpin(self, conv_id: UUID, index: int):
+        self.histories[conv_id].unpin(index)
 
     def __getitem__(self, conv_id: UUID) -> ConvHist:
         return self.histories[conv_id]
@@ -129,17 +294,166 @@ class ConvHistoriesManager:
     def update_msgs(self, conv_id: UUID, msgs: list[ConvMsg], sys_msg: str = None, update_sys_msg: bool = False):
         self.histories[conv_id].update_msgs(msgs, sys_msg, update_sys_msg)
 
+    def memory_usage(self) -> dict[UUID, int]:
+        return {conv_id: conv_hist.memory_usage() for conv_id, conv_hist in self.histories.items()}
+
 
 ChatReplay = dict[str, str | list[dict[str, str]] | dict[str, dict[str, str]]]
 
 
+class ApiClientError(requests.HTTPError):
+    # A 4xx other than 429: the request (or the key, or the model) was rejected, so retrying can't help
+    pass
+
+
+class ConversationNotFoundError(ApiClientError):
+    # A 404 to a chat request with a conversation_id, the server doesn't know (anymore) the conversation
+    pass
+
+
+def is_retryable(exc: Exception) -> bool:
+    # Connection errors, timeouts, 429s and 5xx are retried
+    return isinstance(exc, requests.RequestException) and not isinstance(exc, ApiClientError)
+
+
+@dataclass
+class ModelCatalog:
+    available_endpoint_models: dict[str, set[str]]
+    endpoint_to_model_map: dict[str, str | type(None)]
+    fetched_at: float = field(default_factory=time)
+
+    def age(self) -> float:
+        return time() - self.fetched_at
+
+    def to_json(self) -> dict[str, Any]:
+        return {"available_endpoint_models": {e: sorted(m) for e, m in self.available_endpoint_models.items()},
+                "endpoint_to_model_map": self.endpoint_to_model_map,
+                "fetched_at": self.fetched_at}
+
+    @classmethod
+    def from_json(cls, d: dict[str, Any]) -> "ModelCatalog":
+        return cls({e: set(m) for e, m in d["available_endpoint_models"].items()},
+                   d["endpoint_to_model_map"],
+                   d["fetched_at"])
+
+    @classmethod
+    def from_models_response(cls, available_models: list[dict[str, str]]) -> "ModelCatalog":
+        available_endpoints: set[str] = set(chain(*(m["endpoints"] for m in available_models)))
+        available_endpoint_models: dict[str, set[str]] = {e: set(m["name"] for m in available_models
+                                                                 if e in m['endpoints'])
+                                                          for e in available_endpoints}
+        requested_endpoints = set(el.name for el in EndpointModelMap)
+        unavailable_endpoints = requested_endpoints - available_endpoints
+        if unavailable_endpoints:
+            warn(f"Some requested endpoints in endpoint_to_model_map aren't available. "
+                 f"The endpoints {unavailable_endpoints} aren't available. Available endpoints: {available_endpoints}.")
+        endpoint_to_model_map: dict[str, str | type(None)] \
+            = {endpoint: EndpointModelMap[endpoint].model for endpoint in requested_endpoints & available_endpoints}
+        for endpoint, model in endpoint_to_model_map.items():
+            if model not in available_endpoint_models[endpoint]:
+                warn(f"The model {model} isn't available for the {endpoint} endpoint. Switching to default. "
+                     f"Available models for this endpoint: {available_endpoint_models[endpoint]}")
+                endpoint_to_model_map[endpoint] = None
+        return cls(available_endpoint_models, endpoint_to_model_map)
+
+
+@dataclass
+class CatalogCache:
+    # A validated catalog is shared by every handler in the process (keyed by a hash of the API key and the server,
+    # never the key itself) and persisted to disk, so a new handler or a restarted process doesn't need any network
+    # round trip.
+    # A catalog older than ttl is still served, but triggers a single background revalidation.
+    cache_dir: Path | type(None) = CATALOG_CACHE_DIR  # None disables the on-disk tier
+    ttl: float = 24 * 60 * 60  # Seconds
+
+    _memory: ClassVar[dict[str, ModelCatalog]] = {}
+    _refreshing: ClassVar[set[str]] = set()
+    _lock: ClassVar[threading.Lock] = threading.Lock()
+
+    @staticmethod
+    def key_for(api_key: str, endpoint_prefix: str = ENDPOINT_PREFIX) -> str:
+        # Per server too, so a handler pointed at a stand-in (fake_cohere.py) never shares the production catalog
+        return hashlib.sha256(f"{endpoint_prefix}\n{api_key}".encode()).hexdigest()[:16]
+
+    def _path(self, key: str) -> Path | type(None):
+        return self.cache_dir / f"cohere_catalog_{key}.json" if self.cache_dir else None
+
+    def get(self, key: str) -> ModelCatalog | type(None):
+        with self._lock:
+            catalog = self._memory.get(key)
+        if catalog is not None:
+            return catalog
+        path = self._path(key)
+        if path is None or not path.exists():
+            return None
+        try:
+            catalog = ModelCatalog.from_json(json.loads(path.read_text(encoding="utf-8")))
+        except (OSError, ValueError, KeyError):
+            return None  # A corrupt cache file is treated as a miss and overwritten by the next store
+        with self._lock:
+            return self._memory.setdefault(key, catalog)
+
+    def store(self, key: str, catalog: ModelCatalog):
+        with self._lock:
+            self._memory[key] = catalog
+        path = self._path(key)
+        if path is None:
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(catalog.to_json()), encoding="utf-8")
+            tmp_path.replace(path)
+        except OSError as e:
+            warn(f"Couldn't persist the Cohere model catalog to {path}: {e}")
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._memory.pop(key, None)
+        path = self._path(key)
+        if path is not None:
+            path.unlink(missing_ok=True)
+
+    def is_stale(self, catalog: ModelCatalog) -> bool:
+        return catalog.age() > self.ttl
+
+    def refresh_in_background(self, key: str, fetch: Callable[[], ModelCatalog]):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self.store(key, fetch())
+            except Exception as e:  # The stale catalog stays in use, the next handler or 401/404 retries
+                warn(f"Background revalidation of the Cohere model catalog failed: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, name="cohere-catalog-refresh", daemon=True).start()
+
+
 @dataclass
 class CohereHandler:
+    # CohereEndpointPrefix points the handler to another server, e.g. the local stand-in of fake_cohere.py
+    endpoint_prefix: str = field(default_factory=lambda: os.environ.get("CohereEndpointPrefix", ENDPOINT_PREFIX))
     base_headers: dict[str, str] = field(init=False)
     model_headers: dict[str, str] = field(init=False)
-    endpoint_to_model_map: dict[str, str] = field(init=False)
+    transport_cfg: TransportCfg = field(default_factory=TransportCfg)
+    transport: HttpTransport = field(init=False, repr=False)
+    catalog_cache: CatalogCache = field(default_factory=CatalogCache)
+    catalog_key: str = field(init=False, repr=False)
+    response_cache: ResponseCache | type(None) = None  # Opt-in, e.g. CohereHandler(response_cache=ResponseCache())
+    embedding_cache: LruTtlCache | type(None) = field(default_factory=lambda: LruTtlCache(max_entries=100_000))
+    rerank_score_cache: LruTtlCache | type(None) = field(default_factory=lambda: LruTtlCache(max_entries=100_000))
+    rate_limits: ApiRateLimits = None  # Defaults to the limits shared by every handler using the same API key
+    metrics: ClientMetrics | type(None) = None  # Opt-in, e.g. CohereHandler(metrics=ClientMetrics())
+    hedging: HedgePolicy | type(None) = None  # Opt-in, e.g. CohereHandler(hedging=HedgePolicy())
 
     def __post_init__(self):
+        self.transport = HttpTransport(self.transport_cfg)
         try:
             api_key: str = os.environ['CohereKey']
         except KeyError:
@@ -147,8 +461,32 @@ class CohereHandler:
         auth_str: str = f"bearer {api_key}"
         self.base_headers: dict[str, str] = {"accept": "application/json", "Authorization": auth_str}
         self.model_headers: dict[str, str] = self.base_headers | {'content-type': 'application/json'}
+        self.catalog_key = self.catalog_cache.key_for(api_key, self.endpoint_prefix)
+        if self.rate_limits is None:
+            self.rate_limits = shared_rate_limits(self.catalog_key)
+
+        catalog = self.catalog_cache.get(self.catalog_key)
+        if catalog is None:
+            self.revalidate_catalog()
+        elif self.catalog_cache.is_stale(catalog):
+            self.catalog_cache.refresh_in_background(self.catalog_key, self.fetch_catalog)
+
+    @property
+    def catalog(self) -> ModelCatalog:
+        catalog = self.catalog_cache.get(self.catalog_key)
+        return catalog if catalog is not None else self.revalidate_catalog()
+
+    @property
+    def available_endpoint_models(self) -> dict[str, set[str]]:
+        return self.catalog.available_endpoint_models
+
+    @property
+    def endpoint_to_model_map(self) -> dict[str, str | type(None)]:
+        return self.catalog.endpoint_to_model_map
+
+    def fetch_catalog(self) -> ModelCatalog:
         # Checking API access and validating the API key
-        response: Response = requests.post(f"{ENDPOINT_PREFIX}check-api-key", headers=self.base_headers)
+        response: Response = self.transport.post(f"{self.endpoint_prefix}check-api-key", headers=self.base_headers)
         if not response.status_code == 200:
             raise ConnectionError("Couldn't connect to the Cohere API. Check the internet connection.")
         if not response.json()["valid"]:
@@ -157,63 +495,211 @@ class CohereHandler:
                            f"The response from the check-api-key endpoint: {response.json()}")
 
         # Validating the requested model list
-        response: Response = requests.get(f"{ENDPOINT_PREFIX}models", headers=self.base_headers)
-        available_models: list[dict[str, str]] = response.json()["models"]
-        available_endpoints: set[str] = set(chain(*(m["endpoints"] for m in available_models)))
-        self.available_endpoint_models: dict[str, set[str]] = {e: set(m["name"] for m in available_models
-                                                                      if e in m['endpoints'])
-                                                               for e in available_endpoints}
-        requested_endpoints = set(el.name for el in EndpointModelMap)
-        unavailable_endpoints = requested_endpoints - available_endpoints
-        if unavailable_endpoints:
-            warn(f"Some requested endpoints in endpoint_to_model_map aren't available. "
-                 f"The endpoints {unavailable_endpoints} aren't available. Available endpoints: {available_endpoints}.")
-            for endpoint in unavailable_endpoints:
-                _ = self.endpoint_to_model_map.pop(endpoint)
-        self.endpoint_to_model_map: dict[str, str | type(None)] \
-            = {endpoint: EndpointModelMap[endpoint].value for endpoint in requested_endpoints & available_endpoints}
-        for endpoint, model in self.endpoint_to_model_map.items():
-            if model not in self.available_endpoint_models[endpoint]:
-                warn(f"The model {model} isn't available for the {endpoint} endpoint. Switching to default. "
-                     f"Available models for this endpoint: {self.available_endpoint_models[endpoint]}")
-                self.endpoint_to_model_map[endpoint] = None
+        response: Response = self.transport.get(f"{self.endpoint_prefix}models", headers=self.base_headers)
+        return ModelCatalog.from_models_response(response.json()["models"])
 
-    @retry(on=requests.RequestException, attempts=5, wait_initial=300)
-    def call_endpoint(self, endpoint: EndpointModelMap, data: dict[str, Any], model: str = None) -> dict:
+    def revalidate_catalog(self) -> ModelCatalog:
+        catalog = self.fetch_catalog()
+        self.catalog_cache.store(self.catalog_key, catalog)
+        return catalog
+
+    def set_model(self, endpoint: EndpointModelMap, data: dict[str, Any], model: str = None):
         if model:
             endpoint_available_models = self.available_endpoint_models[endpoint.name]
             if model in endpoint_available_models:
                 data["model"] = model
             else:
                 warn(f"Requested {model=} for endpoint {endpoint.name}. This model is unavailable, defaulting to "
-                     f"{endpoint.value}.\n"
+                     f"{endpoint.model}.\n"
                      f"Available models: {endpoint_available_models}")
-                data["model"] = endpoint.value
+                data["model"] = endpoint.model
         else:
-            data["model"] = endpoint.value
-
-        data_str = json.dumps(data)
-        response: Response = requests.post(f"{ENDPOINT_PREFIX}{endpoint.name}",
-                                           headers=self.model_headers,
-                                           data=data_str,
-                                           )
+            # A None in the validated map means the requested model is unavailable, so the API default is used
+            default_model = self.endpoint_to_model_map.get(endpoint.name, endpoint.model)
+            data.pop("model", None)
+            if default_model:
+                data["model"] = default_model
 
+    def raise_for_status(self, endpoint: EndpointModelMap, response: Response, data: dict[str, Any] = None):
         if response.status_code == 200:
-            chat_reply: ChatReplay = response.json()
-            return chat_reply
+            return
         if response.status_code == 429:
-            raise requests.RequestException(f"Received status code 429")
-        raise requests.HTTPError(f"Received status code {response.status_code} when calling the {endpoint} endpoint")
+            # The rate limiter already paused the endpoint (by Retry-After), the retry waits for its next token
+            raise requests.RequestException(f"Received status code 429", response=response)
+        message = f"Received status code {response.status_code} when calling the {endpoint} endpoint"
+        if response.status_code >= 500:
+            raise requests.HTTPError(message, response=response)
+        if response.status_code == 404 and data is not None and "conversation_id" in data:
+            # The conversation expired, not the catalog, see ConvManager.server_memory_reply
+            raise ConversationNotFoundError(message, response=response)
+        if response.status_code in (401, 404):
+            # The key was revoked or a model was retired since the catalog was cached, so the catalog is revalidated
+            # for the next call. An invalid key raises a KeyError here.
+            self.catalog_cache.invalidate(self.catalog_key)
+            self.revalidate_catalog()
+        raise ApiClientError(message, response=response)
+
+    def post(self, endpoint: EndpointModelMap, data: dict[str, Any], priority: Priority = None, **kwargs
+             ) -> Response:
+        # Every API call goes through the endpoint's shared rate limiter and circuit breaker. Chat is interactive by
+        # default, the other endpoints run in the batch lane, see rate_limiting.lane to override.
+        limiter = self.rate_limits[endpoint.name]
+        default = Priority.interactive if endpoint is EndpointModelMap.chat else Priority.batch
+        data_bytes = dumps_payload(data).encode()
+        limiter.before_call(priority if priority is not None else current_priority(default),
+                            self.rate_limits.acquire_timeout)
+        started = perf_counter()
+        try:
+            response: Response = self.transport.post(f"{self.endpoint_prefix}{endpoint.name}", headers=self.model_headers,
+                                                     data=data_bytes, **kwargs)
+        except requests.RequestException:
+            limiter.record_failure()
+            if self.metrics is not None:
+                self.metrics.record_call(endpoint.name, data.get("model"), 0, perf_counter() - started,
+                                         len(data_bytes), 0)
+            raise
+        except BaseException:
+            limiter.abandon()
+            raise
+        limiter.after_response(response.status_code, response.headers)
+        if self.metrics is not None:
+            # A stream's latency is the time to its first byte, its body size is unknown until it was read
+            bytes_in = int(response.headers.get("content-length") or 0) if kwargs.get("stream") \
+                else len(response.content)
+            self.metrics.record_call(endpoint.name, data.get("model"), response.status_code,
+                                     perf_counter() - started, len(data_bytes), bytes_in)
+        return response
+
+    # Waiting on 429s is up to the rate limiter, the retries only back off briefly on transient errors. An open
+    # circuit breaker raises a CircuitOpenError and other 4xx an ApiClientError, neither is retried.
+    @retry(on=is_retryable, attempts=5, wait_initial=0.5, wait_max=10, timeout=120)
+    def call_endpoint(self, endpoint: EndpointModelMap, data: dict[str, Any], model: str = None,
+                      priority: Priority = None) -> dict:
+        self.set_model(endpoint, data, model)
+        response = self.post(endpoint, data, priority)
+        self.raise_for_status(endpoint, response, data)
+        chat_reply: ChatReplay = response.json()
+        if self.metrics is not None:
+            self.metrics.record_tokens(endpoint.name, data.get("model"), chat_reply)
+        return chat_reply
+
+    @retry(on=is_retryable, attempts=5, wait_initial=0.5, wait_max=10, timeout=120)
+    def open_stream(self, endpoint: EndpointModelMap, data: dict[str, Any], model: str = None,
+                    priority: Priority = None) -> Response:
+        # Only opening the stream is retried. Once deltas were yielded to the caller a retry would repeat them.
+        self.set_model(endpoint, data, model)
+        data["stream"] = True
+        response = self.post(endpoint, data, priority, stream=True)
+        try:
+            self.raise_for_status(endpoint, response, data)
+        except Exception:
+            response.close()
+            raise
+        return response
+
+    def hedge_model(self, model: str | type(None)) -> str | type(None):
+        # The model of a hedged duplicate, the policy's fallback model if the catalog offers it for chat
+        fallback = self.hedging.fallback_model
+        if fallback and fallback not in self.available_endpoint_models[EndpointModelMap.chat.name]:
+            warn(f"The hedging fallback model {fallback} is unavailable for chat, hedging with the same model")
+            return model
+        return fallback or model
+
+    def call_chat(self, data: dict[str, Any], model: str = None) -> ChatReplay:
+        # call_endpoint for chat, hedged by self.hedging. Each attempt runs in a thread of the policy's executor (with
+        # the caller's rate limit lane and metrics conversation), so the first successful reply can be returned while
+        # the other attempt is still running. The hedge delay counts from when the primary attempt starts, not from
+        # its submission, so time queued behind a busy executor doesn't fire the hedge early. A loser already sent
+        # can't be aborted, it runs to its end and its reply is dropped. Turns using server side memory aren't hedged,
+        # a duplicate would add the turn to the server's conversation twice.
+        policy = self.hedging
+        if policy is None or "conversation_id" in data:
+            return self.call_endpoint(EndpointModelMap.chat, data, model)
+        policy.start()
+        delay = policy.delay()
+
+        primary_started = threading.Event()
+        primary_start_time: list[float] = []
+
+        def attempt(attempt_model: str | type(None), is_primary: bool = False) -> ChatReplay:
+            started = perf_counter()
+            if is_primary:
+                primary_start_time.append(started)
+                primary_started.set()
+            reply = self.call_endpoint(EndpointModelMap.chat, dict(data), attempt_model)
+            policy.observe(perf_counter() - started)
+            return reply
+
+        if delay is None:
+            return attempt(model)
+        primary = policy.executor.submit(copy_context().run, attempt, model, True)
+        primary.add_done_callback(lambda _: primary_started.set())  # Also wakes the wait below if it's cancelled
+        primary_started.wait()
+        remaining = delay - (perf_counter() - primary_start_time[0]) if primary_start_time else 0.0
+        if wait([primary], timeout=max(remaining, 0.0)).done or not policy.try_fire():
+            return primary.result()
+        hedge = policy.executor.submit(copy_context().run, attempt, self.hedge_model(model))
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    if future is hedge:
+                        policy.record_win()
+                    return future.result()
+        return primary.result()  # Both failed, raises the primary's error
 
     def chat_from_dict(self, data: dict | str, cfg: GenCfg = None, model: str = None) -> ChatReplay:
         context_data = {"message": data} if isinstance(data, str) else data
         cfg = cfg or GenCfg()
         gen_data: dict = context_data | cfg.parse()
-        return self.call_endpoint(EndpointModelMap.chat, gen_data, model)
-
-    def chat(self, msg: str, conv_hist: ConvHist | UUID = None, sys_msg: str | bool = True,
-             documents: list[Document] = None, cfg: GenCfg = None, model: str = None, search_queries_only: bool = False,
-             ) -> ChatReplay:
+        # The server's state of a conversation_id changes every turn, a cached reply would be stale
+        if self.response_cache is None or "conversation_id" in gen_data:
+            return self.call_chat(gen_data, model)
+
+        self.set_model(EndpointModelMap.chat, gen_data, model)  # The resolved model is part of the cache key
+        cache_key, reply = self.response_cache.get(gen_data)
+        if reply is not None:
+            return copy(reply)
+        reply = self.call_chat(gen_data, model)
+        if cache_key is not None:
+            self.response_cache.put(cache_key, reply)
+        return copy(reply)
+
+    def chat_stream_from_dict(self, data: dict | str, cfg: GenCfg = None, model: str = None
+                              ) -> Iterator[str | ChatReplay]:
+        # Yields the text deltas as they arrive, then the final ChatReplay (the same dict chat_from_dict returns).
+        # https://docs.cohere.com/docs/streaming
+        context_data = {"message": data} if isinstance(data, str) else data
+        cfg = cfg or GenCfg()
+        gen_data: dict = context_data | cfg.parse()
+        response = self.open_stream(EndpointModelMap.chat, gen_data, model)
+        text_parts: list[str] = []
+        final_reply: ChatReplay | type(None) = None
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line:
+                    continue
+                event: dict[str, Any] = json.loads(line)
+                event_type = event.get("event_type")
+                if event_type == "text-generation":
+                    text_parts.append(event["text"])
+                    yield event["text"]
+                elif event_type == "stream-end":
+                    final_reply = event.get("response") or {}
+                    final_reply.setdefault("finish_reason", event.get("finish_reason"))
+        if final_reply is None:
+            raise requests.ConnectionError("The chat stream ended before a stream-end event was received")
+        final_reply.setdefault("text", "".join(text_parts))
+        if self.metrics is not None:
+            self.metrics.record_tokens(EndpointModelMap.chat.name, gen_data.get("model"), final_reply)
+        yield final_reply
+
+    def build_chat_data(self, msg: str, conv_hist: ConvHist | UUID = None, sys_msg: str | bool = True,
+                        documents: list[Document] | RawJson = None, search_queries_only: bool = False
+                        ) -> dict[str, Any]:
         # https://docs.cohere.com/reference/chat
         # https://docs.cohere.com/docs/chat-api
         # https://docs.cohere.com/docs/retrieval-augmented-generation-rag
@@ -227,14 +713,14 @@ class CohereHandler:
             pass
         elif isinstance(conv_hist, UUID):
             # Cohere's API can remember the conversation if an ID is passed. To use properly the same conversation
-            # must always be sent with the same id.
+            # must always be sent with the same id. ConvManager(server_side_memory=True) manages this, including
+            # the fallback when the server lost the conversation.
             # https://docs.cohere.com/docs/chat-api#using-conversation_id-to-save-chat-history
-            # This functionality is untested.
             chat_data["conversation_id"] = str(conv_hist)
         elif isinstance(conv_hist, ConvHist):
-            parsed_conv_hist = conv_hist.parse()
-            if parsed_conv_hist:  # Add only if it's non-empty
-                chat_data["chat_history"] = parsed_conv_hist
+            # If sys_msg is True (and not a string), conv_hist.sys_msg is used as the preamble
+            parsed_conv_hist = conv_hist.parse(include_sys_msg=sys_msg is True, raw=True)
+            chat_data |= parsed_conv_hist  # Adds chat_history and preamble only if they're non-empty
         else:
             raise TypeError(f"conv_hist must be either a UUID of a ConvHist object, but got {type(conv_hist)}.")
 
@@ -248,32 +734,227 @@ class CohereHandler:
             except KeyError:
                 pass
 
-        if documents:
+        if isinstance(documents, RawJson):  # Already serialized, e.g. by DocumentStore.documents_json
+            chat_data["documents"] = documents
+        elif documents:
             chat_data["documents"] = [doc.parse() for doc in documents]
         if search_queries_only:
             chat_data["search_queries_only"] = str(search_queries_only).lower()
+        return chat_data
 
+    def chat(self, msg: str, conv_hist: ConvHist | UUID = None, sys_msg: str | bool = True,
+             documents: list[Document] | RawJson = None, cfg: GenCfg = None, model: str = None,
+             search_queries_only: bool = False,
+             ) -> ChatReplay:
+        chat_data = self.build_chat_data(msg, conv_hist, sys_msg, documents, search_queries_only)
         reply = self.chat_from_dict(chat_data, cfg, model)
         return reply
 
+    def chat_stream(self, msg: str, conv_hist: ConvHist | UUID = None, sys_msg: str | bool = True,
+                    documents: list[Document] | RawJson = None, cfg: GenCfg = None, model: str = None,
+                    ) -> Iterator[str | ChatReplay]:
+        # Same arguments as chat. Yields str text deltas, and the final ChatReplay as the last item.
+        chat_data = self.build_chat_data(msg, conv_hist, sys_msg, documents)
+        yield from self.chat_stream_from_dict(chat_data, cfg, model)
+
     def rerank(self, query: str, documents: list[str | Document], model: str = None) -> dict:
         # https://docs.cohere.com/reference/rerank
+        documents = [doc.parse() if isinstance(doc, Document) else doc for doc in documents]
         return self.call_endpoint(EndpointModelMap.rerank, {"query": query, "documents": documents}, model)
 
+    def rerank_large(self, query: str, documents: list[str | Document], top_n: int = None, model: str = None,
+                     chunk_size: int = RERANK_MAX_DOCUMENTS, max_workers: int = 4) -> dict:
+        # Reranks any number of candidates. They are sharded into chunks the endpoint accepts, the chunks are reranked
+        # concurrently, and the relevance scores (which are absolute, not relative to the chunk) are merged into a
+        # global top_n. Ties keep the input order. Returns the same {"results": [{"index", "relevance_score"}]}
+        # structure as rerank, with indices into documents.
+        # Scores are cached per (model, query, document), so candidates seen before for the query aren't rescored.
+        keys, scores, missing = self.plan_rerank(query, documents, model)
+        missing_keys = list(missing)
+        chunks = [missing_keys[i:i + chunk_size] for i in range(0, len(missing_keys), chunk_size)]
+
+        def rerank_chunk(chunk_keys: list[str]) -> dict:
+            data = {"query": query, "documents": [missing[k] for k in chunk_keys]}
+            return self.call_endpoint(EndpointModelMap.rerank, data, model)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+            for chunk_keys, reply in zip(chunks, executor.map(rerank_chunk, chunks)):
+                self.store_rerank_scores(chunk_keys, reply, scores)
+        return self.merge_rerank_scores(keys, scores, top_n)
+
+    def plan_rerank(self, query: str, documents: list[str | Document], model: str = None
+                    ) -> tuple[list[str], dict[str, float], dict[str, str | dict[str, str]]]:
+        # Returns the cache key of every document, the cached scores, and the parsed documents still to be scored
+        model_data: dict[str, Any] = {}
+        self.set_model(EndpointModelMap.rerank, model_data, model)
+        query_key = canonical_hash([model_data.get("model"), query])
+        parsed_docs = [doc.parse() if isinstance(doc, Document) else doc for doc in documents]
+        keys = [f"{query_key}|{canonical_hash(doc)}" for doc in parsed_docs]
+        scores, missing = split_cached(self.rerank_score_cache, keys, parsed_docs)
+        return keys, scores, missing
+
+    def store_rerank_scores(self, chunk_keys: list[str], reply: dict, scores: dict[str, float]):
+        for result in reply["results"]:
+            key = chunk_keys[result["index"]]
+            scores[key] = result["relevance_score"]
+            if self.rerank_score_cache is not None:
+                self.rerank_score_cache.put(key, result["relevance_score"])
+
+    @staticmethod
+    def merge_rerank_scores(keys: list[str], scores: dict[str, float], top_n: int = None) -> dict:
+        all_scores = np.array([scores[key] for key in keys], dtype=np.float64)
+        order = np.argsort(-all_scores, kind="stable")
+        if top_n is not None:
+            order = order[:top_n]
+        return {"results": [{"index": int(i), "relevance_score": float(all_scores[i])} for i in order]}
+
+    def embed(self, texts: list[str], input_type: str = "search_document", model: str = None,
+              batch_size: int = EMBED_BATCH_SIZE, max_workers: int = 4) -> np.ndarray:
+        # https://docs.cohere.com/reference/embed
+        # input_type is one of "search_document", "search_query", "classification" or "clustering".
+        # Returns a float32 matrix with a row per text, in the order of texts. Texts that are already in
+        # embedding_cache (or repeat within texts) are sent only once.
+        keys, vectors, missing = self.plan_embed(texts, input_type, model)
+        missing_keys = list(missing)
+        batches = [missing_keys[i:i + batch_size] for i in range(0, len(missing_keys), batch_size)]
+
+        def embed_batch(batch_keys: list[str]) -> np.ndarray:
+            data = self.embed_data([missing[k] for k in batch_keys], input_type)
+            return self.parse_embeddings(self.call_endpoint(EndpointModelMap.embed, data, model))
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as executor:
+            for batch_keys, batch_vectors in zip(batches, executor.map(embed_batch, batches)):
+                self.store_embeddings(batch_keys, batch_vectors, vectors)
+        return self.stack_embeddings(keys, vectors)
+
+    def plan_embed(self, texts: list[str], input_type: str, model: str = None
+                   ) -> tuple[list[str], dict[str, np.ndarray], dict[str, str]]:
+        # Returns the cache key of every text, the cached vectors, and the texts still to be embedded
+        model_data: dict[str, Any] = {}
+        self.set_model(EndpointModelMap.embed, model_data, model)
+        key_prefix = f"{model_data.get('model')}|{input_type}|"
+        keys = [hashlib.sha256((key_prefix + text).encode()).hexdigest() for text in texts]
+        vectors, missing = split_cached(self.embedding_cache, keys, texts)
+        return keys, vectors, missing
+
+    @staticmethod
+    def embed_data(texts: list[str], input_type: str) -> dict[str, Any]:
+        return {"texts": texts, "input_type": input_type, "embedding_types": ["float"]}
+
+    @staticmethod
+    def parse_embeddings(reply: dict) -> np.ndarray:
+        embeddings = reply["embeddings"]
+        if isinstance(embeddings, dict):  # Returned when embedding_types is honored
+            embeddings = embeddings["float"]
+        return np.asarray(embeddings, dtype=np.float32)
+
+    def store_embeddings(self, batch_keys: list[str], batch_vectors: np.ndarray, vectors: dict[str, np.ndarray]):
+        for key, vector in zip(batch_keys, batch_vectors):
+            vectors[key] = vector
+            if self.embedding_cache is not None:
+                self.embedding_cache.put(key, vector)
+
+    @staticmethod
+    def stack_embeddings(keys: list[str], vectors: dict[str, np.ndarray]) -> np.ndarray:
+        if not keys:
+            return np.empty((0, 0), dtype=np.float32)
+        dim = len(next(iter(vectors.values())))
+        matrix = np.empty((len(keys), dim), dtype=np.float32)
+        for row, key in enumerate(keys):
+            matrix[row] = vectors[key]
+        return matrix
+
+    @staticmethod
+    def classify_examples_json(examples: list[ClassifyExample | dict[str, str]]) -> RawJson:
+        # The few-shot examples serialized once, to be reused by every batch of a bulk run
+        parsed = [e.parse() if isinstance(e, ClassifyExample) else e for e in examples]
+        too_few = [label for label, n in Counter(e["label"] for e in parsed).items() if n < 2]
+        if too_few:
+            raise ValueError(f"The classify endpoint needs at least 2 examples of every label, got fewer for {too_few}")
+        return RawJson(json.dumps(parsed))
+
+    def classify(self, inputs: list[str], examples: list[ClassifyExample | dict[str, str]] | RawJson,
+                 model: str = None) -> list[dict]:
+        # https://docs.cohere.com/reference/classify
+        # One request of up to CLASSIFY_BATCH_SIZE inputs. Returns the classifications in the order of inputs, each
+        # with the "prediction", its "confidence" and the confidence of every label in "labels".
+        if not isinstance(examples, RawJson):
+            examples = self.classify_examples_json(examples)
+        reply = self.call_endpoint(EndpointModelMap.classify, {"inputs": inputs, "examples": examples}, model)
+        return reply["classifications"]
+
+    def classify_batches(self, inputs: Iterable[str], examples: list[ClassifyExample | dict[str, str]] | RawJson,
+                         model: str = None, batch_size: int = CLASSIFY_BATCH_SIZE, max_workers: int = 4
+                         ) -> Iterator[tuple[int, dict]]:
+        # Classifies any number of inputs. They are read lazily and packed into batches, max_workers batches run
+        # concurrently and at most twice that many are in flight. Yields (index in inputs, classification) as the
+        # batches complete, which isn't the input order.
+        if not isinstance(examples, RawJson):
+            examples = self.classify_examples_json(examples)
+        indexed_inputs = enumerate(inputs)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            in_flight: dict[Future, list[int]] = {}
+            while True:
+                batch = list(islice(indexed_inputs, batch_size))
+                if batch:
+                    indices, texts = zip(*batch)
+                    in_flight[executor.submit(self.classify, list(texts), examples, model)] = list(indices)
+                if not in_flight:
+                    return
+                if batch and len(in_flight) < 2 * max_workers:
+                    continue
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from zip(in_flight.pop(future), future.result())
+
+
+def split_cached(cache: LruTtlCache | type(None), keys: list[str], items: list) -> tuple[dict[str, Any], dict[str, Any]]:
+    # Returns (key -> cached value, key -> item not in the cache). The missing items are insertion ordered and
+    # deduplicated, so an item repeating in items is only sent once.
+    found: dict[str, Any] = {}
+    if cache is not None:
+        for key in set(keys):
+            value = cache.get(key)
+            if value is not None:
+                found[key] = value
+    missing: dict[str, Any] = {}
+    for key, item in zip(keys, items):
+        if key not in found:
+            missing.setdefault(key, item)
+    return found, missing
+
+
+SENTENCE_END = re.compile(r"[.!?…。](?=[\"')\]]*(\s|$))")
+
+
+@dataclass
+class LenControlStats:
+    replies: int = 0
+    extra_calls: int = 0
+    trimmed_locally: int = 0
+    rewritten: int = 0
+    over_limit: int = 0  # Replies returned over the limit, since the round trip or time budget ran out
+
 
 @dataclass
 class ChatLenLimiter:
+    # Keeps replies within max_chars / max_words at the lowest possible cost:
+    # 1. The limit is part of the request, as an instruction appended to the preamble and as a max_tokens cap.
+    # 2. A reply that's still too long is trimmed locally to the last complete sentence that fits.
+    # 3. Only if trimming would lose too much, the LLM rewrites it, bounded by max_attempts_to_shorten round trips and
+    #    max_seconds in total. The rewrite requests time out at the end of max_seconds, see http_transport.deadline.
+    # Every reply gets a "length_control" entry with the extra calls it cost.
     chat_callable: Callable[[str, ConvHist, str | bool, list[Document], bool, GenCfg, str], ChatReplay]
     max_chars: int = 0
     max_words: int = 0
     max_attempts_to_shorten: int = 5
     extra_shorten_multiplier: float = 0.95
+    max_seconds: float = 30.0  # Time budget for the rewrites, the first call isn't limited
+    max_tokens_headroom: float = 1.5  # max_tokens is this times the estimated tokens of the limit, 0 disables it
+    min_trim_ratio: float = 0.6  # Local trimming is accepted if it keeps at least this share of the limit
+    stats: LenControlStats = field(default_factory=LenControlStats)
 
-    def limit_chat_len(self, msg: str, *args, chat_callable: callable = None,  **kwargs):
-        chat_callable = chat_callable or self.chat_callable
-        if max(self.max_chars, self.max_words) == 0:
-            return chat_callable(*args, **kwargs)
-
+    def length_instruction(self) -> str:
         sys_msg_suffix: str = " Limit your response to "
         if self.max_chars and self.max_words:
             sys_msg_suffix += f"{self.max_chars} characters and {self.max_words} words."
@@ -281,49 +962,143 @@ class ChatLenLimiter:
             sys_msg_suffix += f"{self.max_chars} characters."
         else:
             sys_msg_suffix += f"{self.max_words} words."
-        reply = self.chat_callable(msg, *args, **kwargs)
+        return sys_msg_suffix
+
+    def limit_tokens(self, sample: str = "") -> int:
+        # The estimate_tokens of a typical text at the limits, scaled to the UTF-8 bytes per letter of sample (the
+        # user's message or the reply), so replies in scripts like Hebrew that take 2 bytes per letter aren't capped
+        # short
+        letters = "".join(sample.split())
+        bytes_per_letter = len(letters.encode("utf-8")) / len(letters) if letters else 1.0
+        typical = " ".join(islice(cycle("the quick brown fox jumps over the lazy dog".split()),
+                                  max(self.max_chars, self.max_words)))
+        limits = []
+        if self.max_chars:
+            limits.append(estimate_tokens(typical[:self.max_chars]))
+        if self.max_words:
+            limits.append(estimate_tokens(" ".join(typical.split()[:self.max_words])))
+        return int(min(limits) * bytes_per_letter * self.max_tokens_headroom)
+
+    def with_length_limit(self, chat_callable: Callable, msg: str, args: tuple, kwargs: dict
+                          ) -> inspect.BoundArguments | type(None):
+        try:
+            bound = inspect.signature(chat_callable).bind_partial(msg, *args, **kwargs)
+        except (TypeError, ValueError):
+            return None
+        params = inspect.signature(chat_callable).parameters
+        if "sys_msg" in params:
+            sys_msg = bound.arguments.get("sys_msg", params["sys_msg"].default)
+            conv_hist = bound.arguments.get("conv_hist")
+            if isinstance(sys_msg, str):
+                bound.arguments["sys_msg"] = sys_msg + self.length_instruction()
+            elif sys_msg is True and isinstance(conv_hist, ConvHist) and conv_hist.sys_msg:
+                bound.arguments["sys_msg"] = conv_hist.sys_msg + self.length_instruction()
+            else:
+                bound.arguments["sys_msg"] = self.length_instruction().strip()
+        if "cfg" in params and self.max_tokens_headroom:
+            cfg = bound.arguments.get("cfg") or GenCfg()
+            max_tokens = self.limit_tokens(msg)
+            if cfg.max_tokens is None or cfg.max_tokens > max_tokens:
+                bound.arguments["cfg"] = replace(cfg, max_tokens=max_tokens)
+        return bound
+
+    def limit_chat_len(self, msg: str, *args, chat_callable: callable = None,  **kwargs):
+        chat_callable = chat_callable or self.chat_callable
+        if max(self.max_chars, self.max_words) == 0:
+            return chat_callable(msg, *args, **kwargs)
+
+        bound = self.with_length_limit(chat_callable, msg, args, kwargs)
+        reply = chat_callable(*bound.args, **bound.kwargs) if bound else chat_callable(msg, *args, **kwargs)
         if "text" not in reply:
             # Handles the case where search_queries_only=True
             return reply
+        self.stats.replies += 1
+        started = monotonic()
         reply_txt: str = reply["text"]
+        length_control = {"extra_calls": 0, "trimmed_locally": False, "rewritten": False}
 
-        shorten_q = 1
-        num_chars, num_words, desired_over_actual_len_ratio, shorten_q = self.calc_len_and_ratio(reply_txt, shorten_q)
-        tries_counter = 0
-        shortened_reply_txt = copy(reply_txt)
-        shortest_len_ratio = copy(desired_over_actual_len_ratio)
-        while self.is_too_long(num_chars, self.max_chars) or self.is_too_long(num_words, self.max_words) \
-                and tries_counter < self.max_attempts_to_shorten:
-            msg = f"Shorten this text by {self.extra_shorten_multiplier * shorten_q:.0%} while keeping the same " \
-                  f"style and tone. Preserve as much as the content as possible while shortening it by " \
-                  f"{shorten_q:.0%}. The text to shorten:\n{reply_txt}"
-
-            cur_reply_txt = self.chat_callable(msg, *args, **kwargs)["text"]
-            num_chars, num_words, desired_over_actual_len_ratio, shorten_q = self.calc_len_and_ratio(cur_reply_txt, shorten_q)
-            if desired_over_actual_len_ratio > shortest_len_ratio:
-                shortened_reply_txt, shortest_len_ratio = copy(reply_txt), copy(desired_over_actual_len_ratio)
-            tries_counter += 1
-
-        reply["text"] = shortened_reply_txt
+        if self.fits(reply_txt):  # Whatever the finish_reason, a reply within the limits is returned as is
+            reply["length_control"] = length_control
+            return reply
+        trimmed_txt = self.trim_to_sentences(reply_txt)
+        if trimmed_txt and (self.usage(trimmed_txt) >= self.min_trim_ratio
+                            or reply.get("finish_reason") == "MAX_TOKENS"):
+            # A reply cut by max_tokens ends mid-sentence, so trimming it is always preferable to a rewrite
+            length_control["trimmed_locally"] = True
+            self.stats.trimmed_locally += 1
+            reply_txt = trimmed_txt
+
+        shortest_txt = reply_txt
+        rewrite_cfg = replace(bound.arguments.get("cfg") or GenCfg(), max_tokens=self.limit_tokens(reply_txt)) \
+            if bound and "cfg" in bound.arguments else None
+        while not self.fits(shortest_txt) \
+                and length_control["extra_calls"] < self.max_attempts_to_shorten \
+                and (remaining := self.max_seconds - (monotonic() - started)) > 0:
+            shorten_q = 1 - self.extra_shorten_multiplier / self.usage(shortest_txt)
+            rewrite_msg = f"Shorten this text by {shorten_q:.0%} while keeping the same style and tone. Preserve " \
+                          f"as much as the content as possible.{self.length_instruction()} " \
+                          f"The text to shorten:\n{shortest_txt}"
+            rewrite_kwargs = {"cfg": rewrite_cfg} if rewrite_cfg else {}
+            length_control["extra_calls"] += 1
+            try:
+                with deadline(remaining):
+                    cur_reply_txt = chat_callable(rewrite_msg, **rewrite_kwargs)["text"]
+            except DeadlineExceeded:
+                break
+            length_control["rewritten"] = True
+            if not self.fits(cur_reply_txt):
+                cur_reply_txt = self.trim_to_sentences(cur_reply_txt) or cur_reply_txt
+            if self.is_better(cur_reply_txt, shortest_txt):
+                shortest_txt = cur_reply_txt
+
+        self.stats.extra_calls += length_control["extra_calls"]
+        self.stats.rewritten += length_control["rewritten"]
+        if not self.fits(shortest_txt):
+            self.stats.over_limit += 1
+        length_control["elapsed"] = monotonic() - started
+        reply["text"] = shortest_txt
+        reply["length_control"] = length_control
         return reply
 
+    def fits(self, text: str) -> bool:
+        return not (self.is_too_long(len(text), self.max_chars) or self.is_too_long(self.count_words(text),
+                                                                                    self.max_words))
+
+    def trim_to_sentences(self, text: str) -> str:
+        # The longest prefix of whole sentences within the limits, or an empty string if the first sentence is too long
+        best = ""
+        for match in SENTENCE_END.finditer(text):
+            candidate = text[:match.end()].rstrip()
+            if not self.fits(candidate):
+                break
+            best = candidate
+        return best
+
+    def usage(self, text: str) -> float:
+        # Length over limit of the most limiting measure, up to 1 means it fits
+        usages = []
+        if self.max_chars:
+            usages.append(len(text) / self.max_chars)
+        if self.max_words:
+            usages.append(self.count_words(text) / self.max_words)
+        return max(usages)
+
+    def is_better(self, text: str, than: str) -> bool:
+        # A text that fits beats one that doesn't. Among texts that fit the longer keeps more content, among ones
+        # that don't the shorter is closer.
+        usage, than_usage = self.usage(text), self.usage(than)
+        if (usage <= 1) != (than_usage <= 1):
+            return usage <= 1
+        return usage > than_usage if usage <= 1 else usage < than_usage
+
     @staticmethod
     def count_words(text: str) -> int:
-        return len(text.replace("-", " ").split(" "))
+        return len(text.replace("-", " ").split())
 
     @staticmethod
     def is_too_long(cur_len, max_len):
         return max_len and cur_len > max_len
 
-    def calc_len_and_ratio(self, txt: str, shorten_q: float) -> tuple[int, int, float, float]:
-        num_chars, num_words = len(txt), self.count_words(txt)
-
-        char_ratio = self.max_chars / num_chars
-        word_ratio = self.max_words / num_words
-        len_ratio = min(char_ratio, word_ratio)
-        shorten_q *= 1 - len_ratio
-        return num_chars, num_words, len_ratio, shorten_q
-
 
 # @dataclass
 # class ChatLenLimiter:
@@ -389,23 +1164,206 @@ class ChatLenLimiter:
 ChatCallable = Callable[[str, ConvHist, str], str | ChatReplay]
 
 
+@dataclass
+class ServerConvState:
+    server_id: str  # The conversation_id sent to the API
+    synced: int = 0  # Messages of the local history the server has
+    active: bool = True  # False once the server lost the conversation, the history is sent in full from then on
+
+
+@dataclass
+class ServerMemoryStats:
+    turns: int = 0
+    server_turns: int = 0  # Turns sent as just the message and the conversation id
+    fallbacks: int = 0  # Conversations that went back to sending the full history
+    bytes_sent: int = 0
+    bytes_saved: int = 0  # Compared to sending the full history on every turn
+
+
 @dataclass
 class ConvManager(ConvHistoriesManager):
     # histories: ConvHistoriesManager = field(default_factory=ConvHistoriesManager)
     default_gen_cfg: GenCfg = field(default_factory=GenCfg)
     llm_handler: CohereHandler = field(default_factory=CohereHandler)
+    summary_gen_cfg: GenCfg = field(default_factory=lambda: GenCfg(temperature=0.3))
+    # With server_side_memory the API keeps the conversations (conversation_id) and the local histories are only a
+    # shadow copy: a turn sends just the new message. See server_memory_reply.
+    server_side_memory: bool = False
+    server_memory_stats: ServerMemoryStats = field(default_factory=ServerMemoryStats)
+    _server_convs: dict[UUID, ServerConvState] = field(init=False, default_factory=dict, repr=False)
+    _compacting: set[UUID] = field(init=False, default_factory=set, repr=False)
+    _compacting_lock: threading.Lock = field(init=False, default_factory=threading.Lock, repr=False)
+
+    def compact_history(self, conv_id: UUID):
+        # Folds the messages that fell out of the token budget into the conversation summary
+        conv_hist = self.histories[conv_id]
+        msgs, upto = conv_hist.msgs_to_compact()
+        if not msgs:
+            return
+        transcript = "\n".join(f"{m.parse()['role']}: {m.msg}" for m in msgs)
+        prompt = ("Update the summary of a conversation with the new messages below. Keep every fact about the user, "
+                  "their situation and feelings, and any advice given. Reply with the updated summary only.\n"
+                  f"The summary so far: {conv_hist.summary or '(empty)'}\n"
+                  f"The new messages:\n{transcript}")
+        with lane(Priority.batch), conversation(conv_id):  # Never delays a reply
+            summary = self.llm_handler.chat(prompt, sys_msg=False, cfg=self.summary_gen_cfg)["text"]
+        if upto > conv_hist.summarized_upto:
+            conv_hist.summary, conv_hist.summarized_upto = summary, upto
+
+    def compact_history_in_background(self, conv_id: UUID):
+        if not self.histories[conv_id].needs_compaction():
+            return
+        with self._compacting_lock:
+            if conv_id in self._compacting:
+                return
+            self._compacting.add(conv_id)
+
+        def compact():
+            try:
+                self.compact_history(conv_id)
+            except Exception as e:  # Until a summary succeeds the overflow is just not sent
+                warn(f"Summarizing the history of conversation {conv_id} failed: {e}")
+            finally:
+                with self._compacting_lock:
+                    self._compacting.discard(conv_id)
+
+        threading.Thread(target=compact, name=f"compact-{conv_id}", daemon=True).start()
 
     def reply_to_msg(self, conv_id: UUID, msg: str, sys_msg: str = None, func: ChatCallable = None,
-                          update_hist: bool = True, return_json: bool = False) -> str | ChatReplay:
-        func: ChatCallable = func or self.llm_handler.chat
-        # noinspection PyTypeChecker
-        bot_reply = func(msg, self.histories[conv_id], sys_msg)
+                     update_hist: bool = True, return_json: bool = False, stream: bool = False
+                     ) -> str | ChatReplay | Iterator[str | ChatReplay]:
+        # With stream=True an iterator over the text deltas is returned instead (and the final ChatReplay last, if
+        # return_json=True). The history is updated only once the stream was fully consumed.
+        if stream:
+            return self.stream_reply_to_msg(conv_id, msg, sys_msg, update_hist, return_json)
+        with conversation(conv_id):  # The call's metrics count towards the conversation, see metrics.py
+            if self.server_side_memory and func is None:
+                bot_reply = self.server_memory_reply(conv_id, msg, sys_msg, update_hist)
+            else:
+                func: ChatCallable = func or self.llm_handler.chat
+                # noinspection PyTypeChecker
+                bot_reply = func(msg, self.histories[conv_id], sys_msg)
         bot_reply_txt = bot_reply["text"]
         if update_hist:
             self.add_msg(conv_id, msg, StandardRoles.user)
-            self.add_msg(conv_id, bot_reply, StandardRoles.assistant)
+            self.add_msg(conv_id, bot_reply_txt, StandardRoles.assistant)
+            state = self._server_convs.get(conv_id)
+            if state is None or not state.active:  # Otherwise the server keeps the whole conversation itself
+                self.compact_history_in_background(conv_id)
         return bot_reply if return_json else bot_reply_txt
 
+    def server_memory_reply(self, conv_id: UUID, msg: str, sys_msg: str | bool = None, update_hist: bool = True
+                            ) -> ChatReplay:
+        # Sends only the message, the preamble and the conversation id, as long as the server has every message of
+        # the local history. Otherwise, or when the server turns out to have lost the conversation (a 404, or a
+        # chat_history in the reply missing messages), the turn is sent with the full history and the conversation
+        # stays in full history mode. Other errors are raised, the server still has the conversation. A turn that
+        # won't be added to the history (update_hist=False) is sent with the full history and no conversation id, so
+        # it isn't added to the server's conversation either. The reply gets a "server_memory" entry with the bytes
+        # sent and saved.
+        state, full_data, full_size, data = self.server_turn_data(conv_id, msg, sys_msg, update_hist)
+        if data is not None:
+            try:
+                reply = self.llm_handler.chat_from_dict(data)
+            except ConversationNotFoundError as e:
+                warn(f"The server lost conversation {conv_id}, sending the full history: {e}")
+            else:
+                if not self.server_lost_turns(conv_id, state, reply):
+                    return self.record_server_turn(state, reply, data, full_size)
+        return self.record_full_turn(state, self.llm_handler.chat_from_dict(full_data), full_size, update_hist)
+
+    def server_turn_data(self, conv_id: UUID, msg: str, sys_msg: str | bool, update_hist: bool
+                         ) -> tuple[ServerConvState, dict[str, Any], int, dict[str, Any] | type(None)]:
+        # (state, data with the full history, its size, data with the conversation id or None to send the former)
+        conv_hist = self.histories[conv_id]
+        state = self._server_convs.setdefault(conv_id, ServerConvState(str(uuid4())))
+        full_data = self.llm_handler.build_chat_data(msg, conv_hist, sys_msg)
+        self.server_memory_stats.turns += 1
+        data = None
+        if update_hist and state.active and state.synced == len(conv_hist.msgs):
+            data = {k: v for k, v in full_data.items() if k != "chat_history"} | {"conversation_id": state.server_id}
+        return state, full_data, len(dumps_payload(full_data).encode()), data
+
+    @staticmethod
+    def server_lost_turns(conv_id: UUID, state: ServerConvState, reply: ChatReplay) -> bool:
+        server_history = reply.get("chat_history")
+        if server_history is not None and len(server_history) < state.synced + 2:
+            warn(f"The server lost conversation {conv_id}, the full history is sent again")
+            return True
+        return False
+
+    def record_server_turn(self, state: ServerConvState, reply: ChatReplay, data: dict[str, Any], full_size: int
+                           ) -> ChatReplay:
+        stats = self.server_memory_stats
+        state.synced += 2  # The caller adds the message and the reply to the local history
+        size = len(dumps_payload(data).encode())
+        saved = max(full_size - size, 0)  # The conversation_id outweighs an empty history on the first turn
+        stats.server_turns += 1
+        stats.bytes_sent += size
+        stats.bytes_saved += saved
+        reply["server_memory"] = {"mode": "server", "bytes_sent": size, "bytes_saved": saved}
+        return reply
+
+    def record_full_turn(self, state: ServerConvState, reply: ChatReplay, full_size: int, update_hist: bool
+                         ) -> ChatReplay:
+        if update_hist and state.active:
+            state.active = False
+            self.server_memory_stats.fallbacks += 1
+        self.server_memory_stats.bytes_sent += full_size
+        reply["server_memory"] = {"mode": "full", "bytes_sent": full_size, "bytes_saved": 0}
+        return reply
+
+    def server_memory_stream(self, conv_id: UUID, msg: str, sys_msg: str | bool = None, update_hist: bool = True
+                             ) -> Iterator[str | ChatReplay]:
+        # server_memory_reply for streams. A 404 arrives before any text, so the full history can still be sent. A
+        # reply missing messages only shows at the end of the stream, then the next turns send the full history.
+        state, full_data, full_size, data = self.server_turn_data(conv_id, msg, sys_msg, update_hist)
+        if data is not None:
+            stream = self.llm_handler.chat_stream_from_dict(data)
+            try:
+                first = next(stream)
+            except ConversationNotFoundError as e:
+                warn(f"The server lost conversation {conv_id}, sending the full history: {e}")
+            else:
+                for item in chain([first], stream):
+                    if isinstance(item, str):
+                        yield item
+                        continue
+                    lost = self.server_lost_turns(conv_id, state, item)
+                    reply = self.record_server_turn(state, item, data, full_size)
+                    if lost:  # Too late for this reply
+                        state.active = False
+                        self.server_memory_stats.fallbacks += 1
+                    yield reply
+                return
+        for item in self.llm_handler.chat_stream_from_dict(full_data):
+            yield item if isinstance(item, str) else self.record_full_turn(state, item, full_size, update_hist)
+
+    def stream_reply_to_msg(self, conv_id: UUID, msg: str, sys_msg: str = None, update_hist: bool = True,
+                            return_json: bool = False) -> Iterator[str | ChatReplay]:
+        bot_reply: ChatReplay = {}
+        if self.server_side_memory:
+            stream = self.server_memory_stream(conv_id, msg, sys_msg, update_hist)
+        else:
+            stream = self.llm_handler.chat_stream(msg, self.histories[conv_id], sys_msg)
+        while True:
+            with conversation(conv_id):  # Only around the stream's own steps, not the consumer's code between them
+                item = next(stream, None)
+            if item is None:
+                break
+            if isinstance(item, str):
+                yield item
+            else:
+                bot_reply = item
+        if update_hist:
+            self.add_msg(conv_id, msg, StandardRoles.user)
+            self.add_msg(conv_id, bot_reply["text"], StandardRoles.assistant)
+            state = self._server_convs.get(conv_id)
+            if state is None or not state.active:  # See reply_to_msg
+                self.compact_history_in_background(conv_id)
+        if return_json:
+            yield bot_reply
+
 
 if __name__ == "__main__":
     llm_handler = CohereHandler()
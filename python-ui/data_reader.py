@@ -1,43 +1,25 @@
 import os
+import sys
 from dotenv import load_dotenv
-import redis
-import csv
 import json
 
+from redis_store import USER_KEY_PREFIX, redis_from_env
+
 # Specify the path to your .env file (one folder up)
 dotenv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.env')
 
 # Load environment variables from .env file
 load_dotenv(dotenv_path)
 
-# Get Redis connection details from environment variables
-redis_host = os.getenv('REDISHOST', '127.0.0.1')  # Default to localhost for local connection
-redis_port = os.getenv('REDISPORT', 6379)  # Default port for Redis
-
-# Connect to the Redis server
-r = redis.Redis(host=redis_host, port=int(redis_port), db=0)
+# Connect to the Redis server (REDISHOST and REDISPORT, defaults to a local Redis)
+r = redis_from_env()
 
-key = "user:325270109"
-item = r.get(key)
-decoded = json.loads(item.decode('utf-8'))
+# Prints the profile of the user id given as the first argument
+user_id = sys.argv[1] if len(sys.argv) > 1 else "325270109"
+item = r.get(f"{USER_KEY_PREFIX}{user_id}")
+decoded = json.loads(item.decode('utf-8')) if item else None
 print(decoded)
-# Specify the key of the list you want to read
-# list_key = "messages:493839176"
-
-# # Get the entire list
-# my_list = r.lrange(list_key, 0, -1)
-
-# # Convert bytes to string and then to JSON
-# my_list = [json.loads(item.decode('utf-8')) for item in my_list]
-
-# Define the CSV file path
-# csv_file_path = 'exported_list.csv'
-
-# # Write the list to a CSV file
-# with open(csv_file_path, mode='w', newline='', encoding='utf-8') as file:
-#     writer = csv.DictWriter(file, fieldnames=["id", "userId", "role", "timestamp", "message"])
-#     writer.writeheader()
-#     for item in my_list:
-#         writer.writerow(item)
 
-# print(f"List contents have been exported to {csv_file_path}")
+# To export the message histories (messages:<userId> lists) to CSV / JSONL use exporter.py, which pages through the
+# lists instead of loading whole histories into memory:
+# python exporter.py --out export --workers 4
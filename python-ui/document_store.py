@@ -0,0 +1,101 @@
+import json
+import threading
+from dataclasses import dataclass, field
+from typing import Iterable
+
+from caching import canonical_hash
+from cohere_tools import CohereHandler, Document, RawJson, estimate_tokens
+
+
+@dataclass(frozen=True)
+class StoredDocument:
+    doc_id: str
+    document: Document
+    json: RawJson  # The document as sent to the chat endpoint, with its id for the citations
+    tokens: int  # Estimate of the serialized form
+
+
+@dataclass
+class DocumentStore:
+    # Keeps every document once, under an id derived from its content, together with its serialized JSON and token
+    # estimate. A retrieval-augmented turn then packs the most relevant documents into a token budget and sends them
+    # as one RawJson, so nothing is serialized again:
+    #   doc_ids = store.add_many(docs)
+    #   packed = store.pack_reranked(handler, query, doc_ids, budget_tokens=2000)
+    #   handler.chat(query, conv_hist, documents=store.documents_json(packed))
+    max_doc_tokens: int = 0  # Longer document texts are cut at a word boundary when added, 0 keeps them whole
+    _docs: dict[str, StoredDocument] = field(init=False, default_factory=dict, repr=False)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock, repr=False)
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._docs
+
+    def __getitem__(self, doc_id: str) -> StoredDocument:
+        return self._docs[doc_id]
+
+    def truncate(self, document: Document) -> Document:
+        max_bytes = self.max_doc_tokens * 4  # The inverse of estimate_tokens
+        encoded = document.text.encode()
+        if not self.max_doc_tokens or len(encoded) <= max_bytes:
+            return document
+        text = encoded[:max_bytes].decode(errors="ignore")
+        return Document(text.rsplit(maxsplit=1)[0] if " " in text else text, document.title, document.author,
+                        document.date)
+
+    def add(self, document: Document | str) -> str:
+        # Returns the document's id. Adding a document again, or a copy of it, returns the same id.
+        document = self.truncate(Document(document) if isinstance(document, str) else document)
+        parsed = document.parse()
+        doc_id = canonical_hash(parsed)[:16]
+        if doc_id in self._docs:
+            return doc_id
+        doc_json = RawJson(json.dumps({"id": doc_id} | parsed, ensure_ascii=False))
+        stored = StoredDocument(doc_id, document, doc_json, estimate_tokens(doc_json))
+        with self._lock:
+            self._docs.setdefault(doc_id, stored)
+        return doc_id
+
+    def add_many(self, documents: Iterable[Document | str]) -> list[str]:
+        return [self.add(document) for document in documents]
+
+    def discard(self, doc_id: str):
+        with self._lock:
+            self._docs.pop(doc_id, None)
+
+    def documents_json(self, doc_ids: Iterable[str]) -> RawJson:
+        # The documents parameter of CohereHandler.chat, joined from the cached JSON of each document
+        return RawJson("[" + ", ".join(self._docs[doc_id].json for doc_id in doc_ids) + "]")
+
+    def tokens(self, doc_ids: Iterable[str]) -> int:
+        return sum(self._docs[doc_id].tokens for doc_id in doc_ids)
+
+    def pack(self, scored: Iterable[tuple[str, float]], budget_tokens: int, min_score: float = 0.0,
+             max_docs: int = 0) -> list[str]:
+        # Greedily picks the highest scoring documents that still fit the budget. A document too large for what's
+        # left is skipped, so a smaller but less relevant one can still use the space. Duplicate ids count once.
+        # Returns the picked ids, best first.
+        packed: list[str] = []
+        seen: set[str] = set()
+        left = budget_tokens
+        for doc_id, score in sorted(scored, key=lambda pair: -pair[1]):
+            if score < min_score or (max_docs and len(packed) >= max_docs):
+                break
+            if doc_id in seen:
+                continue
+            seen.add(doc_id)
+            tokens = self._docs[doc_id].tokens
+            if tokens <= left:
+                packed.append(doc_id)
+                left -= tokens
+        return packed
+
+    def pack_reranked(self, llm_handler: CohereHandler, query: str, doc_ids: list[str], budget_tokens: int,
+                      min_score: float = 0.0, max_docs: int = 0, model: str = None) -> list[str]:
+        # Scores the candidates with the rerank endpoint (relevance scores are cached by the handler) and packs them
+        doc_ids = list(dict.fromkeys(doc_ids))
+        reply = llm_handler.rerank_large(query, [self._docs[doc_id].document for doc_id in doc_ids], model=model)
+        return self.pack(((doc_ids[r["index"]], r["relevance_score"]) for r in reply["results"]), budget_tokens,
+                         min_score, max_docs)
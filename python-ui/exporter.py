@@ -0,0 +1,226 @@
+import argparse
+import csv
+import json
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, asdict, field
+from pathlib import Path
+from typing import Iterator
+
+import redis
+from dotenv import load_dotenv
+
+from redis_store import MESSAGES_KEY_PREFIX, USER_KEY_PREFIX, redis_from_env
+
+MESSAGE_FIELDS: list[str] = ["id", "userId", "role", "timestamp", "message"]
+
+
+@dataclass
+class ExportCfg:
+    out_dir: Path
+    formats: tuple[str, ...] = ("csv", "jsonl")
+    scan_count: int = 1000  # COUNT hint of every SCAN call
+    page_size: int = 1000  # Messages per LRANGE, a list is never held whole, only one page of it at a time
+    keys_per_pipeline: int = 50  # Lists read in one pipelined round trip
+    workers: int = 1  # Threads reading the lists in parallel, all fed by a single SCAN
+    profiles: bool = True  # Also export the user:<userId> profiles to profiles.jsonl
+    resume: bool = True  # Continue from the checkpoints of a previous, interrupted run
+
+
+@dataclass
+class Checkpoint:
+    # Saved after every SCAN batch is fully written, so a resumed run restarts from the last consistent state:
+    # the output files are truncated to the saved sizes and the scan continues from the saved cursor.
+    cursor: int = 0
+    done: bool = False
+    keys: int = 0
+    rows: int = 0
+    file_sizes: dict[str, int] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, path: Path) -> "Checkpoint":
+        return cls(**json.loads(path.read_text(encoding="utf-8"))) if path.exists() else cls()
+
+    def save(self, path: Path):
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(asdict(self)), encoding="utf-8")
+        tmp_path.replace(path)
+
+
+def scan_batches(r: redis.Redis, match: str, cursor: int, count: int) -> Iterator[tuple[int, list[bytes]]]:
+    # SCAN never blocks the server like KEYS does. A key may be returned more than once, even by different batches,
+    # it's only deduplicated within a batch here.
+    while True:
+        cursor, keys = r.scan(cursor=cursor, match=match, count=count)
+        yield cursor, list(dict.fromkeys(keys))
+        if cursor == 0:
+            return
+
+
+def iter_list_pages(r: redis.Redis, keys: list[bytes], page_size: int, start: dict[bytes, int] = None
+                    ) -> Iterator[tuple[bytes, list[bytes]]]:
+    # Pages through many lists at once, one pipelined round trip per page of every list that still has items.
+    # start optionally maps keys to the index to start reading them from.
+    start = start or {}
+    offsets = {key: start.get(key, 0) for key in keys}
+    while offsets:
+        pipe = r.pipeline(transaction=False)
+        active = list(offsets)
+        for key in active:
+            pipe.lrange(key, offsets[key], offsets[key] + page_size - 1)
+        for key, page in zip(active, pipe.execute()):
+            if page:
+                yield key, page
+            if len(page) < page_size:
+                del offsets[key]
+            else:
+                offsets[key] += page_size
+
+
+class ExportWriters:
+    def __init__(self, out_dir: Path, formats: tuple[str, ...], checkpoint: Checkpoint):
+        self.files = {}
+        self.csv_writer = None
+        for fmt in formats:
+            path = out_dir / f"messages.{fmt}"
+            size = checkpoint.file_sizes.get(path.name, 0)
+            f = open(path, "a+", encoding="utf-8", newline="")
+            f.truncate(size)  # Drops whatever was written after the last checkpoint
+            f.seek(size)
+            self.files[path.name] = f
+            if fmt == "csv":
+                self.csv_writer = csv.DictWriter(f, fieldnames=MESSAGE_FIELDS, extrasaction="ignore")
+                if size == 0:
+                    self.csv_writer.writeheader()
+        self.jsonl = next((f for name, f in self.files.items() if name.endswith(".jsonl")), None)
+
+    def write(self, raw_record: bytes):
+        record_str = raw_record.decode("utf-8")
+        if self.jsonl is not None:
+            self.jsonl.write(record_str + "\n")
+        if self.csv_writer is not None:
+            self.csv_writer.writerow(json.loads(record_str))
+
+    def sizes(self) -> dict[str, int]:
+        sizes = {}
+        for name, f in self.files.items():
+            f.flush()
+            os.fsync(f.fileno())
+            sizes[name] = f.tell()
+        return sizes
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+def put_unless_stopped(pages: queue.Queue, item: list[bytes] | type(None), stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def read_lists(r: redis.Redis, keys: list[bytes], page_size: int, pages: queue.Queue, stop: threading.Event):
+    # Hands the pages to the writer as they're read, the queue is bounded so a slow writer holds back the reads.
+    # None ends the group, also when reading it failed (the future then raises). Once stop is set nobody reads the
+    # queue anymore, the reader just returns.
+    try:
+        for _, page in iter_list_pages(r, keys, page_size):
+            if not put_unless_stopped(pages, page, stop):
+                return
+    finally:
+        put_unless_stopped(pages, None, stop)
+
+
+def export_messages(cfg: ExportCfg) -> Checkpoint:
+    # One SCAN hands out keys_per_pipeline lists at a time to the worker threads. Their pages are written by this
+    # thread as they come, in the order the lists were handed out. Each of the at most 2 * workers groups in flight
+    # holds up to keys_per_pipeline pages, so memory doesn't grow with the histories. A key SCAN returns again in a
+    # later batch of the run is skipped. The checkpoint is saved once every list of a SCAN batch was written.
+    checkpoint_path = cfg.out_dir / "checkpoint.json"
+    checkpoint = Checkpoint.load(checkpoint_path) if cfg.resume else Checkpoint()
+    if checkpoint.done:
+        return checkpoint
+    r = redis_from_env()
+    writers = ExportWriters(cfg.out_dir, cfg.formats, checkpoint)
+    # (reader, its pages, keys, cursor if a batch's last)
+    in_flight: deque[tuple[Future, queue.Queue, int, int | type(None)]] = deque()
+    exported: set[bytes] = set()
+    stop = threading.Event()
+
+    def write_done(max_in_flight: int):
+        while len(in_flight) > max_in_flight:
+            reader, pages, keys, cursor = in_flight.popleft()
+            while (page := pages.get()) is not None:
+                for raw_record in page:
+                    writers.write(raw_record)
+                checkpoint.rows += len(page)
+            reader.result()
+            checkpoint.keys += keys
+            if cursor is not None:
+                checkpoint.cursor, checkpoint.done = cursor, cursor == 0
+                checkpoint.file_sizes = writers.sizes()
+                checkpoint.save(checkpoint_path)
+
+    try:
+        with ThreadPoolExecutor(max_workers=cfg.workers) as executor:
+            try:
+                for cursor, keys in scan_batches(r, f"{MESSAGES_KEY_PREFIX}*", checkpoint.cursor, cfg.scan_count):
+                    keys = [key for key in keys if key not in exported]
+                    exported.update(keys)
+                    groups = [keys[i:i + cfg.keys_per_pipeline] for i in range(0, len(keys), cfg.keys_per_pipeline)]
+                    for i, group in enumerate(groups or [[]]):
+                        pages = queue.Queue(maxsize=cfg.keys_per_pipeline)
+                        in_flight.append((executor.submit(read_lists, r, group, cfg.page_size, pages, stop), pages,
+                                          len(group), cursor if i == max(len(groups) - 1, 0) else None))
+                        write_done(2 * cfg.workers)
+                write_done(0)
+            finally:
+                stop.set()  # The readers still running or queued give up if the export failed
+    finally:
+        writers.close()
+    return checkpoint
+
+
+def export_profiles(cfg: ExportCfg):
+    r = redis_from_env()
+    with open(cfg.out_dir / "profiles.jsonl", "w", encoding="utf-8") as f:
+        for _, keys in scan_batches(r, f"{USER_KEY_PREFIX}*", 0, cfg.scan_count):
+            pipe = r.pipeline(transaction=False)
+            for key in keys:
+                pipe.get(key)
+            for profile in pipe.execute():
+                if profile:
+                    f.write(profile.decode("utf-8") + "\n")
+
+
+def export(cfg: ExportCfg) -> Checkpoint:
+    cfg.out_dir.mkdir(parents=True, exist_ok=True)
+    checkpoint = export_messages(cfg)
+    if cfg.profiles:
+        export_profiles(cfg)
+    return checkpoint
+
+
+if __name__ == "__main__":
+    # Same .env as data_reader.py, one folder up
+    load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.env'))
+    parser = argparse.ArgumentParser(description="Export all the bot's message histories from Redis.")
+    parser.add_argument("--out", type=Path, default=Path("export"))
+    parser.add_argument("--formats", nargs="+", choices=["csv", "jsonl"], default=["csv", "jsonl"])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--no-profiles", action="store_true")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoints of a previous run")
+    args = parser.parse_args()
+    export_cfg = ExportCfg(args.out, tuple(args.formats), page_size=args.page_size, workers=args.workers,
+                           profiles=not args.no_profiles, resume=not args.restart)
+    result = export(export_cfg)
+    print(f"Exported {result.rows} messages of {result.keys} users to {args.out}")
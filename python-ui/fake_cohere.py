@@ -0,0 +1,320 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import random
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from typing import Any, Iterator
+
+import numpy as np
+import requests
+
+# A local stand-in for the Cohere v1 endpoints the client uses, for benchmarks and offline development:
+#   python fake_cohere.py --port 8080 --latency 0.3 --throttle-rate 0.02
+#   CohereEndpointPrefix=http://127.0.0.1:8080/v1/ python gui.py
+# Replies are deterministic for a request (seeded by its content), latency and failures are random.
+
+WORDS: list[str] = ("breathe slowly and notice the feeling without judging it let the thought pass like a cloud you "
+                    "are more than this moment kindness towards yourself is the first step of the path").split()
+
+
+@dataclass
+class FakeCohereCfg:
+    latency: float = 0.05  # Mean seconds before the response headers
+    latency_jitter: float = 0.5  # Latency varies uniformly by this share of it
+    slow_rate: float = 0.0  # Share of calls that take slow_latency instead, a long tail like slow generations
+    slow_latency: float = 2.0
+    stream_delay: float = 0.005  # Seconds between streamed text-generation events
+    error_rate: float = 0.0  # Share of calls answered with a 503
+    throttle_rate: float = 0.0  # Share of calls answered with a 429
+    retry_after: float = 1.0  # Retry-After of the 429s
+    forget_rate: float = 0.0  # Share of conversation_id turns for which the server first loses the conversation
+    forget_status: int = 0  # If set, a lost conversation is answered with this status (e.g. 404) rather than restarted
+    reply_words: int = 60  # Words of a chat reply, unless cut by max_tokens
+    embedding_dim: int = 384
+    models: dict[str, list[str]] = field(default_factory=lambda: {
+        "chat": ["command-r-plus", "command-r", "c4ai-aya-23"],
+        "embed": ["embed-multilingual-light-v3.0", "embed-multilingual-v3.0"],
+        "classify": ["embed-multilingual-light-v3.0"],
+        "rerank": ["rerank-multilingual-v3.0"],
+    })
+    seed: int = 0
+
+
+def content_seed(*parts: Any) -> int:
+    return int.from_bytes(hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).digest()[:8], "big")
+
+
+def count_tokens(text: str) -> int:
+    return len(text.split()) * 4 // 3 + 1
+
+
+class FakeCohereHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real API
+    server: "FakeCohereServer"
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, obj: Any, status: int = 200, headers: dict[str, str] = None):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def endpoint(self) -> str:
+        return self.path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+
+    def simulate_network(self) -> bool:
+        # Sleeps the latency, then answers with an error instead of the endpoint's reply as often as configured
+        cfg = self.server.cfg
+        rng = self.server.rng()
+        latency = cfg.slow_latency if rng.random() < cfg.slow_rate else cfg.latency
+        sleep(max(0.0, latency * (1 + cfg.latency_jitter * (2 * rng.random() - 1))))
+        roll = rng.random()
+        if roll < cfg.throttle_rate:
+            self.server.count("429")
+            self.send_json({"message": "You are using a Trial key, which is limited"}, 429,
+                           {"Retry-After": f"{cfg.retry_after:g}"})
+            return False
+        if roll < cfg.throttle_rate + cfg.error_rate:
+            self.server.count("503")
+            self.send_json({"message": "Service unavailable"}, 503)
+            return False
+        return True
+
+    def do_GET(self):
+        if self.endpoint() == "_stats":  # Not a Cohere endpoint, the calls served so far
+            return self.send_json(self.server.stats())
+        self.server.count(self.endpoint())
+        if self.endpoint() == "models":
+            models: dict[str, list[str]] = {}
+            for endpoint, names in self.server.cfg.models.items():
+                for name in names:
+                    models.setdefault(name, []).append(endpoint)
+            return self.send_json({"models": [{"name": name, "endpoints": endpoints}
+                                              for name, endpoints in models.items()]})
+        self.send_json({"message": "Not found"}, 404)
+
+    def do_POST(self):
+        endpoint = self.endpoint()
+        self.server.count(endpoint)
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body: dict = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self.send_json({"message": "invalid request: body is not valid JSON"}, 400)
+        if endpoint == "check-api-key":
+            return self.send_json({"valid": True, "organization_id": "fake", "owner_id": "fake"})
+        handler = getattr(self, f"post_{endpoint.replace('-', '_')}", None)
+        if handler is None:
+            return self.send_json({"message": f"Unknown endpoint {endpoint}"}, 404)
+        if self.simulate_network():
+            handler(body)
+
+    def reply_text(self, body: dict, history: list[dict]) -> tuple[str, str]:
+        # A deterministic reply to the request, capped by max_tokens like the real API
+        words = self.server.cfg.reply_words
+        finish_reason = "COMPLETE"
+        if body.get("max_tokens") and count_tokens(" ".join(["w"] * words)) > body["max_tokens"]:
+            words, finish_reason = max(1, body["max_tokens"] * 3 // 4), "MAX_TOKENS"
+        rng = random.Random(content_seed(body.get("message"), history, body.get("preamble")))
+        sentences, sentence = [], []
+        for _ in range(words):
+            sentence.append(rng.choice(WORDS))
+            if len(sentence) >= rng.randint(6, 14):
+                sentences.append(" ".join(sentence).capitalize() + ".")
+                sentence = []
+        if sentence:  # A reply cut by max_tokens ends mid-sentence
+            sentences.append(" ".join(sentence).capitalize() + ("." if finish_reason == "COMPLETE" else ""))
+        return " ".join(sentences), finish_reason
+
+    def post_chat(self, body: dict):
+        conversation_id = body.get("conversation_id")
+        if conversation_id and body.get("chat_history"):
+            return self.send_json({"message": "invalid request: cannot specify both chat_history and "
+                                              "conversation_id"}, 400)
+        history = body.get("chat_history") or []
+        if conversation_id:  # The server keeps the history of the conversation
+            if self.server.rng().random() < self.server.cfg.forget_rate:
+                self.server.conversations.pop(conversation_id, None)
+                if self.server.cfg.forget_status:
+                    return self.send_json({"message": f"conversation {conversation_id} not found"},
+                                          self.server.cfg.forget_status)
+            history = self.server.conversations.get(conversation_id, [])
+        text, finish_reason = self.reply_text(body, history)
+        full_history = history + [{"role": "USER", "message": body.get("message") or ""},
+                                  {"role": "CHATBOT", "message": text}]
+        if conversation_id:
+            self.server.conversations[conversation_id] = full_history
+        input_text = " ".join([body.get("message") or "", body.get("preamble") or ""]
+                              + [m.get("message", "") for m in history])
+        reply = {"response_id": f"{content_seed(body):x}", "text": text, "generation_id": f"{content_seed(text):x}",
+                 "finish_reason": finish_reason, "chat_history": full_history,
+                 "meta": {"billed_units": {"input_tokens": count_tokens(input_text),
+                                           "output_tokens": count_tokens(text)}}}
+        if not body.get("stream"):
+            return self.send_json(reply)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/stream+json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        events = [{"event_type": "stream-start", "generation_id": reply["generation_id"]}]
+        events += [{"event_type": "text-generation", "text": (" " if i else "") + word}
+                   for i, word in enumerate(text.split(" "))]
+        events.append({"event_type": "stream-end", "finish_reason": finish_reason, "response": reply})
+        for event in events:
+            chunk = (json.dumps(event) + "\n").encode()
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.flush()
+            if event["event_type"] == "text-generation":
+                sleep(self.server.cfg.stream_delay)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def post_rerank(self, body: dict):
+        query_words = set(str(body.get("query", "")).lower().split())
+        results = []
+        for i, doc in enumerate(body.get("documents") or []):
+            text = doc if isinstance(doc, str) else " ".join(str(v) for v in doc.values())
+            doc_words = set(text.lower().split())
+            overlap = len(query_words & doc_words) / (len(query_words) or 1)
+            results.append({"index": i, "relevance_score": round(overlap, 6)})
+        results.sort(key=lambda r: -r["relevance_score"])
+        if body.get("top_n"):
+            results = results[:body["top_n"]]
+        self.send_json({"id": f"{content_seed(body):x}", "results": results,
+                        "meta": {"billed_units": {"search_units": 1}}})
+
+    def post_embed(self, body: dict):
+        texts = body.get("texts") or []
+        vectors = np.empty((len(texts), self.server.cfg.embedding_dim), dtype=np.float32)
+        for row, text in enumerate(texts):  # Unit vectors seeded by the text, so equal texts embed equally
+            vector = np.random.default_rng(content_seed(text)).standard_normal(vectors.shape[1], dtype=np.float32)
+            vectors[row] = vector / np.linalg.norm(vector)
+        embeddings = vectors.round(5).tolist()
+        self.send_json({"id": f"{content_seed(body):x}", "texts": texts,
+                        "embeddings": {"float": embeddings} if body.get("embedding_types") else embeddings,
+                        "meta": {"billed_units": {"input_tokens": sum(count_tokens(t) for t in texts)}}})
+
+    def post_classify(self, body: dict):
+        # Scores every label by the word overlap of the input with the label's examples
+        examples = body.get("examples") or []
+        labels = sorted({e["label"] for e in examples})
+        label_words = {label: set(" ".join(e["text"] for e in examples if e["label"] == label).lower().split())
+                       for label in labels}
+        classifications = []
+        for text in body.get("inputs") or []:
+            words = set(text.lower().split())
+            scores = np.array([len(words & label_words[label]) + 0.1 for label in labels])
+            confidences = scores / scores.sum()
+            best = int(confidences.argmax())
+            classifications.append({"id": f"{content_seed(text):x}", "input": text, "prediction": labels[best],
+                                    "confidence": round(float(confidences[best]), 6),
+                                    "labels": {label: {"confidence": round(float(c), 6)}
+                                               for label, c in zip(labels, confidences)},
+                                    "classification_type": "single-label"})
+        self.send_json({"id": f"{content_seed(body):x}", "classifications": classifications,
+                        "meta": {"billed_units": {"classifications": len(classifications)}}})
+
+
+class FakeCohereServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, cfg: FakeCohereCfg, host: str = "127.0.0.1", port: int = 0):
+        self.cfg = cfg
+        self.requests: Counter = Counter()  # endpoint (or "429" / "503") -> calls
+        self.conversations: dict[str, list[dict]] = {}  # conversation_id -> chat_history
+        self._lock = threading.Lock()
+        self._rng = random.Random(cfg.seed)
+        super().__init__((host, port), FakeCohereHandler)
+
+    @property
+    def url(self) -> str:
+        # The endpoint prefix to give CohereHandler
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/"
+
+    def rng(self) -> random.Random:
+        with self._lock:
+            return random.Random(self._rng.random())
+
+    def count(self, key: str):
+        with self._lock:
+            self.requests[key] += 1
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self.requests)
+
+    def handle_error(self, request, client_address):
+        # Clients closing their keep-alive connections isn't worth a traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self) -> "FakeCohereServer":
+        threading.Thread(target=self.serve_forever, name="fake-cohere", daemon=True).start()
+        return self
+
+    def __enter__(self) -> "FakeCohereServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+def _serve(cfg: FakeCohereCfg, host: str, port: int, urls: multiprocessing.Queue):
+    with FakeCohereServer(cfg, host, port) as server:
+        urls.put(server.url)
+        threading.Event().wait()
+
+
+@contextmanager
+def fake_cohere_process(cfg: FakeCohereCfg = None, host: str = "127.0.0.1", port: int = 0) -> Iterator[str]:
+    # Serves the stand-in from a child process, so it doesn't compete with the code under test for the GIL.
+    # Yields its URL, the endpoint prefix to give CohereHandler.
+    urls = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(cfg or FakeCohereCfg(), host, port, urls),
+                                      name="fake-cohere", daemon=True)
+    process.start()
+    try:
+        yield urls.get(timeout=30)
+    finally:
+        process.terminate()
+        process.join()
+
+
+def fetch_stats(url: str) -> Counter:
+    return Counter(requests.get(f"{url}_stats", timeout=5).json())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a local stand-in of the Cohere API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean seconds per call")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Share of calls taking --slow-latency")
+    parser.add_argument("--slow-latency", type=float, default=2.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--reply-words", type=int, default=60)
+    args = parser.parse_args()
+    server_cfg = FakeCohereCfg(latency=args.latency, slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+                               error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                               reply_words=args.reply_words)
+    with FakeCohereServer(server_cfg, args.host, args.port) as server:
+        print(f"Serving the Cohere stand-in on {server.url}, stop with Ctrl+C")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
@@ -1,10 +1,14 @@
 from tkinter import *
+from tkinter import filedialog
+import queue
 import time
-import pyttsx3
 from bot import chat
-import threading
+from chat_executor import ChatExecutor, ChatResult
+from speech_worker import SpeechWorker
+from transcript import Transcript, new_session_log
 
 window_size = "600x600"
+results_poll_interval_ms = 50
 
 
 class ChatInterface(Frame):
@@ -26,7 +30,7 @@ class ChatInterface(Frame):
         # File
         file = Menu(menu, tearoff=0)
         menu.add_cascade(label="File", menu=file)
-        # file.add_command(label="Save Chat Log", command=self.save_chat)
+        file.add_command(label="Save Chat Log", command=self.save_chat)
         file.add_command(label="Clear Chat", command=self.clear_chat)
         #  file.add_separator()
         file.add_command(label="Exit", command=self.chatexit)
@@ -68,12 +72,17 @@ class ChatInterface(Frame):
         self.text_box_scrollbar.pack(fill=Y, side=RIGHT)
 
         # contains messages
-        self.text_box = Text(self.text_frame, yscrollcommand=self.text_box_scrollbar.set, state=DISABLED,
+        self.text_box = Text(self.text_frame, yscrollcommand=self.on_text_scroll, state=DISABLED,
                              bd=1, padx=6, pady=6, spacing3=8, wrap=WORD, bg=None, font="Verdana 10", relief=GROOVE,
                              width=10, height=1)
         self.text_box.pack(expand=True, fill=BOTH)
         self.text_box_scrollbar.config(command=self.text_box.yview)
 
+        # The widget only holds the latest messages, older ones are loaded back on scroll-up. The session is logged
+        # to chat_logs/ in the background.
+        self.transcript = Transcript(log=new_session_log())
+        self.loading_older = False
+
         # frame containing user entry field
         self.entry_frame = Frame(self.master, bd=1)
         self.entry_frame.pack(side=LEFT, fill=BOTH, expand=True)
@@ -94,24 +103,29 @@ class ChatInterface(Frame):
         self.send_button.pack(side=LEFT, ipady=8)
         self.master.bind("<Return>", self.send_message_insert)
 
+        # stop button, drops the reply of the in-flight message
+        self.stop_button = Button(self.send_button_frame, text="Stop", width=5, relief=GROOVE, bg='white',
+                                  bd=1, command=lambda: self.cancel_message(None), activebackground="#FFFFFF",
+                                  activeforeground="#000000")
+        self.stop_button.pack(side=LEFT, ipady=8)
+        self.master.bind("<Escape>", self.cancel_message)
+
+        # typing indicator
+        self.typing_label = Label(self.text_frame, font="Verdana 8 italic", text="", anchor=W)
+        self.typing_label.pack(fill=X, side=BOTTOM)
+
         self.last_sent_label(date="No messages sent.")
+
+        # The LLM calls run on a worker thread, the replies are collected here on the Tk main thread
+        self.executor = ChatExecutor(chat)
+        self.speech = SpeechWorker()
+        self.after(results_poll_interval_ms, self.poll_results)
         #t2 = threading.Thread(target=self.send_message_insert(name='t1'))
         #t2.start()
 
     def playResponce(self, responce):
-        x = pyttsx3.init()
-        print(responce)
-        li = []
-        if len(responce) > 100:
-            if responce.find('--') == -1:
-                b = responce.split('--')
-                print(b)
-
-        x.setProperty('rate', 200)
-        x.setProperty('volume', 100)
-        x.say(responce)
-        x.runAndWait()
-        print("Played Successfully......")
+        # Interrupts whatever is still being read out, speech starts once the first sentence is synthesized
+        self.speech.speak(responce)
 
     def last_sent_label(self, date):
 
@@ -129,32 +143,89 @@ class ChatInterface(Frame):
         self.text_box.delete(1.0, END)
         self.text_box.delete(1.0, END)
         self.text_box.config(state=DISABLED)
+        self.transcript.clear()
+
+    def save_chat(self):
+        path = filedialog.asksaveasfilename(defaultextension=".txt", filetypes=[("Text files", "*.txt")],
+                                            title="Save Chat Log")
+        if path:
+            self.transcript.save_in_background(path)
 
     def chatexit(self):
+        self.executor.shutdown()
+        self.speech.shutdown()
+        self.transcript.close()
         exit()
 
-    def send_message_insert(self, message):
-        user_input = self.entry_field.get()
-        pr1 = "Human : " + user_input + "\n"
+    def insert_text(self, text):
+        self.transcript.append(text)
         self.text_box.configure(state=NORMAL)
-        self.text_box.insert(END, pr1)
+        self.text_box.insert(END, text)
+        trimmed_lines = self.transcript.trim()
+        if trimmed_lines:
+            self.text_box.delete("1.0", f"{trimmed_lines + 1}.0")
         self.text_box.configure(state=DISABLED)
         self.text_box.see(END)
-        #t1 = threading.Thread(target=self.playResponce, args=(user_input,))
-        #t1.start()
-        #time.sleep(1)
-        ob = chat(user_input)
-        pr = "ROGA: " + ob + "\n"
+
+    def on_text_scroll(self, first, last):
+        self.text_box_scrollbar.set(first, last)
+        # The widget can't be changed from its own scroll callback, the older messages are loaded when idle
+        if float(first) <= 0.0 and self.transcript.has_older and not self.loading_older:
+            self.loading_older = True
+            self.after_idle(self.load_older_messages)
+
+    def load_older_messages(self):
+        self.loading_older = False
+        text = self.transcript.load_older()
+        if not text:
+            return
         self.text_box.configure(state=NORMAL)
-        self.text_box.insert(END, pr)
+        self.text_box.insert("1.0", text)
         self.text_box.configure(state=DISABLED)
-        self.text_box.see(END)
-        self.last_sent_label(str(time.strftime("Last message sent: " + '%B %d, %Y' + ' at ' + '%I:%M %p')))
+        self.text_box.yview(f"{text.count(chr(10)) + 1}.0")  # Keeps the line that was at the top in place
+
+    def send_message_insert(self, message):
+        user_input = self.entry_field.get()
+        if not user_input.strip():
+            return
+        self.insert_text("Human : " + user_input + "\n")
         self.entry_field.delete(0, END)
-        time.sleep(0)
-        t2 = threading.Thread(target=self.playResponce, args=(ob,))
-        t2.start()
-        #return ob
+        self.speech.cancel()  # Barge-in, the user doesn't need the rest of the previous reply read out
+        self.executor.submit(user_input)
+        self.update_typing_indicator()
+
+    def cancel_message(self, event):
+        if self.executor.cancel_current():
+            self.insert_text("(ROGA's reply was cancelled)\n")
+        self.update_typing_indicator()
+
+    def update_typing_indicator(self):
+        if not self.executor.busy:
+            speech_depth = self.speech.queue_depth
+            self.typing_label.config(text=f"Reading out... ({speech_depth} sentences left)" if speech_depth else "")
+            return
+        queued = self.executor.queued
+        self.typing_label.config(text="ROGA is typing..." + (f" ({queued} more queued)" if queued else ""))
+
+    def poll_results(self):
+        while True:
+            try:
+                result: ChatResult = self.executor.results.get_nowait()
+            except queue.Empty:
+                break
+            self.show_result(result)
+        self.update_typing_indicator()
+        self.after(results_poll_interval_ms, self.poll_results)
+
+    def show_result(self, result):
+        if result.error is not None:
+            self.insert_text(f"(ROGA couldn't reply: {result.error})\n")
+            self.last_sent_label(f"Last message failed after {result.latency:.2f}s")
+            return
+        self.insert_text("ROGA: " + result.reply + "\n")
+        self.last_sent_label(str(time.strftime("Last reply: " + '%I:%M %p')) +
+                             f" - took {result.latency:.2f}s ({result.service_time:.2f}s LLM)")
+        self.playResponce(result.reply)
 
     def font_change_default(self):
         self.text_box.config(font="Verdana 10")
@@ -0,0 +1,87 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import numpy as np
+
+
+@dataclass
+class HedgeStats:
+    requests: int = 0  # Chat calls that could be hedged
+    fired: int = 0  # Calls for which a hedged duplicate went out
+    won: int = 0  # Hedged calls answered first by the duplicate
+    over_budget: int = 0  # Calls past the threshold that weren't hedged, the budget was used up
+
+    @property
+    def fire_rate(self) -> float:
+        return self.fired / self.requests if self.requests else 0.0
+
+    @property
+    def win_rate(self) -> float:
+        return self.won / self.fired if self.fired else 0.0
+
+
+@dataclass
+class HedgePolicy:
+    # Cuts the tail latency of the chat calls, e.g. CohereHandler(hedging=HedgePolicy(fallback_model="command-r")).
+    # A call that hasn't answered within the quantile of the recent call latencies gets a duplicate, sent to the
+    # fallback model if one is set. The first successful reply wins. At most budget of the calls are hedged, so the
+    # extra API spend is bounded. No duplicate goes out until min_samples latencies were observed.
+    quantile: float = 0.9
+    budget: float = 0.05  # Share of the calls that may be hedged
+    fallback_model: str | type(None) = None  # From available_endpoint_models["chat"], None hedges with the same model
+    min_delay: float = 0.25  # Seconds, bounds of the adaptive threshold
+    max_delay: float = 30.0
+    min_samples: int = 20
+    window: int = 1000  # Latencies the threshold is computed from, the most recent ones
+    max_workers: int = 64  # Threads of the sync handler's calls in flight, the async handler doesn't use them
+    stats: HedgeStats = field(init=False, default_factory=HedgeStats)
+    _latencies: deque = field(init=False, repr=False)
+    _executor: ThreadPoolExecutor | type(None) = field(init=False, default=None, repr=False)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self):
+        self._latencies = deque(maxlen=self.window)
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="cohere-hedge")
+            return self._executor
+
+    def observe(self, seconds: float):
+        # The latency of a successful call, hedged duplicates and calls that lost the race included
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def delay(self) -> float | type(None):
+        # Seconds to wait before hedging a new call, None while too few latencies were observed
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = np.fromiter(self._latencies, float, len(self._latencies))
+        return min(max(float(np.quantile(latencies, self.quantile)), self.min_delay), self.max_delay)
+
+    def start(self):
+        with self._lock:
+            self.stats.requests += 1
+
+    def try_fire(self) -> bool:
+        with self._lock:
+            if self.stats.fired + 1 > self.budget * self.stats.requests:
+                self.stats.over_budget += 1
+                return False
+            self.stats.fired += 1
+            return True
+
+    def record_win(self):
+        with self._lock:
+            self.stats.won += 1
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,147 @@
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import monotonic
+
+import requests
+from requests import Response
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+@dataclass
+class TransportCfg:
+    pool_connections: int = 4  # Number of per-host connection pools to keep alive
+    pool_maxsize: int = 16  # Max concurrent connections kept per host
+    pool_block: bool = False  # If True, wait for a free connection instead of opening an extra one past pool_maxsize
+    connect_timeout: float = 5.0  # Seconds
+    read_timeout: float = 120.0  # Seconds between bytes received, not the total response time
+
+    @property
+    def timeout(self) -> tuple[float, float]:
+        return self.connect_timeout, self.read_timeout
+
+
+class DeadlineExceeded(TimeoutError):
+    # The time budget of a deadline block ran out. Not a requests.RequestException: the API didn't fail, so neither
+    # the retries nor the circuit breaker count it.
+    pass
+
+
+_deadline: ContextVar[float | type(None)] = ContextVar("request_deadline", default=None)
+
+
+@contextmanager
+def deadline(seconds: float):
+    # The requests made in the block, retries included, time out once seconds passed in total
+    token = _deadline.set(monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@dataclass
+class TransportStats:
+    requests: int = 0
+    new_connections: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    @property
+    def reused_connections(self) -> int:
+        return max(self.requests - self.new_connections, 0)
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def count_new_connection(self):
+        with self._lock:
+            self.new_connections += 1
+
+    def snapshot(self) -> dict[str, int]:
+        with self._lock:
+            return {"requests": self.requests, "new_connections": self.new_connections,
+                    "reused_connections": max(self.requests - self.new_connections, 0)}
+
+
+def _counting_pool_classes(stats: TransportStats) -> dict[str, type]:
+    # urllib3 calls _new_conn only when no idle keep-alive connection is available in the pool, so counting the calls
+    # counts the TCP (+TLS) handshakes.
+    def counting(pool_cls: type) -> type:
+        def _new_conn(self):
+            stats.count_new_connection()
+            return pool_cls._new_conn(self)
+        return type(f"Counting{pool_cls.__name__}", (pool_cls,), {"_new_conn": _new_conn})
+
+    return {"http": counting(HTTPConnectionPool), "https": counting(HTTPSConnectionPool)}
+
+
+class _CountingAdapter(HTTPAdapter):
+    def __init__(self, stats: TransportStats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = _counting_pool_classes(self.stats)
+
+
+@dataclass
+class HttpTransport:
+    # Keep-alive HTTP transport shared by all the calls of a handler.
+    # All threads share one connection pool (urllib3 pools are thread-safe), but every thread gets its own
+    # requests.Session since sessions aren't guaranteed to be thread-safe. Only the thread itself references its
+    # session, so the sessions of short-lived threads (e.g. a ThreadPoolExecutor per embed call) are freed with them.
+    cfg: TransportCfg = field(default_factory=TransportCfg)
+    stats: TransportStats = field(init=False, default_factory=TransportStats)
+    _adapter: HTTPAdapter = field(init=False, repr=False)
+    _local: threading.local = field(init=False, repr=False, default_factory=threading.local)
+
+    def __post_init__(self):
+        self._adapter = _CountingAdapter(self.stats,
+                                         pool_connections=self.cfg.pool_connections,
+                                         pool_maxsize=self.cfg.pool_maxsize,
+                                         pool_block=self.cfg.pool_block)
+
+    @property
+    def session(self) -> requests.Session:
+        session: requests.Session | None = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", self._adapter)
+            session.mount("http://", self._adapter)
+            self._local.session = session
+        return session
+
+    def request(self, method: str, url: str, **kwargs) -> Response:
+        kwargs.setdefault("timeout", self.cfg.timeout)
+        until = _deadline.get()
+        if until is None:
+            self.stats.count_request()
+            return self.session.request(method, url, **kwargs)
+        remaining = until - monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"The deadline passed before {method} {url}")
+        timeout = kwargs["timeout"]
+        kwargs["timeout"] = tuple(remaining if t is None else min(t, remaining)
+                                  for t in (timeout if isinstance(timeout, tuple) else (timeout, timeout)))
+        self.stats.count_request()
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.Timeout as e:
+            if monotonic() < until:
+                raise
+            raise DeadlineExceeded(f"The deadline passed during {method} {url}") from e
+
+    def get(self, url: str, **kwargs) -> Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> Response:
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        # The sessions hold no connections of their own, closing the shared adapter closes them all
+        self._adapter.close()
+        self._local = threading.local()
@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, Protocol
+
+from cohere_tools import CLASSIFY_BATCH_SIZE, ClassifyExample, CohereHandler
+
+# Labels the stored messages (exporter.py / sync.py messages.jsonl) with the classify endpoint, e.g. by distress level:
+#   python labeling.py --store export --examples distress_examples.jsonl --out labels/distress.jsonl
+# examples.jsonl holds the few-shot {"text", "label"} examples, at least 2 per label. An interrupted run continues
+# where it stopped when started again with the same --out.
+
+
+def message_id(record: dict) -> str:
+    return str(record.get("id") or f"{record.get('userId')}:{record.get('timestamp')}")
+
+
+class LabelSink(Protocol):
+    def done_ids(self) -> set[str]: ...
+
+    def write(self, row: dict): ...
+
+    def close(self): ...
+
+
+class JsonlLabelSink:
+    # One JSON line per labeled message, flushed every fsync_every lines. Lines are written as batches complete, not
+    # in message order. When reopened, a torn last line is dropped and the labeled ids are read back, so a resumed
+    # run only classifies the messages that are missing.
+    def __init__(self, path: Path, fsync_every: int = 1000):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fsync_every = fsync_every
+        self._done: set[str] = set()
+        size = 0
+        if self.path.exists():
+            with open(self.path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    self._done.add(json.loads(line)["id"])
+                    size += len(line)
+        self._f = open(self.path, "a+", encoding="utf-8")
+        self._f.truncate(size)
+        self._unsynced = 0
+
+    def done_ids(self) -> set[str]:
+        return self._done
+
+    def write(self, row: dict):
+        self._f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self._done.add(row["id"])
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        self.sync()
+        self._f.close()
+
+
+def load_examples(path: Path) -> list[ClassifyExample]:
+    with open(path, encoding="utf-8") as f:
+        return [ClassifyExample(e["text"], e["label"]) for e in map(json.loads, filter(str.strip, f))]
+
+
+def iter_messages(messages_jsonl: Path, role: str | type(None), skip_ids: set[str]) -> Iterator[dict]:
+    # The ids yielded are added to skip_ids, so a message stored twice is labeled once
+    with open(messages_jsonl, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if (role is None or record.get("role") == role) and (record.get("message") or "").strip() \
+                    and message_id(record) not in skip_ids:
+                skip_ids.add(message_id(record))
+                yield record
+
+
+@dataclass
+class LabelingCfg:
+    store_dir: Path  # With messages.jsonl
+    examples_path: Path
+    out_path: Path
+    role: str | type(None) = "USER"  # Only the messages of this role, None labels all of them
+    batch_size: int = CLASSIFY_BATCH_SIZE
+    workers: int = 4
+    model: str = None
+
+
+def label_messages(cfg: LabelingCfg, handler: CohereHandler = None, sink: LabelSink = None) -> int:
+    # Returns the number of messages labeled by this run
+    handler = handler or CohereHandler()
+    sink = sink or JsonlLabelSink(cfg.out_path)
+    examples = handler.classify_examples_json(load_examples(cfg.examples_path))
+    # Only the messages of the batches in flight are kept, classify_batches reads the inputs lazily
+    in_flight: dict[int, dict] = {}
+
+    def inputs() -> Iterator[str]:
+        seen = set(sink.done_ids())  # The sink only learns an id once its batch completes
+        for i, record in enumerate(iter_messages(cfg.store_dir / "messages.jsonl", cfg.role, seen)):
+            in_flight[i] = record
+            yield record["message"]
+
+    labeled = 0
+    try:
+        for i, classification in handler.classify_batches(inputs(), examples, cfg.model, cfg.batch_size,
+                                                          cfg.workers):
+            record = in_flight.pop(i)
+            sink.write({"id": message_id(record), "userId": record.get("userId"),
+                        "timestamp": record.get("timestamp"), "label": classification["prediction"],
+                        "confidence": classification["confidence"],
+                        "labels": {label: v["confidence"] for label, v in classification.get("labels", {}).items()}})
+            labeled += 1
+    finally:
+        sink.close()
+    return labeled
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Label the stored messages with the Cohere classify endpoint.")
+    parser.add_argument("--store", type=Path, default=Path("export"), help="Directory with messages.jsonl")
+    parser.add_argument("--examples", type=Path, required=True, help='JSONL of {"text", "label"} examples')
+    parser.add_argument("--out", type=Path, required=True)
+    parser.add_argument("--role", default="USER", help='Role of the messages to label, "all" for every message')
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--model")
+    args = parser.parse_args()
+    labeling_cfg = LabelingCfg(args.store, args.examples, args.out, None if args.role == "all" else args.role,
+                               workers=args.workers, model=args.model)
+    print(f"Labeled {label_messages(labeling_cfg)} messages, written to {args.out}")
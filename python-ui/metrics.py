@@ -0,0 +1,254 @@
+import json
+import threading
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from time import time
+from typing import Any, Callable
+from warnings import warn
+
+from stamina.instrumentation import RetryDetails, get_on_retry_hooks, set_on_retry_hooks
+
+# Seconds. Cohere's latencies range from ~50ms (embed, rerank) to tens of seconds (long chat replies).
+LATENCY_BUCKETS: tuple[float, ...] = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+
+
+@dataclass
+class Histogram:
+    bounds: tuple[float, ...] = LATENCY_BUCKETS
+    counts: list[int] = field(default=None)  # Per bucket, not cumulative. The last one counts values above bounds.
+    total: float = 0.0
+    count: int = 0
+
+    def __post_init__(self):
+        if self.counts is None:
+            self.counts = [0] * (len(self.bounds) + 1)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # The upper bound of the bucket the quantile falls in, inf if above the last bound
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds + (float("inf"),), self.counts):
+            seen += n
+            if seen >= rank and n:
+                return bound
+        return 0.0
+
+
+@dataclass
+class CallRecord:
+    # One HTTP attempt, passed to the hooks of ClientMetrics
+    endpoint: str
+    model: str
+    status: int  # 0 when no response was received (timeout, connection error)
+    seconds: float
+    bytes_out: int
+    bytes_in: int
+    conversation: str | type(None)
+
+
+@dataclass
+class Usage:
+    calls: int = 0
+    seconds: float = 0.0
+    bytes_out: int = 0
+    bytes_in: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+
+
+_conversation: ContextVar[str | type(None)] = ContextVar("metrics_conversation", default=None)
+
+
+@contextmanager
+def conversation(conv_id: Any):
+    # The calls made in the block count towards the conversation's share, see ClientMetrics.conversation_usage
+    token = _conversation.set(str(conv_id))
+    try:
+        yield
+    finally:
+        _conversation.reset(token)
+
+
+@dataclass
+class ClientMetrics:
+    # Metrics of the Cohere API calls of the handlers it's passed to, e.g. CohereHandler(metrics=ClientMetrics()).
+    # Handlers without metrics (the default) skip all of this. Labels are (endpoint, model), per conversation usage
+    # is kept for the max_conversations most recently active ones and only in snapshot(), not in the Prometheus text.
+    max_conversations: int = 10_000
+    hooks: list[Callable[[CallRecord], None]] = field(default_factory=list)
+    started: float = field(init=False, default_factory=time)
+    latency: dict[tuple[str, str], Histogram] = field(init=False, default_factory=lambda: defaultdict(Histogram))
+    usage: dict[tuple[str, str], Usage] = field(init=False, default_factory=lambda: defaultdict(Usage))
+    statuses: dict[tuple[str, str, int], int] = field(init=False, default_factory=lambda: defaultdict(int))
+    retries: dict[str, int] = field(init=False, default_factory=lambda: defaultdict(int))
+    conversations: OrderedDict = field(init=False, default_factory=OrderedDict)  # conversation -> Usage
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock, repr=False)
+    _snapshot_stop: threading.Event = field(init=False, default_factory=threading.Event, repr=False)
+
+    def __post_init__(self):
+        _install_retry_hook()
+
+    def _conversation_usage(self) -> Usage | type(None):
+        conv = _conversation.get()
+        if conv is None:
+            return None
+        usage = self.conversations.get(conv)
+        if usage is None:
+            usage = self.conversations[conv] = Usage()
+            if len(self.conversations) > self.max_conversations:
+                self.conversations.popitem(last=False)
+        else:
+            self.conversations.move_to_end(conv)
+        return usage
+
+    def record_call(self, endpoint: str, model: str | type(None), status: int, seconds: float, bytes_out: int,
+                    bytes_in: int):
+        model = model or "default"
+        with self._lock:
+            self.latency[endpoint, model].observe(seconds)
+            self.statuses[endpoint, model, status] += 1
+            for usage in (self.usage[endpoint, model], self._conversation_usage()):
+                if usage is not None:
+                    usage.calls += 1
+                    usage.seconds += seconds
+                    usage.bytes_out += bytes_out
+                    usage.bytes_in += bytes_in
+        if self.hooks:
+            record = CallRecord(endpoint, model, status, seconds, bytes_out, bytes_in, _conversation.get())
+            for hook in self.hooks:
+                try:
+                    hook(record)
+                except Exception as e:
+                    warn(f"Metrics hook {hook} failed: {e}")
+
+    def record_tokens(self, endpoint: str, model: str | type(None), reply: dict):
+        # From meta.billed_units of a reply (chat, embed and classify bill input tokens, chat output tokens too)
+        billed = (reply.get("meta") or {}).get("billed_units") or {}
+        input_tokens, output_tokens = int(billed.get("input_tokens") or 0), int(billed.get("output_tokens") or 0)
+        if not input_tokens and not output_tokens:
+            return
+        with self._lock:
+            for usage in (self.usage[endpoint, model or "default"], self._conversation_usage()):
+                if usage is not None:
+                    usage.input_tokens += input_tokens
+                    usage.output_tokens += output_tokens
+
+    def record_retry(self, endpoint: str):
+        with self._lock:
+            self.retries[endpoint] += 1
+
+    def conversation_usage(self, conv_id: Any) -> Usage | type(None):
+        with self._lock:
+            return self.conversations.get(str(conv_id))
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            labels = sorted(set(self.latency) | set(self.usage))
+            return {
+                "timestamp": time(),
+                "uptime": time() - self.started,
+                "calls": [{"endpoint": endpoint, "model": model,
+                           "latency": {"count": self.latency[endpoint, model].count,
+                                       "sum": self.latency[endpoint, model].total,
+                                       **{f"p{q * 100:g}": self.latency[endpoint, model].quantile(q)
+                                          for q in (0.5, 0.95, 0.99)}},
+                           "statuses": {str(status): n for (e, m, status), n in self.statuses.items()
+                                        if (e, m) == (endpoint, model)},
+                           **asdict(self.usage[endpoint, model])}
+                          for endpoint, model in labels],
+                "retries": dict(self.retries),
+                "conversations": {conv: asdict(usage) for conv, usage in self.conversations.items()},
+            }
+
+    def to_prometheus(self, prefix: str = "cohere") -> str:
+        # The Prometheus text exposition format, e.g. to serve on a /metrics endpoint
+        lines: list[str] = []
+
+        def metric(name: str, kind: str, description: str):
+            lines.extend([f"# HELP {prefix}_{name} {description}", f"# TYPE {prefix}_{name} {kind}"])
+
+        def label_str(**labels) -> str:
+            return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels.items()) + "}"
+
+        with self._lock:
+            metric("request_duration_seconds", "histogram", "Latency of the API calls")
+            for (endpoint, model), histogram in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, n in zip(histogram.bounds + (float("inf"),), histogram.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f"{prefix}_request_duration_seconds_bucket"
+                                 f"{label_str(endpoint=endpoint, model=model, le=le)} {cumulative}")
+                lines.append(f"{prefix}_request_duration_seconds_sum{label_str(endpoint=endpoint, model=model)} "
+                             f"{histogram.total}")
+                lines.append(f"{prefix}_request_duration_seconds_count{label_str(endpoint=endpoint, model=model)} "
+                             f"{histogram.count}")
+            metric("requests_total", "counter", "API calls by response status, 0 when no response was received")
+            for (endpoint, model, status), n in sorted(self.statuses.items()):
+                lines.append(f"{prefix}_requests_total{label_str(endpoint=endpoint, model=model, status=status)} {n}")
+            metric("throttled_total", "counter", "API calls rejected with a 429")
+            for (endpoint, model, status), n in sorted(self.statuses.items()):
+                if status == 429:
+                    lines.append(f"{prefix}_throttled_total{label_str(endpoint=endpoint, model=model)} {n}")
+            for name, attr, description in (("request_bytes_total", "bytes_out", "Bytes of the request bodies"),
+                                            ("response_bytes_total", "bytes_in", "Bytes of the response bodies"),
+                                            ("input_tokens_total", "input_tokens", "Billed input tokens"),
+                                            ("output_tokens_total", "output_tokens", "Billed output tokens")):
+                metric(name, "counter", description)
+                for (endpoint, model), usage in sorted(self.usage.items()):
+                    lines.append(f"{prefix}_{name}{label_str(endpoint=endpoint, model=model)} {getattr(usage, attr)}")
+            metric("retries_total", "counter", "Retried API calls")
+            for endpoint, n in sorted(self.retries.items()):
+                lines.append(f"{prefix}_retries_total{label_str(endpoint=endpoint)} {n}")
+        return "\n".join(lines) + "\n"
+
+    def write_snapshots(self, path: Path, interval: float = 60.0) -> threading.Thread:
+        # Appends a JSON snapshot line to path every interval seconds, until stop_snapshots
+        path = Path(path)
+        self._snapshot_stop.clear()
+
+        def write():
+            while not self._snapshot_stop.wait(interval):
+                try:
+                    with open(path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(self.snapshot()) + "\n")
+                except OSError as e:
+                    warn(f"Writing a metrics snapshot to {path} failed: {e}")
+
+        thread = threading.Thread(target=write, name="metrics-snapshots", daemon=True)
+        thread.start()
+        return thread
+
+    def stop_snapshots(self):
+        self._snapshot_stop.set()
+
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _count_retry(details: RetryDetails):
+    # stamina passes the arguments of the retried call, (handler, endpoint, ...) for call_endpoint and open_stream
+    if len(details.args) >= 2:
+        metrics = getattr(details.args[0], "metrics", None)
+        if isinstance(metrics, ClientMetrics):
+            metrics.record_retry(getattr(details.args[1], "name", str(details.args[1])))
+
+
+_retry_hook_lock = threading.Lock()
+
+
+def _install_retry_hook():
+    with _retry_hook_lock:
+        hooks = list(get_on_retry_hooks())
+        if _count_retry not in hooks:
+            set_on_retry_hooks([*hooks, _count_retry])
@@ -0,0 +1,289 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from enum import IntEnum
+from time import monotonic
+from typing import Mapping
+
+
+class Priority(IntEnum):
+    # Lower values go first. A batch call only gets a token when no interactive call is waiting for one.
+    interactive = 0
+    batch = 1
+
+
+class CircuitOpenError(ConnectionError):
+    # Raised without calling the API while the circuit breaker is open. Not a requests.RequestException, so the
+    # retry decorators don't retry it.
+    pass
+
+
+@dataclass
+class TokenBucket:
+    rate: float  # Tokens per second
+    capacity: float  # Max burst
+    tokens: float = field(init=False)
+    paused_until: float = field(init=False, default=0.0)  # Set from Retry-After
+    _updated: float = field(init=False, default_factory=monotonic)
+    _waiting: list[int] = field(init=False, default_factory=lambda: [0] * len(Priority))
+    _cond: threading.Condition = field(init=False, default_factory=threading.Condition, repr=False)
+
+    def __post_init__(self):
+        self.tokens = self.capacity
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority: Priority = Priority.interactive, timeout: float = None) -> bool:
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._cond:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    now = monotonic()
+                    self._refill(now)
+                    higher_priority_waiting = any(self._waiting[p] for p in range(priority))
+                    if now >= self.paused_until and self.tokens >= 1 and not higher_priority_waiting:
+                        self.tokens -= 1
+                        return True
+                    if now < self.paused_until:
+                        wait = self.paused_until - now
+                    elif self.tokens < 1:
+                        wait = (1 - self.tokens) / self.rate
+                    else:
+                        wait = None  # Woken up once the higher priority caller took its token
+                    if deadline is not None:
+                        if now >= deadline:
+                            return False
+                        wait = deadline - now if wait is None else min(wait, deadline - now)
+                    self._cond.wait(wait)
+            finally:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+
+    def try_acquire(self, priority: Priority = Priority.interactive) -> float:
+        # Non-blocking, for event loops: takes a token and returns 0, or returns the seconds to wait before retrying
+        with self._cond:
+            now = monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                return self.paused_until - now
+            if any(self._waiting[p] for p in range(priority)):
+                return min(1 / self.rate, 0.05)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    async def acquire_async(self, priority: Priority = Priority.interactive, timeout: float = None) -> bool:
+        # Same lanes as acquire (and shared with the threads calling it), without blocking the event loop
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._cond:
+            self._waiting[priority] += 1
+        try:
+            while (wait := self.try_acquire(priority)) > 0:
+                if deadline is not None:
+                    if monotonic() >= deadline:
+                        return False
+                    wait = min(wait, deadline - monotonic())
+                await asyncio.sleep(wait)
+            return True
+        finally:
+            with self._cond:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+
+    def pause(self, seconds: float):
+        with self._cond:
+            self.paused_until = max(self.paused_until, monotonic() + seconds)
+            self.tokens = 0
+
+    def limit_remaining(self, remaining: float):
+        with self._cond:
+            self._refill(monotonic())
+            self.tokens = min(self.tokens, remaining)
+
+    def set_rate(self, rate: float, capacity: float = None):
+        with self._cond:
+            self._refill(monotonic())
+            self.rate = rate
+            if capacity is not None:
+                self.capacity = capacity
+                self.tokens = min(self.tokens, capacity)
+            self._cond.notify_all()
+
+
+@dataclass
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive failures (5xx, timeouts, connection errors), then fails fast for
+    # reset_timeout seconds. After that a single trial call is let through (half-open): success closes the circuit,
+    # failure opens it again.
+    failure_threshold: int = 5
+    reset_timeout: float = 30.0
+    failures: int = field(init=False, default=0)
+    opened_at: float | type(None) = field(init=False, default=None)
+    _trial_in_flight: bool = field(init=False, default=False)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock, repr=False)
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "open" if monotonic() - self.opened_at < self.reset_timeout else "half-open"
+
+    def _raise_if_open(self, name: str):
+        elapsed = monotonic() - self.opened_at
+        if elapsed < self.reset_timeout or self._trial_in_flight:
+            raise CircuitOpenError(f"The circuit breaker of {name or 'the API'} is open after {self.failures} "
+                                   f"consecutive failures, retry in {max(self.reset_timeout - elapsed, 0):.0f}s")
+
+    def check(self, name: str = ""):
+        # Fails fast while open, without taking the half-open trial
+        with self._lock:
+            if self.opened_at is not None:
+                self._raise_if_open(name)
+
+    def before_call(self, name: str = ""):
+        # Right before the request is sent. When half-open, the caller becomes the trial call and must end with
+        # record_success, record_failure or release_trial.
+        with self._lock:
+            if self.opened_at is None:
+                return
+            self._raise_if_open(name)
+            self._trial_in_flight = True
+
+    def release_trial(self):
+        # The trial call ended without telling whether the API recovered (a 429, cancelled), the next call is the trial
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures, self.opened_at, self._trial_in_flight = 0, None, False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_flight or self.failures >= self.failure_threshold:
+                self.opened_at = monotonic()
+            self._trial_in_flight = False
+
+
+# Requests per minute and burst per endpoint, Cohere's production key limits
+DEFAULT_ENDPOINT_LIMITS: dict[str, tuple[float, float]] = {
+    "chat": (500, 20),
+    "embed": (2000, 20),
+    "rerank": (1000, 20),
+    "classify": (1000, 20),
+}
+
+
+@dataclass
+class EndpointLimiter:
+    name: str
+    bucket: TokenBucket
+    breaker: CircuitBreaker = field(default_factory=CircuitBreaker)
+    throttled: int = 0  # 429 responses
+
+    # The breaker is checked before waiting for a token, but the half-open trial is only taken once the token was
+    # acquired, so waiting on the limiter can't leave a trial in flight.
+    def before_call(self, priority: Priority = Priority.interactive, timeout: float = None):
+        self.breaker.check(self.name)
+        if not self.bucket.acquire(priority, timeout):
+            raise CircuitOpenError(f"Timed out after {timeout}s waiting for the {self.name} rate limiter")
+        self.breaker.before_call(self.name)
+
+    async def before_call_async(self, priority: Priority = Priority.interactive, timeout: float = None):
+        self.breaker.check(self.name)
+        if not await self.bucket.acquire_async(priority, timeout):
+            raise CircuitOpenError(f"Timed out after {timeout}s waiting for the {self.name} rate limiter")
+        self.breaker.before_call(self.name)
+
+    def after_response(self, status_code: int, headers: Mapping[str, str]):
+        self.update_from_headers(headers)
+        if status_code == 429:
+            self.throttled += 1
+            retry_after = _float_header(headers, "retry-after")
+            self.bucket.pause(retry_after if retry_after is not None else 1 / self.bucket.rate)
+            self.breaker.release_trial()
+        elif status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def record_failure(self):
+        # A timeout or a connection error
+        self.breaker.record_failure()
+
+    def abandon(self):
+        # The call ended without a response nor a transport error, e.g. it was cancelled
+        self.breaker.release_trial()
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        # The usual x-ratelimit-* headers, if the API sends them. Limits are per minute, like Cohere's.
+        limit = _float_header(headers, "x-ratelimit-limit")
+        if limit:
+            self.bucket.set_rate(limit / 60)
+        remaining = _float_header(headers, "x-ratelimit-remaining")
+        if remaining is not None:
+            self.bucket.limit_remaining(remaining)
+
+
+def _float_header(headers: Mapping[str, str], name: str) -> float | type(None):
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+@dataclass
+class ApiRateLimits:
+    # One limiter per endpoint, shared by every thread and handler using this object
+    endpoint_limits: dict[str, tuple[float, float]] = field(default_factory=lambda: dict(DEFAULT_ENDPOINT_LIMITS))
+    failure_threshold: int = 5
+    reset_timeout: float = 30.0
+    acquire_timeout: float | type(None) = 60.0  # Max seconds to wait for a token, None waits forever
+    _limiters: dict[str, EndpointLimiter] = field(init=False, default_factory=dict)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock, repr=False)
+
+    def __getitem__(self, endpoint: str) -> EndpointLimiter:
+        with self._lock:
+            limiter = self._limiters.get(endpoint)
+            if limiter is None:
+                per_minute, burst = self.endpoint_limits.get(endpoint, (100, 10))
+                limiter = EndpointLimiter(endpoint, TokenBucket(per_minute / 60, burst),
+                                          CircuitBreaker(self.failure_threshold, self.reset_timeout))
+                self._limiters[endpoint] = limiter
+            return limiter
+
+
+_shared_rate_limits: dict[str, ApiRateLimits] = {}
+_shared_rate_limits_lock = threading.Lock()
+
+
+def shared_rate_limits(key: str = "") -> ApiRateLimits:
+    # The process-wide limits of an API key on a server (by a hash of both, see CatalogCache.key_for), so every
+    # handler instance shares the same quota
+    with _shared_rate_limits_lock:
+        return _shared_rate_limits.setdefault(key, ApiRateLimits())
+
+
+_lane: ContextVar[Priority | type(None)] = ContextVar("rate_limit_lane", default=None)
+
+
+@contextmanager
+def lane(priority: Priority):
+    # Runs the API calls made in the block in the given lane, e.g. a background summary of a chat in the batch lane
+    token = _lane.set(priority)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def current_priority(default: Priority) -> Priority:
+    priority = _lane.get()
+    return default if priority is None else priority
@@ -0,0 +1,307 @@
+import json
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from collections.abc import MutableMapping
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from time import monotonic
+from typing import Any, Callable, Iterator
+from uuid import uuid4
+from warnings import warn
+
+import redis
+
+from cohere_tools import ConvHist, ConvHistoriesManager, ConvManager, ConvMsg, StandardRoles
+
+# The layout of the TypeScript bot's RedisUserStore:
+#   messages:<userId> - a list of JSON messages {id, userId, role, timestamp, message}, oldest first
+#   user:<userId>     - the JSON UserProfile
+# and the Python side's own:
+#   conv:<userId>     - a hash of the conversation's system prompt (sysMsg) and pinned messages (pinned, a JSON list of
+#                       indices into messages:<userId>)
+MESSAGES_KEY_PREFIX: str = "messages:"
+USER_KEY_PREFIX: str = "user:"
+CONV_KEY_PREFIX: str = "conv:"
+
+
+def redis_from_env(db: int = 0) -> redis.Redis:
+    # Same env vars as the TypeScript bot and data_reader.py
+    redis_host = os.getenv('REDISHOST', '127.0.0.1')
+    redis_port = os.getenv('REDISPORT', 6379)
+    return redis.Redis(host=redis_host, port=int(redis_port), db=db)
+
+
+def js_timestamp(dt: datetime = None) -> str:
+    # The format JSON.stringify gives a JS Date, e.g. 2024-05-01T12:00:00.000Z
+    dt = dt or datetime.now(timezone.utc)
+    return dt.astimezone(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def msg_to_record(user_id: str, msg: ConvMsg) -> dict[str, str]:
+    return {"id": str(uuid4()), "userId": user_id, "role": msg.role_value, "timestamp": js_timestamp(),
+            "message": msg.msg}
+
+
+def record_to_msg(record: dict[str, Any]) -> ConvMsg:
+    role: str = record["role"]
+    try:
+        role = StandardRoles(role)
+    except ValueError:
+        pass
+    return ConvMsg(role, record["message"])
+
+
+class HotHistories(MutableMapping):
+    # An LRU of the conversations in memory. A missing conversation is loaded on access, the least recently used one
+    # is dropped once there are more than max_size, and idle ones can be dropped with evict_idle.
+    # The loader and before_evict run outside the lock, so a slow load only blocks the callers of that conversation.
+    def __init__(self, loader: Callable[[str], ConvHist], max_size: int,
+                 before_evict: Callable[[str], Any] = None):
+        self.loader = loader
+        self.max_size = max_size
+        self.before_evict = before_evict
+        self._hot: OrderedDict[str, ConvHist] = OrderedDict()
+        self._last_access: dict[str, float] = {}
+        self._loading: dict[str, threading.Event] = {}  # Conversations being loaded, set once they are in _hot
+        self._lock = threading.RLock()
+
+    def __getitem__(self, conv_id: str) -> ConvHist:
+        while True:
+            with self._lock:
+                conv_hist = self._hot.get(conv_id)
+                if conv_hist is not None:
+                    self._hot.move_to_end(conv_id)
+                    self._last_access[conv_id] = monotonic()
+                    return conv_hist
+                loading = self._loading.get(conv_id)
+                if loading is None:
+                    loading = self._loading[conv_id] = threading.Event()
+                    break
+            loading.wait()  # Loaded by another thread, or its load failed and this thread retries
+        try:
+            conv_hist = self.loader(conv_id)
+            with self._lock:
+                conv_hist = self._hot.setdefault(conv_id, conv_hist)  # Unless it was set meanwhile
+                self._last_access[conv_id] = monotonic()
+                evicted = self._pop_over_size()
+        finally:
+            with self._lock:
+                del self._loading[conv_id]
+            loading.set()
+        self._run_before_evict(evicted)
+        return conv_hist
+
+    def __setitem__(self, conv_id: str, conv_hist: ConvHist):
+        with self._lock:
+            self._hot[conv_id] = conv_hist
+            self._hot.move_to_end(conv_id)
+            self._last_access[conv_id] = monotonic()
+            evicted = self._pop_over_size()
+        self._run_before_evict(evicted)
+
+    def __delitem__(self, conv_id: str):
+        with self._lock:
+            del self._hot[conv_id]
+            self._last_access.pop(conv_id, None)
+
+    def __contains__(self, conv_id: object) -> bool:
+        # Only checks memory, use the manager to check Redis
+        return conv_id in self._hot
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._hot))
+
+    def __len__(self) -> int:
+        return len(self._hot)
+
+    def _pop(self, conv_id: str):
+        self._hot.pop(conv_id, None)
+        self._last_access.pop(conv_id, None)
+
+    def _pop_over_size(self) -> list[str]:
+        evicted = []
+        while len(self._hot) > self.max_size:
+            evicted.append(next(iter(self._hot)))
+            self._pop(evicted[-1])
+        return evicted
+
+    def _run_before_evict(self, evicted: list[str]):
+        # After the conversations left memory, a concurrent reload flushes their pending messages itself first
+        if self.before_evict is not None:
+            for conv_id in evicted:
+                self.before_evict(conv_id)
+
+    def evict_idle(self, idle_seconds: float) -> int:
+        with self._lock:
+            cutoff = monotonic() - idle_seconds
+            idle = [conv_id for conv_id, t in self._last_access.items() if t < cutoff]
+            for conv_id in idle:
+                self._pop(conv_id)
+        self._run_before_evict(idle)
+        return len(idle)
+
+
+@dataclass
+class RedisConvHistoriesManager(ConvHistoriesManager):
+    # Conversation histories stored in the same Redis layout as the TypeScript bot, so conversation ids are Telegram
+    # user ids. Histories are loaded on first access, new messages are written behind in pipelined batches, and only
+    # a bounded LRU of recently used conversations is kept in memory.
+    # The system prompt and the pins are written through to conv:<userId>, so set them with the manager's methods
+    # (new_conv, update_sys_prompt, add_msg, pin, unpin), changes made on a ConvHist directly are lost on eviction.
+    redis_client: redis.Redis = field(default_factory=redis_from_env, repr=False)
+    max_hot_conversations: int = 1000
+    idle_seconds: float = 30 * 60  # Conversations unused for longer are dropped from memory
+    load_last: int = 0  # Messages to load per conversation, 0 loads the whole list
+    flush_interval: float = 0.2  # Seconds between write-behind flushes
+    flush_batch_size: int = 500  # Pending messages that trigger an immediate flush
+    _pending: list[tuple[str, str]] = field(init=False, default_factory=list, repr=False)  # (key, JSON record)
+    _pending_lock: threading.Lock = field(init=False, default_factory=threading.Lock, repr=False)
+    _flush_lock: threading.Lock = field(init=False, default_factory=threading.Lock, repr=False)  # Keeps write order
+    _flush_requested: threading.Event = field(init=False, default_factory=threading.Event, repr=False)
+    _closed: threading.Event = field(init=False, default_factory=threading.Event, repr=False)
+    _flusher: threading.Thread = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.histories = HotHistories(self.load_conv, self.max_hot_conversations, before_evict=self._before_evict)
+        self._flusher = threading.Thread(target=self._flush_loop, name="redis-write-behind", daemon=True)
+        self._flusher.start()
+
+    def load_conv(self, conv_id: str) -> ConvHist:
+        if self._has_pending(conv_id):
+            self.flush()
+        start = -self.load_last if self.load_last else 0
+        key = f"{MESSAGES_KEY_PREFIX}{conv_id}"
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.llen(key)
+        pipe.lrange(key, start, -1)
+        pipe.hgetall(f"{CONV_KEY_PREFIX}{conv_id}")
+        length, records, state = pipe.execute()
+        conv_hist = ConvHist(state.get(b"sysMsg", b"").decode("utf-8"), [record_to_msg(json.loads(r)) for r in records],
+                             self.max_history_tokens)
+        offset = length - len(records)  # Index of the first loaded message in the list
+        conv_hist.pinned = {i - offset for i in json.loads(state.get(b"pinned", b"[]")) if offset <= i < length}
+        return conv_hist
+
+    def _list_offset(self, conv_id: str, conv_hist: ConvHist) -> int:
+        # Index of conv_hist.msgs[0] in the Redis list, not 0 if only the last load_last messages were loaded
+        if not self.load_last:
+            return 0
+        self.flush()
+        return self.redis_client.llen(f"{MESSAGES_KEY_PREFIX}{conv_id}") - len(conv_hist.msgs)
+
+    def save_conv_state(self, conv_id: str, pipe: redis.client.Pipeline = None):
+        conv_hist = self.histories[conv_id]
+        offset = self._list_offset(conv_id, conv_hist)
+        (pipe or self.redis_client).hset(f"{CONV_KEY_PREFIX}{conv_id}", mapping={
+            "sysMsg": conv_hist.sys_msg, "pinned": json.dumps(sorted(offset + i for i in conv_hist.pinned))})
+
+    def conv_exists(self, conv_id: str) -> bool:
+        return conv_id in self.histories or bool(self.redis_client.exists(f"{MESSAGES_KEY_PREFIX}{conv_id}"))
+
+    def new_conv(self, sys_prompt: str = None, init_history: list[ConvMsg] = None, user_id: str = None) -> str:
+        conv_id: str = str(user_id) if user_id is not None else str(uuid4())
+        conv_hist = self.histories[conv_id]  # Continues the stored conversation of an existing user
+        if sys_prompt is not None:
+            conv_hist.sys_msg = sys_prompt
+            self.save_conv_state(conv_id)
+        for msg in init_history or []:
+            self.add_msg(conv_id, msg)
+        return conv_id
+
+    def update_sys_prompt(self, conv_id: str, sys_prompt: str):
+        super().update_sys_prompt(conv_id, sys_prompt)
+        self.save_conv_state(conv_id)
+
+    def pin(self, conv_id: str, index: int = -1):
+        super().pin(conv_id, index)
+        self.save_conv_state(conv_id)
+
+    def unpin(self, conv_id: str, index: int):
+        super().unpin(conv_id, index)
+        self.save_conv_state(conv_id)
+
+    def add_msg(self, conv_id: str, msg: ConvMsg | str, role: StandardRoles | str = None, pinned: bool = False):
+        conv_hist = self.histories[conv_id]
+        conv_hist.add_msg(msg, role, pinned)
+        record = msg_to_record(conv_id, conv_hist.msgs[-1])
+        with self._pending_lock:
+            self._pending.append((f"{MESSAGES_KEY_PREFIX}{conv_id}", json.dumps(record, ensure_ascii=False)))
+            if len(self._pending) >= self.flush_batch_size:
+                self._flush_requested.set()
+        if pinned:
+            self.save_conv_state(conv_id)
+
+    def update_msgs(self, conv_id: str, msgs: list[ConvMsg], sys_msg: str = None, update_sys_msg: bool = False):
+        self.flush()
+        self.histories[conv_id].update_msgs(msgs, sys_msg, update_sys_msg)
+        key = f"{MESSAGES_KEY_PREFIX}{conv_id}"
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.delete(key)
+        if msgs:
+            pipe.rpush(key, *(json.dumps(msg_to_record(conv_id, m), ensure_ascii=False) for m in msgs))
+        self.save_conv_state(conv_id, pipe)  # The pins were reset
+        pipe.execute()
+
+    def get_profile(self, user_id: str) -> dict[str, Any]:
+        # Same defaults as RedisUserStore.getUser
+        data = self.redis_client.get(f"{USER_KEY_PREFIX}{user_id}")
+        if data:
+            return json.loads(data)
+        return {"id": user_id, "satisfactionLevel": [], "personalDetails": {}, "language": "Hebrew"}
+
+    def save_profile(self, profile: dict[str, Any]):
+        self.redis_client.set(f"{USER_KEY_PREFIX}{profile['id']}", json.dumps(profile, ensure_ascii=False))
+
+    def _has_pending(self, conv_id: str) -> bool:
+        key = f"{MESSAGES_KEY_PREFIX}{conv_id}"
+        with self._pending_lock:
+            return any(k == key for k, _ in self._pending)
+
+    def _before_evict(self, conv_id: str):
+        if self._has_pending(conv_id):
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        by_key: dict[str, list[str]] = defaultdict(list)  # Keeps the order of the messages within each list
+        for key, record in pending:
+            by_key[key].append(record)
+        try:
+            # MULTI/EXEC, so a failed flush wrote none of the records and re-queueing them all can't duplicate any
+            pipe = self.redis_client.pipeline(transaction=True)
+            for key, records in by_key.items():
+                pipe.rpush(key, *records)
+            pipe.execute()
+        except redis.RedisError:
+            with self._pending_lock:
+                self._pending = pending + self._pending  # Retried on the next flush
+            raise
+
+    def _flush_loop(self):
+        while not self._closed.is_set():
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            try:
+                self.flush()
+                self.histories.evict_idle(self.idle_seconds)
+            except redis.RedisError as e:
+                warn(f"Writing conversation messages to Redis failed, will retry: {e}")
+
+    def close(self):
+        self._closed.set()
+        self._flush_requested.set()
+        self._flusher.join()
+        self.flush()
+
+
+@dataclass
+class RedisConvManager(RedisConvHistoriesManager, ConvManager):
+    pass
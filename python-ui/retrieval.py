@@ -0,0 +1,137 @@
+import json
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+
+import numpy as np
+
+from cohere_tools import CohereHandler, Document
+
+VECTORS_FILE_NAME: str = "vectors.npy"
+METADATA_FILE_NAME: str = "index.json"
+
+
+@dataclass
+class DocumentIndex:
+    # Local retrieval over a Document corpus. The unit-normalized embeddings are stored in a memory-mapped .npy file
+    # with spare capacity, so adding documents appends rows instead of rebuilding the file, and deleting only flags the
+    # row. The documents themselves are kept in a sidecar JSON file, where row i describes vector i.
+    # The search output plugs straight into CohereHandler.chat(documents=...).
+    index_dir: Path
+    llm_handler: CohereHandler
+    initial_capacity: int = 1024
+    dim: int = field(init=False, default=0)
+    count: int = field(init=False, default=0)  # Rows in use, including the deleted ones
+    documents: list[dict[str, str]] = field(init=False, default_factory=list)
+    alive: np.ndarray = field(init=False, default_factory=lambda: np.zeros(0, dtype=bool))
+    vectors: np.ndarray | type(None) = field(init=False, default=None)
+
+    def __post_init__(self):
+        self.index_dir = Path(self.index_dir)
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        metadata_path = self.index_dir / METADATA_FILE_NAME
+        if metadata_path.exists():
+            metadata = json.loads(metadata_path.read_text(encoding="utf-8"))
+            self.dim, self.count, self.documents = metadata["dim"], metadata["count"], metadata["documents"]
+            self.alive = np.zeros(self.count, dtype=bool)
+            self.alive[metadata["alive"]] = True
+            self.vectors = np.load(self.index_dir / VECTORS_FILE_NAME, mmap_mode="r+")
+
+    def __len__(self) -> int:
+        return int(self.alive.sum())
+
+    @property
+    def capacity(self) -> int:
+        return 0 if self.vectors is None else self.vectors.shape[0]
+
+    def _reserve(self, rows: int):
+        if self.count + rows <= self.capacity:
+            return
+        new_capacity = max(self.initial_capacity, self.capacity)
+        while new_capacity < self.count + rows:
+            new_capacity *= 2
+        path = self.index_dir / VECTORS_FILE_NAME
+        tmp_path = path.with_suffix(".tmp.npy")
+        new_vectors = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(new_capacity, self.dim))
+        if self.vectors is not None:
+            new_vectors[:self.count] = self.vectors[:self.count]
+        new_vectors.flush()
+        del new_vectors
+        self.vectors = None  # Releases the old mapping before the file is replaced
+        tmp_path.replace(path)
+        self.vectors = np.load(path, mmap_mode="r+")
+
+    def _save_metadata(self):
+        metadata = {"dim": self.dim, "count": self.count, "documents": self.documents,
+                    "alive": np.flatnonzero(self.alive).tolist()}
+        path = self.index_dir / METADATA_FILE_NAME
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(metadata, ensure_ascii=False), encoding="utf-8")
+        tmp_path.replace(path)
+
+    def add(self, documents: list[Document]) -> list[int]:
+        # Returns the ids of the new documents, which stay valid until compact() is called
+        if not documents:
+            return []
+        embeddings = self.llm_handler.embed([doc.text for doc in documents], input_type="search_document")
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        if not self.dim:
+            self.dim = embeddings.shape[1]
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(f"The index holds {self.dim}-dimensional vectors, but the embed model returned "
+                             f"{embeddings.shape[1]} dimensions. Was the embed model changed?")
+        self._reserve(len(documents))
+        ids = list(range(self.count, self.count + len(documents)))
+        self.vectors[ids[0]:ids[-1] + 1] = embeddings
+        self.vectors.flush()
+        self.documents.extend(asdict(doc) for doc in documents)
+        self.alive = np.concatenate([self.alive, np.ones(len(documents), dtype=bool)])
+        self.count += len(documents)
+        self._save_metadata()
+        return ids
+
+    def delete(self, ids: list[int]):
+        self.alive[ids] = False
+        self._save_metadata()
+
+    def compact(self) -> dict[int, int]:
+        # Drops the deleted rows, returns a map from the old ids to the new ids
+        keep = np.flatnonzero(self.alive)
+        id_map = {int(old_id): new_id for new_id, old_id in enumerate(keep)}
+        if len(keep) == self.count:
+            return id_map
+        self.vectors[:len(keep)] = self.vectors[keep]
+        self.vectors.flush()
+        self.documents = [self.documents[i] for i in keep]
+        self.count = len(keep)
+        self.alive = np.ones(self.count, dtype=bool)
+        self._save_metadata()
+        return id_map
+
+    def get(self, doc_id: int) -> Document:
+        return Document(**self.documents[doc_id])
+
+    def search(self, query: str, k: int = 5) -> list[tuple[int, float]]:
+        # Top-k (id, cosine similarity) pairs, best first
+        if not self.count or not self.alive.any():
+            return []
+        query_vector = self.llm_handler.embed([query], input_type="search_query")[0]
+        query_vector /= max(float(np.linalg.norm(query_vector)), 1e-12)
+        scores = self.vectors[:self.count] @ query_vector
+        scores[~self.alive] = -np.inf
+        k = min(k, len(self))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(i), float(scores[i])) for i in top]
+
+    def retrieve(self, query: str, k: int = 5, rerank: bool = False, rerank_candidates: int = 0,
+                 rerank_model: str = None) -> list[Document]:
+        # With rerank=True, the top rerank_candidates (default 4 * k) by cosine similarity are refined with the
+        # rerank endpoint, which is slower but much more precise.
+        if not rerank:
+            return [self.get(doc_id) for doc_id, _ in self.search(query, k)]
+        candidate_ids = [doc_id for doc_id, _ in self.search(query, rerank_candidates or 4 * k)]
+        if not candidate_ids:
+            return []
+        reply = self.llm_handler.rerank(query, [self.documents[i]["text"] for i in candidate_ids], rerank_model)
+        ranked = sorted(reply["results"], key=lambda r: -r["relevance_score"])
+        return [self.get(candidate_ids[r["index"]]) for r in ranked[:k]]
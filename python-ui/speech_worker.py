@@ -0,0 +1,143 @@
+import hashlib
+import queue
+import re
+import shutil
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import pyttsx3
+
+try:
+    import winsound  # Cached phrases are replayed from wav files, which the standard library can only do on Windows
+except ImportError:
+    winsound = None
+
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?…:;])\s+|\s*\n+\s*|\s+--\s+")
+
+
+def split_sentences(text: str) -> list[str]:
+    return [s.strip() for s in SENTENCE_SPLIT.split(text) if s and s.strip()]
+
+
+@dataclass
+class SpeechWorker:
+    # A single long-lived speech engine on its own thread. Replies are split into sentences so speech starts right
+    # after the first sentence is synthesized, and a new reply (or a new user message) can cut off the current one.
+    # pyttsx3 engines aren't thread-safe, so only the worker thread touches the engine: cancel() just raises a flag
+    # which the engine's started-word callback acts on. Phrases repeated often are replayed from a wav cache, on
+    # Windows only (winsound is the only wav player in the standard library), elsewhere every sentence is synthesized.
+    rate: int = 200
+    volume: float = 1.0  # 0.0 to 1.0
+    max_queue: int = 64  # Sentences. Further sentences are dropped, speech is best-effort.
+    cache_min_repeats: int = 2  # A phrase is synthesized to a wav file once it was spoken this many times, Windows only
+    max_cached_phrases: int = 64
+    cache_dir: Path | type(None) = None  # None: a temporary directory, created only with winsound, removed on shutdown
+    dropped: int = field(init=False, default=0)
+    _owns_cache_dir: bool = field(init=False, default=False, repr=False)
+    _queue: queue.Queue = field(init=False)
+    _generation: int = field(init=False, default=0)
+    _engine: object = field(init=False, default=None, repr=False)
+    _stop_requested: threading.Event = field(init=False, default_factory=threading.Event, repr=False)
+    _phrase_counts: Counter = field(init=False, default_factory=Counter, repr=False)
+    _cached_phrases: OrderedDict = field(init=False, default_factory=OrderedDict, repr=False)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock, repr=False)
+    _worker: threading.Thread = field(init=False, repr=False)
+
+    def __post_init__(self):
+        if winsound is not None and self.cache_dir is None:
+            self.cache_dir, self._owns_cache_dir = Path(tempfile.mkdtemp(prefix="roga_tts_")), True
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._worker = threading.Thread(target=self._run, name="speech-worker", daemon=True)
+        self._worker.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def speak(self, text: str, interrupt: bool = True):
+        if interrupt:
+            self.cancel()
+        with self._lock:
+            generation = self._generation
+        for sentence in split_sentences(text):
+            try:
+                self._queue.put_nowait((generation, sentence))
+            except queue.Full:
+                self.dropped += 1
+
+    def cancel(self):
+        # Barge-in: everything queued is dropped and the sentence being spoken is stopped
+        with self._lock:
+            self._generation += 1
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._stop_requested.set()  # The sentence being synthesized stops at its next word, see _on_word
+        if winsound is not None:
+            winsound.PlaySound(None, winsound.SND_PURGE)
+
+    def shutdown(self, timeout: float = 2.0):
+        self.cancel()
+        self._queue.put((None, None))
+        if self._owns_cache_dir:
+            # The worker may still be writing a wav file, cancel() stops it at the next word
+            self._worker.join(timeout)
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _run(self):
+        self._engine = pyttsx3.init()
+        self._engine.setProperty('rate', self.rate)
+        self._engine.setProperty('volume', self.volume)
+        self._engine.connect('started-word', self._on_word)
+        while True:
+            generation, sentence = self._queue.get()
+            if sentence is None:
+                break
+            # Cleared before the generation check, so a cancel() racing with it still stops the sentence
+            self._stop_requested.clear()
+            with self._lock:
+                if generation != self._generation:
+                    continue
+            self._say(sentence)
+
+    def _on_word(self, name, location, length):
+        # Runs on the worker thread, inside runAndWait
+        if self._stop_requested.is_set():
+            self._engine.stop()
+
+    def _say(self, sentence: str):
+        cached_path: Path | type(None) = self._cached_phrases.get(sentence)
+        if cached_path is not None:
+            self._cached_phrases.move_to_end(sentence)
+            winsound.PlaySound(str(cached_path), winsound.SND_FILENAME)
+            return
+        self._engine.say(sentence)
+        self._engine.runAndWait()
+        if winsound is None or self._stop_requested.is_set():
+            return
+        self._phrase_counts[sentence] += 1
+        if self._phrase_counts[sentence] >= self.cache_min_repeats:
+            self._cache_phrase(sentence)
+        elif len(self._phrase_counts) > 16 * self.max_cached_phrases:
+            # Keeps the candidate counts bounded, the phrases seen once are the least likely to repeat
+            self._phrase_counts = Counter(dict(self._phrase_counts.most_common(self.max_cached_phrases)))
+
+    def _cache_phrase(self, sentence: str):
+        path = self.cache_dir / f"{hashlib.sha1(sentence.encode()).hexdigest()}.wav"
+        self._engine.save_to_file(sentence, str(path))
+        self._engine.runAndWait()
+        if self._stop_requested.is_set():  # The file may be cut short
+            path.unlink(missing_ok=True)
+            return
+        if not path.exists():
+            return
+        self._cached_phrases[sentence] = path
+        del self._phrase_counts[sentence]
+        while len(self._cached_phrases) > self.max_cached_phrases:
+            _, evicted_path = self._cached_phrases.popitem(last=False)
+            evicted_path.unlink(missing_ok=True)
@@ -0,0 +1,215 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+from collections import Counter
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from time import monotonic
+from warnings import warn
+
+import redis
+from dotenv import load_dotenv
+
+from exporter import iter_list_pages, scan_batches
+from redis_store import MESSAGES_KEY_PREFIX, USER_KEY_PREFIX, redis_from_env
+
+SYNC_STATE_FILE_NAME: str = "sync_state.json"
+# Keyspace events (K), list commands (l), string commands ($) and generic commands like DEL (g)
+NOTIFY_KEYSPACE_EVENTS: str = "Kl$g"
+
+
+def record_hash(raw_record: bytes) -> str:
+    return hashlib.sha1(raw_record).hexdigest()
+
+
+@dataclass
+class SyncState:
+    offsets: dict[str, int] = field(default_factory=dict)  # user id -> messages already in the local store
+    last_hashes: dict[str, str] = field(default_factory=dict)  # user id -> hash of the last message stored
+    profile_hashes: dict[str, str] = field(default_factory=dict)  # user id -> hash of the last stored profile
+
+    @classmethod
+    def load(cls, path: Path) -> "SyncState":
+        return cls(**json.loads(path.read_text(encoding="utf-8"))) if path.exists() else cls()
+
+    def save(self, path: Path):
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(asdict(self)), encoding="utf-8")
+        tmp_path.replace(path)
+
+    @classmethod
+    def from_export(cls, messages_jsonl: Path) -> "SyncState":
+        # Seeds the offsets from a bulk export (exporter.py), so the first sync only fetches what came after it
+        offsets = Counter()
+        last_hashes: dict[str, str] = {}
+        with open(messages_jsonl, encoding="utf-8") as f:
+            for line in f:
+                user_id = json.loads(line)["userId"]
+                offsets[user_id] += 1
+                last_hashes[user_id] = record_hash(line.rstrip("\n").encode("utf-8"))
+        return cls(offsets=dict(offsets), last_hashes=last_hashes)
+
+
+@dataclass
+class HistorySync:
+    # Incrementally mirrors the bot's Redis data into a local store directory:
+    #   messages.jsonl - every message, appended in list order per user (the exporter's JSONL format)
+    #   profiles.jsonl - every new version of a user:<userId> profile, the last line per id is the current one
+    # The number of messages already copied from each messages:<userId> list is tracked, so a sync only reads the
+    # new tail of each list. The bot only appends to the lists, but it may clear one, which then grows again. So the
+    # hash of the last copied message is kept too, and a list whose item at offset - 1 isn't that message anymore is
+    # read again from its start.
+    store_dir: Path
+    redis_client: redis.Redis = field(default_factory=redis_from_env, repr=False)
+    page_size: int = 1000
+    keys_per_pipeline: int = 100
+    scan_count: int = 1000
+    state: SyncState = field(init=False)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self):
+        self.store_dir = Path(self.store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.state = SyncState.load(self.state_path)
+
+    @property
+    def state_path(self) -> Path:
+        return self.store_dir / SYNC_STATE_FILE_NAME
+
+    @staticmethod
+    def user_id(key: bytes) -> str:
+        return key.decode().split(":", 1)[1]
+
+    def sync_message_keys(self, keys: list[bytes]) -> int:
+        new_messages = 0
+        with self._lock, open(self.store_dir / "messages.jsonl", "a", encoding="utf-8") as f:
+            for i in range(0, len(keys), self.keys_per_pipeline):
+                batch = keys[i:i + self.keys_per_pipeline]
+                pipe = self.redis_client.pipeline(transaction=False)
+                offsets = [self.state.offsets.get(self.user_id(key), 0) for key in batch]
+                for key, offset in zip(batch, offsets):
+                    pipe.llen(key)
+                    pipe.lindex(key, max(offset - 1, 0))
+                replies = pipe.execute()
+                start: dict[bytes, int] = {}
+                for key, offset, length, last in zip(batch, offsets, replies[::2], replies[1::2]):
+                    last_hash = self.state.last_hashes.get(self.user_id(key))
+                    # The history was cleared (and backed up) by the bot, and maybe grew again since
+                    if length < offset or (offset and last_hash and (last is None or record_hash(last) != last_hash)):
+                        offset = 0
+                    if length > offset:
+                        start[key] = offset
+                for key, page in iter_list_pages(self.redis_client, list(start), self.page_size, start):
+                    f.writelines(record.decode("utf-8") + "\n" for record in page)
+                    user_id = self.user_id(key)
+                    self.state.offsets[user_id] = start[key] = start[key] + len(page)
+                    self.state.last_hashes[user_id] = record_hash(page[-1])
+                    new_messages += len(page)
+                # The state never gets ahead of what's on disk, at worst a crash re-copies the last batch
+                f.flush()
+                os.fsync(f.fileno())
+                self.state.save(self.state_path)
+        return new_messages
+
+    def sync_profile_keys(self, keys: list[bytes]) -> int:
+        changed = 0
+        with self._lock, open(self.store_dir / "profiles.jsonl", "a", encoding="utf-8") as f:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for key in keys:
+                pipe.get(key)
+            for key, profile in zip(keys, pipe.execute()):
+                if not profile:
+                    continue
+                profile_hash = hashlib.sha1(profile).hexdigest()
+                user_id = self.user_id(key)
+                if self.state.profile_hashes.get(user_id) != profile_hash:
+                    f.write(profile.decode("utf-8") + "\n")
+                    self.state.profile_hashes[user_id] = profile_hash
+                    changed += 1
+            f.flush()
+            os.fsync(f.fileno())
+            self.state.save(self.state_path)
+        return changed
+
+    def sync(self) -> tuple[int, int]:
+        # A full pass over the keyspace, reading only what's new. Returns (new messages, changed profiles).
+        new_messages = changed_profiles = 0
+        for _, keys in scan_batches(self.redis_client, f"{MESSAGES_KEY_PREFIX}*", 0, self.scan_count):
+            new_messages += self.sync_message_keys(keys)
+        for _, keys in scan_batches(self.redis_client, f"{USER_KEY_PREFIX}*", 0, self.scan_count):
+            changed_profiles += self.sync_profile_keys(keys)
+        return new_messages, changed_profiles
+
+    def missing_notify_flags(self) -> str:
+        current = self.redis_client.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+        covered = set(current) | (set("g$lshzxet") if "A" in current else set())  # A is an alias for them
+        return "".join(flag for flag in NOTIFY_KEYSPACE_EVENTS if flag not in covered)
+
+    def configure_notifications(self):
+        # Adds the flags watch needs to the server's notify-keyspace-events, keeping the ones already set
+        missing = self.missing_notify_flags()
+        if missing:
+            current = self.redis_client.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+            self.redis_client.config_set("notify-keyspace-events", current + missing)
+
+    def watch(self, debounce: float = 1.0, stop: threading.Event = None, configure_notifications: bool = False):
+        # Reacts to keyspace notifications instead of polling: the keys changed since the last sync are collected and
+        # synced at most every debounce seconds. Notifications aren't delivered while disconnected, so a full sync
+        # runs first. Requires notify-keyspace-events to include K, l, $ and g. It's a server wide setting, so it's
+        # only changed if configure_notifications, and then only by adding the missing flags.
+        stop = stop or threading.Event()
+        db = self.redis_client.connection_pool.connection_kwargs.get("db", 0)
+        if configure_notifications:
+            self.configure_notifications()
+        else:
+            try:
+                missing = self.missing_notify_flags()
+            except redis.ResponseError:  # CONFIG is often disabled on managed servers, which then set it themselves
+                missing = ""
+            if missing:
+                warn(f"notify-keyspace-events lacks the flags {missing}, changes won't be noticed until they are set "
+                     f"(e.g. with --configure-notifications)")
+        pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        prefix = f"__keyspace@{db}__:"
+        pubsub.psubscribe(f"{prefix}{MESSAGES_KEY_PREFIX}*", f"{prefix}{USER_KEY_PREFIX}*")
+        self.sync()
+        dirty: set[bytes] = set()
+        last_sync = monotonic()
+        try:
+            while not stop.is_set():
+                message = pubsub.get_message(timeout=debounce)
+                if message is not None:
+                    dirty.add(message["channel"][len(prefix):])
+                if dirty and monotonic() - last_sync >= debounce:
+                    keys, dirty = sorted(dirty), set()
+                    message_keys = [k for k in keys if k.startswith(MESSAGES_KEY_PREFIX.encode())]
+                    profile_keys = [k for k in keys if k.startswith(USER_KEY_PREFIX.encode())]
+                    if message_keys:
+                        self.sync_message_keys(message_keys)
+                    if profile_keys:
+                        self.sync_profile_keys(profile_keys)
+                    last_sync = monotonic()
+        finally:
+            pubsub.close()
+
+
+if __name__ == "__main__":
+    # Same .env as data_reader.py, one folder up
+    load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.env'))
+    parser = argparse.ArgumentParser(description="Incrementally sync the bot's Redis histories to a local store.")
+    parser.add_argument("--store", type=Path, default=Path("history_store"))
+    parser.add_argument("--seed-from-export", type=Path, help="messages.jsonl of a bulk export already in the store")
+    parser.add_argument("--watch", action="store_true", help="Keep syncing on keyspace notifications")
+    parser.add_argument("--configure-notifications", action="store_true",
+                        help=f"Add the flags {NOTIFY_KEYSPACE_EVENTS} to the server's notify-keyspace-events")
+    args = parser.parse_args()
+    history_sync = HistorySync(args.store)
+    if args.seed_from_export:
+        history_sync.state = SyncState.from_export(args.seed_from_export)
+        history_sync.state.save(history_sync.state_path)
+    if args.watch:
+        history_sync.watch(configure_notifications=args.configure_notifications)
+    else:
+        print("Synced {} new messages and {} changed profiles".format(*history_sync.sync()))
@@ -0,0 +1,39 @@
+import sys
+from pathlib import Path
+
+import pytest
+import stamina
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))  # The modules of python-ui are imported flat
+
+from cohere_tools import CatalogCache, CohereHandler
+from fake_cohere import FakeCohereCfg, FakeCohereServer
+from rate_limiting import ApiRateLimits
+
+
+@pytest.fixture(autouse=True)
+def no_retry_backoff():
+    # Retries keep their attempts but don't sleep
+    with stamina.set_testing(True, attempts=5, cap=True):
+        yield
+
+
+@pytest.fixture
+def fake_server():
+    # In this process, so a test can change its cfg and read its request counts
+    with FakeCohereServer(FakeCohereCfg(latency=0.0, stream_delay=0.0, retry_after=0.01, reply_words=20)) as server:
+        yield server
+
+
+@pytest.fixture
+def rate_limits() -> ApiRateLimits:
+    return ApiRateLimits({endpoint: (60_000, 1000) for endpoint in ("chat", "embed", "rerank", "classify")},
+                         failure_threshold=2, reset_timeout=60.0, acquire_timeout=5.0)
+
+
+@pytest.fixture
+def handler(fake_server, rate_limits) -> CohereHandler:
+    llm_handler = CohereHandler(endpoint_prefix=fake_server.url, catalog_cache=CatalogCache(cache_dir=None),
+                                rate_limits=rate_limits)
+    yield llm_handler
+    llm_handler.transport.close()
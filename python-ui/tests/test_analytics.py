@@ -0,0 +1,62 @@
+import json
+
+import numpy as np
+import pytest
+
+from analytics import build, length_distribution, messages_per_user, open_tables, parse_timestamps, \
+    satisfaction_trend, turn_gaps
+
+
+def write_jsonl(path, rows: list[dict]):
+    path.write_text("".join(json.dumps(row) + "\n" for row in rows), encoding="utf-8")
+
+
+@pytest.fixture
+def store_dir(tmp_path):
+    messages = [("a", "USER", "Hi", "2026-01-05T10:00:00.000Z"),
+                ("a", "CHATBOT", "Hello there", "2026-01-05T10:00:02.000Z"),
+                ("b", "USER", "Hey", "2026-01-05T11:00:00.000Z"),
+                ("a", "USER", "Thanks", "2026-01-05T10:01:00.000Z"),
+                ("b", "CHATBOT", "Hi, how are you?", "2026-01-05T11:00:05.000Z"),
+                ("b", "USER", "Bye", "not a date")]
+    write_jsonl(tmp_path / "messages.jsonl", [{"userId": user, "role": role, "message": message, "timestamp": timestamp}
+                                              for user, role, message, timestamp in messages])
+    write_jsonl(tmp_path / "profiles.jsonl", [
+        {"id": "b", "satisfactionLevel": [{"level": 1, "timestamp": "2026-01-04T12:00:00.000Z"}]},  # A Sunday
+        {"id": "b", "satisfactionLevel": [{"level": 2, "timestamp": "2026-01-04T12:00:00.000Z"},
+                                          {"level": 4, "timestamp": "2026-01-11T23:00:00.000Z"}]},
+        {"id": "a", "satisfactionLevel": [{"level": 3, "timestamp": "2026-01-05T00:00:00.000Z"}]}])  # A Monday
+    return tmp_path
+
+
+def test_malformed_timestamps_are_nat():
+    timestamps = parse_timestamps(["2026-01-05T10:00:00.000Z", None, "yesterday"])
+    assert timestamps[0] == np.datetime64("2026-01-05T10:00:00", "ms") and np.isnat(timestamps[1:]).all()
+
+
+def test_tables_reopen_memory_mapped(store_dir, tmp_path):
+    messages, ratings = build(store_dir, tmp_path / "tables")
+    reopened_messages, reopened_ratings = open_tables(tmp_path / "tables")
+    assert isinstance(reopened_messages["length"], np.memmap)
+    assert reopened_messages.dictionaries == messages.dictionaries
+    assert np.array_equal(reopened_ratings["level"], ratings["level"])
+    assert ratings.dictionaries["user"][:2] == messages.dictionaries["user"] == ["a", "b"]  # Shared user codes
+
+
+def test_message_statistics(store_dir, tmp_path):
+    messages, _ = build(store_dir, tmp_path / "tables")
+    assert messages_per_user(messages, "USER").tolist() == [2, 2]
+    assert messages_per_user(messages).tolist() == [3, 3]
+    assert length_distribution(messages, "CHATBOT", percentiles=(50,)) == {"count": 2.0, "mean": 13.5, "max": 16.0,
+                                                                           "p50": 13.5}
+    assert sorted(turn_gaps(messages, "USER", "CHATBOT").tolist()) == [2.0, 5.0]
+    assert turn_gaps(messages, "CHATBOT", "USER").tolist() == [58.0]
+
+
+def test_weeks_start_on_monday(store_dir, tmp_path):
+    _, ratings = build(store_dir, tmp_path / "tables")
+    starts, levels, counts = satisfaction_trend(ratings)
+    assert np.array_equal(starts, np.array(["2025-12-29", "2026-01-05"], dtype="datetime64[D]"))
+    assert levels.tolist() == [2.0, 3.5] and counts.tolist() == [1, 2]
+    starts, _, counts = satisfaction_trend(ratings, "D")
+    assert len(starts) == 3 and counts.tolist() == [1, 1, 1]
@@ -0,0 +1,122 @@
+import asyncio
+import threading
+from time import monotonic
+
+import aiohttp
+import fakeredis
+import numpy as np
+import pytest
+
+from async_cohere import AsyncCohereHandler, AsyncConvManager, OverloadedError
+from cohere_tools import ConvManager
+from redis_store import RedisConvManager
+
+
+def run(coroutine_function, *args):
+    # Each test runs on its own event loop, the handler's session is closed on it
+    async def main():
+        async_handler = args[0]
+        try:
+            return await coroutine_function(*args)
+        finally:
+            await async_handler.close()
+
+    return asyncio.run(main())
+
+
+def test_chat_and_embed(handler, fake_server):
+    async def calls(llm: AsyncCohereHandler):
+        return await asyncio.gather(llm.chat("Hello"), llm.embed([f"text {i}" for i in range(5)], batch_size=2))
+
+    reply, vectors = run(calls, AsyncCohereHandler(handler))
+    assert reply["text"] and vectors.shape == (5, fake_server.cfg.embedding_dim)
+    assert np.allclose(vectors, handler.embed([f"text {i}" for i in range(5)]))  # From the shared cache
+    assert fake_server.requests["embed"] == 3
+
+
+def test_5xx_is_retried_and_4xx_is_not(handler, fake_server):
+    handler.rate_limits.failure_threshold = 10
+
+    async def calls(llm: AsyncCohereHandler):
+        fake_server.cfg.error_rate = 1.0
+        with pytest.raises(aiohttp.ClientResponseError):
+            await llm.chat("Hello")
+        fake_server.cfg.error_rate = 0.0
+        with pytest.raises(aiohttp.ClientResponseError):
+            await llm.chat_from_dict({"message": "hi", "chat_history": [{"role": "USER", "message": "hello"}],
+                                      "conversation_id": "a"})
+
+    run(calls, AsyncCohereHandler(handler))
+    assert fake_server.requests["503"] == 5 and fake_server.requests["chat"] == 6
+
+
+def test_unexpected_error_releases_the_half_open_trial(handler, fake_server, monkeypatch):
+    breaker = handler.rate_limits["chat"].breaker
+    breaker.failures, breaker.opened_at = 2, monotonic() - breaker.reset_timeout - 1  # Half-open
+    post = aiohttp.ClientSession.post
+
+    def failing_post(*args, **kwargs):
+        raise RuntimeError("Not a transport error")
+
+    async def calls(llm: AsyncCohereHandler):
+        monkeypatch.setattr(aiohttp.ClientSession, "post", failing_post)
+        with pytest.raises(RuntimeError):
+            await llm.chat("Hello")
+        assert breaker.state == "half-open"
+        monkeypatch.setattr(aiohttp.ClientSession, "post", post)
+        return await llm.chat("Hello")
+
+    assert run(calls, AsyncCohereHandler(handler))["text"]
+    assert breaker.state == "closed"
+
+
+def test_replies_of_one_conversation_run_in_order(handler, fake_server):
+    manager = AsyncConvManager(ConvManager(llm_handler=handler))
+
+    async def calls(llm: AsyncCohereHandler):
+        conv_id = await manager.new_conv("Be brief")
+        await asyncio.gather(*(manager.reply_to_msg(conv_id, f"Question {i}") for i in range(5)))
+        return conv_id
+
+    conv_id = run(calls, manager.llm)
+    assert [m.msg for m in manager.conv_manager[conv_id].msgs[::2]] == [f"Question {i}" for i in range(5)]
+    assert manager.pending == 0
+
+
+def test_admission_is_bounded(handler, fake_server):
+    fake_server.cfg.latency = 0.3
+    manager = AsyncConvManager(ConvManager(llm_handler=handler), max_pending=1, admission_timeout=0.05)
+
+    async def calls(llm: AsyncCohereHandler):
+        conv_ids = [await manager.new_conv() for _ in range(2)]
+        return await asyncio.gather(*(manager.reply_to_msg(conv_id, "Hello") for conv_id in conv_ids),
+                                    return_exceptions=True)
+
+    results = run(calls, manager.llm)
+    assert sum(isinstance(result, OverloadedError) for result in results) == 1
+
+
+def test_redis_histories_load_off_the_event_loop(handler, fake_server):
+    conv_manager = RedisConvManager(llm_handler=handler, redis_client=fakeredis.FakeRedis(), max_hot_conversations=2)
+    manager = AsyncConvManager(conv_manager)
+    load_conv = conv_manager.load_conv
+    loading_threads = set()
+
+    def recording_load_conv(conv_id: str):
+        loading_threads.add(threading.current_thread())
+        return load_conv(conv_id)
+
+    conv_manager.histories.loader = recording_load_conv
+
+    async def calls(llm: AsyncCohereHandler):
+        conv_ids = [await manager.new_conv() for _ in range(4)]
+        for _ in range(2):
+            await asyncio.gather(*(manager.reply_to_msg(conv_id, "Hello") for conv_id in conv_ids))
+        return conv_ids
+
+    try:
+        conv_ids = run(calls, manager.llm)
+    finally:
+        conv_manager.close()
+    assert threading.main_thread() not in loading_threads
+    assert [conv_manager.redis_client.llen(f"messages:{conv_id}") for conv_id in conv_ids] == [4] * 4
@@ -0,0 +1,73 @@
+import json
+from time import perf_counter, sleep, time
+
+import pytest
+from requests import Response
+
+from cohere_tools import ApiClientError, CatalogCache, CohereHandler, EndpointModelMap
+
+
+@pytest.fixture
+def empty_memory(monkeypatch):
+    # The memory tier is shared by the whole process, each test starts from an empty one
+    monkeypatch.setattr(CatalogCache, "_memory", {})
+    monkeypatch.setattr(CatalogCache, "_refreshing", set())
+
+
+@pytest.fixture
+def new_handler(fake_server, rate_limits):
+    handlers = []
+
+    def new(catalog_cache: CatalogCache) -> CohereHandler:
+        handlers.append(CohereHandler(endpoint_prefix=fake_server.url, catalog_cache=catalog_cache,
+                                      rate_limits=rate_limits))
+        return handlers[-1]
+
+    yield new
+    for llm_handler in handlers:
+        llm_handler.transport.close()
+
+
+def test_catalog_is_fetched_once_per_process(fake_server, new_handler, empty_memory):
+    first = new_handler(CatalogCache(cache_dir=None))
+    second = new_handler(CatalogCache(cache_dir=None))
+    assert fake_server.requests["models"] == 1
+    assert second.available_endpoint_models == first.available_endpoint_models
+    assert "command-r" in second.available_endpoint_models["chat"]
+
+
+def test_restarted_process_reads_the_catalog_from_disk(fake_server, new_handler, empty_memory, tmp_path, monkeypatch):
+    new_handler(CatalogCache(cache_dir=tmp_path))
+    monkeypatch.setattr(CatalogCache, "_memory", {})  # As in a new process
+    llm_handler = new_handler(CatalogCache(cache_dir=tmp_path))
+    assert fake_server.requests["models"] == 1 and llm_handler.available_endpoint_models["rerank"]
+
+
+def test_corrupt_cache_file_is_a_miss(fake_server, new_handler, empty_memory, tmp_path):
+    catalog_cache = CatalogCache(cache_dir=tmp_path)
+    llm_handler = new_handler(catalog_cache)
+    path = catalog_cache._path(llm_handler.catalog_key)
+    path.write_text("{not json", encoding="utf-8")
+    CatalogCache._memory.clear()
+    new_handler(catalog_cache)
+    assert fake_server.requests["models"] == 2
+    assert json.loads(path.read_text(encoding="utf-8"))["available_endpoint_models"]["chat"]
+
+
+def test_stale_catalog_is_served_and_revalidated_in_the_background(fake_server, new_handler, empty_memory):
+    catalog_cache = CatalogCache(cache_dir=None, ttl=60.0)
+    llm_handler = new_handler(catalog_cache)
+    catalog_cache.get(llm_handler.catalog_key).fetched_at = time() - 120.0
+    new_handler(catalog_cache)
+    deadline = perf_counter() + 5.0
+    while not catalog_cache.get(llm_handler.catalog_key).age() < 60.0 and perf_counter() < deadline:
+        sleep(0.01)
+    assert fake_server.requests["models"] == 2 and catalog_cache.get(llm_handler.catalog_key).age() < 60.0
+
+
+def test_404_revalidates_the_catalog(handler, fake_server):
+    response = Response()
+    response.status_code = 404
+    with pytest.raises(ApiClientError):
+        handler.raise_for_status(EndpointModelMap.chat, response, {"message": "hi", "model": "retired-model"})
+    assert fake_server.requests["models"] == 2
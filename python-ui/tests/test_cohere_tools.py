@@ -0,0 +1,132 @@
+from time import sleep
+
+import pytest
+import requests
+
+from caching import ResponseCache
+from cohere_tools import ApiClientError, ConvHist, ConvManager, GenCfg, StandardRoles, estimate_tokens
+from rate_limiting import CircuitOpenError
+
+
+def test_5xx_is_retried(handler, fake_server):
+    handler.rate_limits.failure_threshold = 10
+    fake_server.cfg.error_rate = 1.0
+    with pytest.raises(requests.HTTPError):
+        handler.chat_from_dict("hi")
+    assert fake_server.requests["503"] == 5
+
+
+def test_4xx_is_not_retried(handler, fake_server):
+    with pytest.raises(ApiClientError):
+        handler.chat_from_dict({"message": "hi", "chat_history": [{"role": "USER", "message": "hello"}],
+                                "conversation_id": "a"})
+    assert fake_server.requests["chat"] == 1
+    assert handler.rate_limits["chat"].breaker.state == "closed"
+
+
+def test_open_breaker_fails_fast(handler, fake_server):
+    fake_server.cfg.error_rate = 1.0
+    with pytest.raises(CircuitOpenError):  # The third attempt, after failure_threshold=2 failures
+        handler.chat_from_dict("hi")
+    assert handler.rate_limits["chat"].breaker.state == "open"
+    fake_server.cfg.error_rate = 0.0
+    with pytest.raises(CircuitOpenError):
+        handler.chat_from_dict("hi")
+    assert fake_server.requests["chat"] == 2
+
+
+def test_429_trial_leaves_breaker_half_open(handler, fake_server):
+    breaker = handler.rate_limits["chat"].breaker
+    breaker.reset_timeout = 0.05
+    fake_server.cfg.error_rate = 1.0
+    with pytest.raises(CircuitOpenError):
+        handler.chat_from_dict("hi")
+    sleep(0.1)
+    fake_server.cfg.error_rate, fake_server.cfg.throttle_rate = 0.0, 1.0
+    with pytest.raises(requests.RequestException):
+        handler.chat_from_dict("hi")
+    assert fake_server.requests["429"] == 5
+    assert breaker.state == "half-open"
+    fake_server.cfg.throttle_rate = 0.0
+    assert handler.chat_from_dict("hi")["text"]
+    assert breaker.state == "closed"
+
+
+def test_stream_yields_deltas_then_reply(handler, fake_server):
+    items = list(handler.chat_stream("Tell me something", ConvHist("Be brief")))
+    deltas, final_reply = items[:-1], items[-1]
+    assert len(deltas) > 1 and all(isinstance(delta, str) for delta in deltas)
+    assert "".join(deltas) == final_reply["text"]
+    assert final_reply["finish_reason"] == "COMPLETE"
+    assert fake_server.requests["chat"] == 1
+
+
+def test_stream_open_is_retried(handler, fake_server):
+    handler.rate_limits.failure_threshold = 10
+    fake_server.cfg.error_rate = 1.0
+    with pytest.raises(requests.HTTPError):
+        list(handler.chat_stream("hi"))
+    assert fake_server.requests["503"] == 5
+
+
+def test_budgeted_history_keeps_pinned_and_recent():
+    conv_hist = ConvHist(max_tokens=3 * estimate_tokens("message 00"))
+    for i in range(10):
+        conv_hist.add_msg(f"message {i:02}", StandardRoles.user, pinned=i == 0)
+    assert [m.msg for m in conv_hist.get_budgeted_msgs()] == ["message 00", "message 08", "message 09"]
+    assert conv_hist.needs_compaction()
+    msgs, upto = conv_hist.msgs_to_compact()
+    assert [m.msg for m in msgs] == [f"message {i:02}" for i in range(1, 8)] and upto == 8
+
+
+def test_compaction_summarizes_overflow(handler, fake_server):
+    manager = ConvManager(llm_handler=handler, max_history_tokens=60)
+    conv_id = manager.new_conv("Be brief")
+    for i in range(4):
+        manager.reply_to_msg(conv_id, f"Question number {i}", update_hist=False)
+        manager.add_msg(conv_id, f"Question number {i}", StandardRoles.user)
+        manager.add_msg(conv_id, "An answer " * 10, StandardRoles.assistant)
+    conv_hist = manager[conv_id]
+    assert conv_hist.needs_compaction()
+    compacted, upto = conv_hist.msgs_to_compact()
+    manager.compact_history(conv_id)
+    assert conv_hist.summary and conv_hist.summarized_upto == upto
+    assert fake_server.requests["chat"] == 5
+    sent = conv_hist.get_budgeted_msgs()
+    assert sent[0].msg.startswith("Summary of the earlier conversation")
+    assert not set(map(id, compacted)) & set(map(id, sent))
+
+
+def test_response_cache_hits_deterministic_requests(handler, fake_server):
+    handler.response_cache = ResponseCache()
+    first = handler.chat_from_dict("hi", GenCfg(temperature=0.0))
+    first["text"] = "changed by the caller"
+    second = handler.chat_from_dict("hi", GenCfg(temperature=0.0))
+    assert second["text"] != "changed by the caller"
+    assert fake_server.requests["chat"] == 1
+    assert handler.response_cache.stats.hits == 1
+
+
+def test_response_cache_skips_sampled_and_server_memory_requests(handler, fake_server):
+    handler.response_cache = ResponseCache()
+    handler.chat_from_dict("hi", GenCfg(temperature=0.9))
+    handler.chat_from_dict("hi", GenCfg(temperature=0.9))
+    handler.chat_from_dict({"message": "hi", "conversation_id": "a"}, GenCfg(temperature=0.0))
+    second = handler.chat_from_dict({"message": "hi", "conversation_id": "a"}, GenCfg(temperature=0.0))
+    assert fake_server.requests["chat"] == 4
+    assert len(second["chat_history"]) == 4
+    assert handler.response_cache.stats.hits == 0
+
+
+def test_pin_checks_the_index():
+    conv_hist = ConvHist()
+    with pytest.raises(IndexError):
+        conv_hist.pin()
+    conv_hist.add_msg("Hello", StandardRoles.user)
+    conv_hist.add_msg("Hi", StandardRoles.assistant)
+    conv_hist.pin(-2)
+    assert conv_hist.pinned == {0}
+    with pytest.raises(IndexError):
+        conv_hist.unpin(2)
+    conv_hist.unpin(0)
+    assert not conv_hist.pinned
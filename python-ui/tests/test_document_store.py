@@ -0,0 +1,39 @@
+import json
+
+from cohere_tools import Document
+from document_store import DocumentStore
+
+
+def test_copies_are_stored_once():
+    store = DocumentStore()
+    doc_ids = store.add_many([Document("Breathe slowly", title="Panic"), "Sleep early",
+                              Document("Breathe slowly", title="Panic")])
+    assert doc_ids[0] == doc_ids[2] != doc_ids[1] and len(store) == 2
+    assert json.loads(store.documents_json(doc_ids[:2])) == [{"id": doc_ids[0], "text": "Breathe slowly",
+                                                              "title": "Panic"},
+                                                             {"id": doc_ids[1], "text": "Sleep early"}]
+
+
+def test_long_documents_are_cut_at_a_word_boundary():
+    store = DocumentStore(max_doc_tokens=3)
+    doc_id = store.add("one two three four five six seven")
+    assert store[doc_id].document.text == "one two"  # 12 bytes end inside "three"
+
+
+def test_pack_skips_what_does_not_fit():
+    store = DocumentStore()
+    large, small, tiny = store.add("word " * 200), store.add("a short one"), store.add("tiny")
+    budget = store.tokens([small, tiny]) + 1
+    scored = [(large, 0.9), (small, 0.5), (small, 0.5), (tiny, 0.1)]
+    assert store.pack(scored, budget) == [small, tiny]
+    assert store.pack(scored, budget, min_score=0.2) == [small]
+    assert store.pack(scored, 10_000, max_docs=2) == [large, small]
+
+
+def test_reranked_documents_are_sent_with_the_chat(handler, fake_server):
+    store = DocumentStore()
+    doc_ids = store.add_many(["Talk to a friend about stress", "The weather is nice", "Stress at work"])
+    packed = store.pack_reranked(handler, "stress friend", doc_ids, budget_tokens=store.tokens(doc_ids[:1]))
+    assert packed == [doc_ids[0]]
+    assert handler.chat("How do I handle stress?", documents=store.documents_json(packed))["text"]
+    assert fake_server.requests["rerank"] == 1
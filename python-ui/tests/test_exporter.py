@@ -0,0 +1,97 @@
+import json
+
+import fakeredis
+import pytest
+
+import exporter
+from exporter import ExportCfg, export
+
+
+@pytest.fixture
+def redis_client(monkeypatch) -> fakeredis.FakeRedis:
+    client = fakeredis.FakeRedis()
+    for u in range(40):
+        client.rpush(f"messages:user{u}", *(json.dumps({"id": f"{u}-{i}", "userId": f"user{u}", "role": "USER",
+                                                         "timestamp": "", "message": f"m{i}"}) for i in range(u % 7 + 1)))
+    monkeypatch.setattr(exporter, "redis_from_env", lambda: client)
+    return client
+
+
+def export_cfg(out_dir, workers: int = 1) -> ExportCfg:
+    return ExportCfg(out_dir, scan_count=5, page_size=2, keys_per_pipeline=2, workers=workers, profiles=False)
+
+
+def messages(out_dir) -> list[str]:
+    return (out_dir / "messages.jsonl").read_text(encoding="utf-8").splitlines()
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_export_writes_every_message_once(redis_client, tmp_path, workers):
+    checkpoint = export(export_cfg(tmp_path, workers))
+    assert checkpoint.done and checkpoint.keys == 40 and checkpoint.rows == sum(u % 7 + 1 for u in range(40))
+    lines = messages(tmp_path)
+    assert len(lines) == len(set(lines)) == checkpoint.rows
+    assert (tmp_path / "messages.csv").read_text(encoding="utf-8").count("\n") == checkpoint.rows + 1
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_interrupted_export_resumes(redis_client, tmp_path, monkeypatch, workers):
+    export(export_cfg(tmp_path / "reference"))
+    expected = sorted(messages(tmp_path / "reference"))
+    iter_list_pages = exporter.iter_list_pages
+    calls = []
+
+    def failing_iter_list_pages(*args):
+        calls.append(args)
+        if len(calls) == 7:
+            raise ConnectionError("Lost the connection")
+        return iter_list_pages(*args)
+
+    monkeypatch.setattr(exporter, "iter_list_pages", failing_iter_list_pages)
+    with pytest.raises(ConnectionError):
+        export(export_cfg(tmp_path / "resumed", workers))
+    interrupted = json.loads((tmp_path / "resumed" / "checkpoint.json").read_text())
+    assert not interrupted["done"] and 0 < interrupted["rows"] < len(expected)
+    monkeypatch.setattr(exporter, "iter_list_pages", iter_list_pages)
+    checkpoint = export(export_cfg(tmp_path / "resumed", workers))
+    assert checkpoint.done and checkpoint.rows == len(expected)
+    assert sorted(messages(tmp_path / "resumed")) == expected
+
+
+
+def test_pages_are_written_as_they_are_read(redis_client, tmp_path, monkeypatch):
+    redis_client.rpush("messages:long", *(json.dumps({"id": f"long-{i}", "userId": "long", "role": "USER",
+                                                      "timestamp": "", "message": f"m{i}"}) for i in range(50)))
+    events = []
+    iter_list_pages, write = exporter.iter_list_pages, exporter.ExportWriters.write
+
+    def recording_iter_list_pages(*args):
+        for key, page in iter_list_pages(*args):
+            events.append(("read", key))
+            yield key, page
+
+    def recording_write(writers, raw_record):
+        events.append(("write", json.loads(raw_record)["userId"].encode()))
+        write(writers, raw_record)
+
+    monkeypatch.setattr(exporter, "iter_list_pages", recording_iter_list_pages)
+    monkeypatch.setattr(exporter.ExportWriters, "write", recording_write)
+    export(export_cfg(tmp_path, workers=2))
+    long_events = [event for event, key in events if key in (b"long", b"messages:long")]
+    # The long list isn't read whole before its first messages are written
+    assert long_events.count("read") == 25 and long_events.index("write") < len(long_events) - 1 - \
+        long_events[::-1].index("read")
+
+
+def test_key_returned_by_two_scan_batches_is_exported_once(redis_client, tmp_path, monkeypatch):
+    scan_batches = exporter.scan_batches
+
+    def repeating_scan_batches(*args):
+        # The first keys come again at the end, like SCAN may return them while the keyspace is rehashed
+        batches = list(scan_batches(*args))
+        return [(cursor or 1, keys) for cursor, keys in batches] + [(0, batches[0][1])]
+
+    monkeypatch.setattr(exporter, "scan_batches", repeating_scan_batches)
+    checkpoint = export(export_cfg(tmp_path))
+    lines = messages(tmp_path)
+    assert len(lines) == len(set(lines)) == checkpoint.rows == sum(u % 7 + 1 for u in range(40))
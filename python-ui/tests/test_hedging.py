@@ -0,0 +1,66 @@
+from time import perf_counter, sleep
+
+import pytest
+
+from hedging import HedgePolicy
+
+
+@pytest.fixture
+def policy() -> HedgePolicy:
+    hedge_policy = HedgePolicy(budget=1.0, fallback_model="command-r", min_delay=0.05, min_samples=5)
+    for _ in range(5):
+        hedge_policy.observe(0.01)
+    yield hedge_policy
+    hedge_policy.shutdown()
+
+
+def test_delay_follows_the_observed_latencies():
+    policy = HedgePolicy(quantile=0.5, min_delay=0.1, max_delay=1.0, min_samples=3, window=3)
+    policy.observe(0.5)
+    policy.observe(0.3)
+    assert policy.delay() is None
+    policy.observe(0.4)
+    assert policy.delay() == pytest.approx(0.4)
+    for _ in range(3):
+        policy.observe(0.01)
+    assert policy.delay() == 0.1  # The window dropped the slow calls, the threshold is clamped to min_delay
+
+
+def test_hedges_are_bounded_by_the_budget():
+    policy = HedgePolicy(budget=0.1)
+    for _ in range(20):
+        policy.start()
+    assert [policy.try_fire() for _ in range(3)] == [True, True, False]
+    assert policy.stats.fired == 2 and policy.stats.over_budget == 1 and policy.stats.fire_rate == 0.1
+
+
+def test_slow_call_is_answered_by_the_fallback_model(handler, fake_server, policy, monkeypatch):
+    handler.hedging = policy
+    call_endpoint = handler.call_endpoint
+    models = []
+
+    def slow_primary(endpoint, data, model=None, *args, **kwargs):
+        models.append(model)
+        if model != policy.fallback_model:
+            sleep(1.0)
+        return call_endpoint(endpoint, data, model, *args, **kwargs)
+
+    monkeypatch.setattr(handler, "call_endpoint", slow_primary)
+    started = perf_counter()
+    assert handler.chat("Hello")["text"]
+    assert perf_counter() - started < 0.8
+    assert models == [None, "command-r"]
+    assert policy.stats.fired == policy.stats.won == 1
+    deadline = perf_counter() + 5.0
+    while fake_server.requests["chat"] < 2 and perf_counter() < deadline:  # The loser runs to its end
+        sleep(0.05)
+    assert fake_server.requests["chat"] == 2
+
+
+def test_fast_call_and_server_memory_turns_are_not_hedged(handler, fake_server, policy):
+    handler.hedging = policy
+    policy.min_delay = 1.0
+    handler.chat("Hello")
+    handler.chat_from_dict({"message": "Hello", "conversation_id": "a"})
+    assert policy.stats.requests == 1 and policy.stats.fired == 0
+    assert fake_server.requests["chat"] == 2
@@ -0,0 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from http_transport import HttpTransport, TransportCfg
+
+
+def test_sequential_calls_reuse_one_connection(handler, fake_server):
+    stats = handler.transport.stats
+    before = stats.snapshot()
+    for i in range(5):
+        handler.chat(f"Hello {i}")
+    after = stats.snapshot()
+    assert after["requests"] - before["requests"] == 5
+    assert after["new_connections"] - before["new_connections"] <= 1
+    assert stats.reused_connections >= 4
+
+
+def test_threads_share_the_pool(fake_server):
+    transport = HttpTransport(TransportCfg(pool_maxsize=4))
+    try:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for _ in range(3):  # Every thread opens its session's connection once, then reuses it
+                statuses = list(executor.map(lambda _: transport.get(f"{fake_server.url}models").status_code,
+                                             range(4)))
+                assert statuses == [200] * 4
+        assert transport.stats.requests == 12 and 1 <= transport.stats.new_connections <= 4
+    finally:
+        transport.close()
+
+
+def test_closed_transport_opens_new_connections(fake_server):
+    transport = HttpTransport()
+    transport.get(f"{fake_server.url}models")
+    transport.close()
+    transport.get(f"{fake_server.url}models")
+    transport.close()
+    assert transport.stats.snapshot() == {"requests": 2, "new_connections": 2, "reused_connections": 0}
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from labeling import JsonlLabelSink, LabelingCfg, label_messages
+
+EXAMPLES = [{"text": "I feel hopeless and alone", "label": "distress"},
+            {"text": "Everything is too much, I can't cope", "label": "distress"},
+            {"text": "Thanks, have a nice day", "label": "calm"},
+            {"text": "All good here, the weather is nice", "label": "calm"}]
+
+
+def write_jsonl(path, rows: list[dict]):
+    path.write_text("".join(json.dumps(row) + "\n" for row in rows), encoding="utf-8")
+
+
+def read_jsonl(path) -> list[dict]:
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+@pytest.fixture
+def labeling_cfg(tmp_path) -> LabelingCfg:
+    write_jsonl(tmp_path / "examples.jsonl", EXAMPLES)
+    messages = [{"id": f"m{i}", "userId": "a", "role": "USER", "message": text, "timestamp": f"2026-01-01T00:00:0{i}Z"}
+                for i, text in enumerate(["I feel alone", "Have a nice day", "I can't cope", "The weather is nice"])]
+    messages.append({"id": "r0", "userId": "a", "role": "CHATBOT", "message": "I'm here for you"})
+    write_jsonl(tmp_path / "messages.jsonl", messages)
+    return LabelingCfg(tmp_path, tmp_path / "examples.jsonl", tmp_path / "labels" / "out.jsonl", batch_size=2)
+
+
+def test_user_messages_are_labeled(handler, fake_server, labeling_cfg):
+    assert label_messages(labeling_cfg, handler) == 4
+    labels = {row["id"]: row["label"] for row in read_jsonl(labeling_cfg.out_path)}
+    assert labels == {"m0": "distress", "m1": "calm", "m2": "distress", "m3": "calm"}
+    assert fake_server.requests["classify"] == 2
+
+
+def test_message_stored_twice_is_labeled_once(handler, fake_server, labeling_cfg):
+    messages_path = labeling_cfg.store_dir / "messages.jsonl"
+    write_jsonl(messages_path, read_jsonl(messages_path) * 2)
+    assert label_messages(labeling_cfg, handler) == 4
+    assert sorted(row["id"] for row in read_jsonl(labeling_cfg.out_path)) == ["m0", "m1", "m2", "m3"]
+
+
+def test_resumed_run_labels_only_the_missing_messages(handler, fake_server, labeling_cfg):
+    sink = JsonlLabelSink(labeling_cfg.out_path)
+    sink.write({"id": "m0", "label": "distress"})
+    sink.close()
+    with open(labeling_cfg.out_path, "a", encoding="utf-8") as f:
+        f.write('{"id": "m1", "lab')  # Torn by a crash
+    assert label_messages(labeling_cfg, handler) == 3
+    assert [row["id"] for row in read_jsonl(labeling_cfg.out_path)][0] == "m0"
+    assert sorted(row["id"] for row in read_jsonl(labeling_cfg.out_path)) == ["m0", "m1", "m2", "m3"]
@@ -0,0 +1,80 @@
+from time import monotonic
+
+from cohere_tools import ChatLenLimiter, GenCfg
+
+LONG_REPLY = "One two three four five six. Seven eight nine ten eleven twelve. Thirteen fourteen fifteen sixteen."
+
+
+def scripted_chat(*replies: str):
+    # A chat callable answering with the replies in turn, and recording its calls
+    calls = []
+
+    def chat(msg: str, conv_hist=None, sys_msg: str | bool = True, cfg: GenCfg = None) -> dict:
+        calls.append({"msg": msg, "sys_msg": sys_msg, "cfg": cfg})
+        return {"text": replies[min(len(calls), len(replies)) - 1], "finish_reason": "COMPLETE"}
+
+    return chat, calls
+
+
+def test_limit_is_part_of_the_request():
+    chat, calls = scripted_chat("Short enough.")
+    limiter = ChatLenLimiter(chat, max_words=10)
+    reply = limiter.limit_chat_len("Hello", sys_msg="Be kind.")
+    assert reply["text"] == "Short enough." and reply["length_control"]["extra_calls"] == 0
+    assert calls[0]["sys_msg"] == "Be kind. Limit your response to 10 words."
+    assert calls[0]["cfg"].max_tokens == limiter.limit_tokens("Hello")
+
+
+def test_reply_is_trimmed_locally_when_enough_is_left():
+    chat, calls = scripted_chat(LONG_REPLY)
+    limiter = ChatLenLimiter(chat, max_words=13, min_trim_ratio=0.6)
+    reply = limiter.limit_chat_len("Count")
+    assert reply["text"] == "One two three four five six. Seven eight nine ten eleven twelve."
+    assert reply["length_control"]["trimmed_locally"] and len(calls) == 1
+
+
+def test_reply_is_rewritten_when_trimming_loses_too_much():
+    chat, calls = scripted_chat(LONG_REPLY, "Still far too long for the limit, really.", "One to six.")
+    limiter = ChatLenLimiter(chat, max_words=4, min_trim_ratio=0.9)
+    reply = limiter.limit_chat_len("Count")
+    assert reply["text"] == "One to six."
+    length_control = reply["length_control"]
+    assert length_control["extra_calls"] == 2 and length_control["rewritten"] and not length_control["trimmed_locally"]
+    assert limiter.stats.extra_calls == 2 and limiter.stats.over_limit == 0
+
+
+def test_rewrites_are_bounded_by_the_attempts():
+    chat, calls = scripted_chat(LONG_REPLY, "Still far too long for the limit, really.")
+    limiter = ChatLenLimiter(chat, max_words=4, min_trim_ratio=0.9)
+    assert limiter.max_attempts_to_shorten == 5
+    limiter.limit_chat_len("Count")
+    assert len(calls) == 1 + 5 and limiter.stats.over_limit == 1
+
+
+def test_limit_tokens_scale_with_the_script():
+    limiter = ChatLenLimiter(None, max_chars=200)
+    assert limiter.limit_tokens("שלום, מה שלומך היום?") > limiter.limit_tokens("Hello, how are you today?")
+
+
+def test_unbindable_callable_is_called_as_is():
+    limiter = ChatLenLimiter(None, max_words=5)
+    assert limiter.with_length_limit(lambda: None, "Hello", (), {}) is None
+
+
+def test_rewrites_stop_at_the_time_budget(handler, fake_server):
+    fake_server.cfg.reply_words = 60
+    limiter = ChatLenLimiter(handler.chat, max_words=5, min_trim_ratio=1.0, max_tokens_headroom=0, max_seconds=0.3)
+    fake_server.cfg.latency = 0.0
+    first_reply = handler.chat("Tell me a story")  # Warms up the connection
+    fake_server.cfg.latency = 2.0
+
+    def chat(msg: str, *args, **kwargs) -> dict:
+        # The first call answers at once, only the rewrites are slow
+        return first_reply if msg == "Tell me a story" else handler.chat(msg, *args, **kwargs)
+
+    started = monotonic()
+    reply = limiter.limit_chat_len("Tell me a story", chat_callable=chat)
+    assert monotonic() - started < 1.5
+    assert reply["length_control"]["extra_calls"] == 1 and not reply["length_control"]["rewritten"]
+    assert limiter.stats.over_limit == 1
+    assert handler.rate_limits["chat"].breaker.failures == 0
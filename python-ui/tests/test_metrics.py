@@ -0,0 +1,63 @@
+import pytest
+import requests
+
+from cohere_tools import ConvManager
+from metrics import ClientMetrics, Histogram
+
+
+@pytest.fixture
+def metrics(handler) -> ClientMetrics:
+    handler.metrics = ClientMetrics()
+    return handler.metrics
+
+
+def chat_calls(metrics: ClientMetrics) -> dict:
+    return next(calls for calls in metrics.snapshot()["calls"] if calls["endpoint"] == "chat")
+
+
+def test_histogram_quantiles_are_bucket_bounds():
+    histogram = Histogram(bounds=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value)
+    assert histogram.counts == [1, 2, 1]
+    assert (histogram.quantile(0.25), histogram.quantile(0.75), histogram.quantile(1.0)) == (0.1, 1.0, float("inf"))
+
+
+def test_calls_tokens_and_bytes_are_counted(handler, fake_server, metrics):
+    handler.chat("Hello")
+    handler.embed(["a", "b"])
+    calls = chat_calls(metrics)
+    assert calls["calls"] == calls["latency"]["count"] == 1 and calls["statuses"] == {"200": 1}
+    assert calls["input_tokens"] > 0 and calls["output_tokens"] > 0
+    assert calls["bytes_out"] > 0 and calls["bytes_in"] > 0
+    assert {c["endpoint"] for c in metrics.snapshot()["calls"]} >= {"chat", "embed"}
+
+
+def test_retries_and_failed_statuses_are_counted(handler, fake_server, metrics):
+    handler.rate_limits.failure_threshold = 10
+    fake_server.cfg.error_rate = 1.0
+    with pytest.raises(requests.HTTPError):
+        handler.chat("Hello")
+    assert chat_calls(metrics)["statuses"] == {"503": 5}
+    assert metrics.snapshot()["retries"] == {"chat": 4}
+    assert 'cohere_requests_total{endpoint="chat",model="' in metrics.to_prometheus()
+    assert 'cohere_retries_total{endpoint="chat"} 4' in metrics.to_prometheus()
+
+
+def test_usage_is_kept_per_conversation(handler, fake_server, metrics):
+    metrics.max_conversations = 1
+    manager = ConvManager(llm_handler=handler)
+    first, second = manager.new_conv(), manager.new_conv()
+    manager.reply_to_msg(first, "Hello")
+    manager.reply_to_msg(first, "Hello again")
+    assert metrics.conversation_usage(first).calls == 2
+    manager.reply_to_msg(second, "Hello")
+    assert metrics.conversation_usage(first) is None and metrics.conversation_usage(second).calls == 1
+
+
+def test_failing_hook_only_warns(handler, fake_server, metrics):
+    records = []
+    metrics.hooks = [lambda record: 1 / 0, records.append]
+    with pytest.warns(UserWarning, match="Metrics hook"):
+        handler.chat("Hello")
+    assert [(record.endpoint, record.status) for record in records] == [("chat", 200)]
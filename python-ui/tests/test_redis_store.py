@@ -0,0 +1,126 @@
+import json
+import threading
+from time import sleep
+
+import fakeredis
+import pytest
+import redis
+
+from cohere_tools import ConvHist, StandardRoles
+from redis_store import HotHistories, RedisConvHistoriesManager
+
+
+@pytest.fixture
+def redis_client() -> fakeredis.FakeRedis:
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def manager(redis_client) -> RedisConvHistoriesManager:
+    histories_manager = RedisConvHistoriesManager(redis_client=redis_client, max_hot_conversations=1)
+    yield histories_manager
+    histories_manager.close()
+
+
+def test_messages_use_the_bots_layout(manager, redis_client):
+    conv_id = manager.new_conv(user_id=42)
+    manager.add_msg(conv_id, "Hello", StandardRoles.user)
+    manager.add_msg(conv_id, "Hi there", StandardRoles.assistant)
+    manager.flush()
+    records = [json.loads(r) for r in redis_client.lrange("messages:42", 0, -1)]
+    assert [(r["userId"], r["role"], r["message"]) for r in records] == [("42", "USER", "Hello"),
+                                                                         ("42", "CHATBOT", "Hi there")]
+    assert all(r["id"] and r["timestamp"].endswith("Z") for r in records)
+
+
+def test_evicted_conversation_is_reloaded(manager):
+    conv_id = manager.new_conv("You are ROGA", user_id="a")
+    manager.add_msg(conv_id, "first", StandardRoles.user)
+    manager.add_msg(conv_id, "pinned", StandardRoles.user, pinned=True)
+    manager.add_msg(conv_id, "last", StandardRoles.assistant)
+    manager.new_conv(user_id="b")  # Evicts a, max_hot_conversations=1
+    assert "a" not in manager.histories
+    conv_hist = manager["a"]
+    assert [m.msg for m in conv_hist.msgs] == ["first", "pinned", "last"]
+    assert conv_hist.sys_msg == "You are ROGA"
+    assert conv_hist.pinned == {1}
+
+
+def test_pins_follow_a_partial_load(redis_client):
+    histories_manager = RedisConvHistoriesManager(redis_client=redis_client, max_hot_conversations=1, load_last=3)
+    try:
+        conv_id = histories_manager.new_conv(user_id="a")
+        for i in range(6):
+            histories_manager.add_msg(conv_id, f"m{i}", StandardRoles.user)
+        histories_manager.pin(conv_id, 1)
+        histories_manager.pin(conv_id, 4)
+        histories_manager.update_sys_prompt(conv_id, "Be kind")
+        histories_manager.new_conv(user_id="b")
+        conv_hist = histories_manager["a"]
+        assert [m.msg for m in conv_hist.msgs] == ["m3", "m4", "m5"]
+        assert conv_hist.pinned == {1} and conv_hist.sys_msg == "Be kind"
+    finally:
+        histories_manager.close()
+
+
+def test_failed_flush_is_retried_without_duplicates(manager, redis_client, monkeypatch):
+    conv_id = manager.new_conv(user_id="a")
+    manager.add_msg(conv_id, "one", StandardRoles.user)
+    manager.add_msg(conv_id, "two", StandardRoles.assistant)
+    pipeline = redis_client.pipeline
+    failures = []
+
+    def failing_pipeline(transaction=True):
+        pipe = pipeline(transaction=transaction)
+        if not failures:
+            failures.append(transaction)
+            pipe.execute = lambda: (_ for _ in ()).throw(redis.ConnectionError("Lost the connection"))
+        return pipe
+
+    monkeypatch.setattr(redis_client, "pipeline", failing_pipeline)
+    with manager._flush_lock, pytest.raises(redis.ConnectionError):
+        manager._flush()
+    assert failures == [True]  # A transaction, nothing was written
+    manager.flush()
+    assert [json.loads(r)["message"] for r in redis_client.lrange("messages:a", 0, -1)] == ["one", "two"]
+
+
+def test_concurrent_lookups_load_a_conversation_once():
+    loads = []
+
+    def slow_loader(conv_id: str) -> ConvHist:
+        loads.append(conv_id)
+        sleep(0.05)
+        return ConvHist()
+
+    histories = HotHistories(slow_loader, max_size=10)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(histories["a"])) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loads == ["a"] and all(conv_hist is results[0] for conv_hist in results)
+
+
+def test_before_evict_runs_outside_the_lock():
+    evicted = []
+    histories = HotHistories(lambda conv_id: ConvHist(), max_size=2)
+
+    def before_evict(conv_id: str):
+        # Another thread can take the lock, e.g. to look up another conversation, while this runs
+        lock_free = []
+
+        def take_lock():
+            lock_free.append(histories._lock.acquire(timeout=1))
+            histories._lock.release()
+
+        thread = threading.Thread(target=take_lock)
+        thread.start()
+        thread.join()
+        evicted.append((conv_id, lock_free == [True]))
+
+    histories.before_evict = before_evict
+    for conv_id in ("a", "b", "c"):
+        _ = histories[conv_id]
+    assert evicted == [("a", True)] and list(histories) == ["b", "c"]
@@ -0,0 +1,44 @@
+import numpy as np
+
+from cohere_tools import Document
+from retrieval import DocumentIndex
+
+TEXTS = ["Breathing exercises for panic attacks", "Sleep hygiene before exams", "Talking to a friend about stress",
+         "Grounding with the five senses", "Journaling every evening"]
+
+
+def test_search_finds_the_matching_document(handler, fake_server, tmp_path):
+    index = DocumentIndex(tmp_path, handler)
+    ids = index.add([Document(text, title=f"Tip {i}") for i, text in enumerate(TEXTS)])
+    assert ids == list(range(5))
+    (best_id, best_score), *rest = index.search(TEXTS[3], k=3)
+    assert best_id == 3 and np.isclose(best_score, 1.0, atol=1e-4)
+    assert len(rest) == 2 and all(score < best_score for _, score in rest)
+    assert index.get(best_id) == Document(TEXTS[3], title="Tip 3")
+
+
+def test_index_grows_and_reopens(handler, fake_server, tmp_path):
+    index = DocumentIndex(tmp_path, handler, initial_capacity=2)
+    index.add([Document(text) for text in TEXTS[:3]])
+    index.add([Document(text) for text in TEXTS[3:]])
+    assert index.capacity == 8 and index.count == 5
+    reopened = DocumentIndex(tmp_path, handler)
+    assert len(reopened) == 5 and reopened.search(TEXTS[4], k=1)[0][0] == 4
+
+
+def test_deleted_documents_are_not_returned(handler, fake_server, tmp_path):
+    index = DocumentIndex(tmp_path, handler)
+    index.add([Document(text) for text in TEXTS])
+    index.delete([1, 3])
+    assert len(index) == 3 and {doc_id for doc_id, _ in index.search(TEXTS[3], k=5)} == {0, 2, 4}
+    id_map = index.compact()
+    assert id_map == {0: 0, 2: 1, 4: 2} and index.count == 3
+    assert DocumentIndex(tmp_path, handler).search(TEXTS[4], k=1)[0][0] == 2
+
+
+def test_rerank_refines_the_candidates(handler, fake_server, tmp_path):
+    index = DocumentIndex(tmp_path, handler)
+    index.add([Document(text) for text in TEXTS])
+    docs = index.retrieve("stress friend", k=1, rerank=True, rerank_candidates=5)
+    assert docs == [Document(TEXTS[2])]
+    assert fake_server.requests["rerank"] == 1
@@ -0,0 +1,75 @@
+import pytest
+import requests
+
+from cohere_tools import ConvManager
+
+
+@pytest.fixture
+def manager(handler) -> ConvManager:
+    return ConvManager(llm_handler=handler, server_side_memory=True)
+
+
+def test_turns_send_only_the_message(manager, fake_server):
+    conv_id = manager.new_conv("Be brief")
+    for i in range(3):
+        reply = manager.reply_to_msg(conv_id, f"Question {i}", return_json=True)
+        assert reply["server_memory"]["mode"] == "server"
+    stats = manager.server_memory_stats
+    assert stats.turns == stats.server_turns == 3 and stats.fallbacks == 0
+    assert stats.bytes_saved > 0
+    assert len(next(iter(fake_server.conversations.values()))) == len(manager[conv_id].msgs) == 6
+
+
+def test_lost_conversation_falls_back_without_revalidating_the_catalog(manager, fake_server):
+    conv_id = manager.new_conv()
+    manager.reply_to_msg(conv_id, "Hello")
+    catalog_calls = fake_server.requests["models"]
+    fake_server.cfg.forget_rate, fake_server.cfg.forget_status = 1.0, 404
+    with pytest.warns(UserWarning, match="lost conversation"):
+        reply = manager.reply_to_msg(conv_id, "Still there?", return_json=True)
+    assert reply["server_memory"]["mode"] == "full"
+    assert fake_server.requests["models"] == catalog_calls
+    assert manager.server_memory_stats.fallbacks == 1
+    assert manager.reply_to_msg(conv_id, "And now?", return_json=True)["server_memory"]["mode"] == "full"
+
+
+def test_transient_error_keeps_server_memory(manager, fake_server):
+    manager.llm_handler.rate_limits.failure_threshold = 10
+    conv_id = manager.new_conv()
+    manager.reply_to_msg(conv_id, "Hello")
+    fake_server.cfg.error_rate = 1.0
+    with pytest.raises(requests.HTTPError):
+        manager.reply_to_msg(conv_id, "Hello again")
+    fake_server.cfg.error_rate = 0.0
+    assert manager.reply_to_msg(conv_id, "Hello again", return_json=True)["server_memory"]["mode"] == "server"
+    assert manager.server_memory_stats.fallbacks == 0
+
+
+def test_turn_outside_the_history_keeps_server_memory(manager, fake_server):
+    conv_id = manager.new_conv()
+    manager.reply_to_msg(conv_id, "Hello")
+    reply = manager.reply_to_msg(conv_id, "Just checking", update_hist=False, return_json=True)
+    assert reply["server_memory"]["mode"] == "full"
+    assert manager.reply_to_msg(conv_id, "Hello again", return_json=True)["server_memory"]["mode"] == "server"
+    assert manager.server_memory_stats.fallbacks == 0
+    assert len(next(iter(fake_server.conversations.values()))) == 4
+
+
+def test_streamed_turns_use_server_memory(manager, fake_server):
+    conv_id = manager.new_conv()
+    manager.reply_to_msg(conv_id, "Hello")
+    items = list(manager.reply_to_msg(conv_id, "Tell me more", stream=True, return_json=True))
+    assert items[-1]["server_memory"]["mode"] == "server"
+    assert "".join(items[:-1]) == items[-1]["text"] == manager[conv_id].msgs[-1].msg
+    assert manager.reply_to_msg(conv_id, "Thanks", return_json=True)["server_memory"]["mode"] == "server"
+    assert len(next(iter(fake_server.conversations.values()))) == len(manager[conv_id].msgs) == 6
+
+
+def test_stream_of_a_lost_conversation_falls_back(manager, fake_server):
+    conv_id = manager.new_conv()
+    manager.reply_to_msg(conv_id, "Hello")
+    fake_server.cfg.forget_rate, fake_server.cfg.forget_status = 1.0, 404
+    with pytest.warns(UserWarning, match="lost conversation"):
+        items = list(manager.reply_to_msg(conv_id, "Tell me more", stream=True, return_json=True))
+    assert items[-1]["server_memory"]["mode"] == "full"
+    assert [m.msg for m in manager[conv_id].msgs][2:] == ["Tell me more", items[-1]["text"]]
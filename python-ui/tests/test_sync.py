@@ -0,0 +1,63 @@
+import json
+
+import fakeredis
+import pytest
+
+from sync import HistorySync, SyncState
+
+
+def message(user_id: str, i: int) -> str:
+    return json.dumps({"id": f"{user_id}-{i}", "userId": user_id, "role": "USER", "timestamp": "", "message": f"m{i}"})
+
+
+def stored_lines(history_sync: HistorySync) -> list[str]:
+    return (history_sync.store_dir / "messages.jsonl").read_text(encoding="utf-8").splitlines()
+
+
+@pytest.fixture
+def redis_client() -> fakeredis.FakeRedis:
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def history_sync(tmp_path, redis_client) -> HistorySync:
+    return HistorySync(tmp_path, redis_client, page_size=2, keys_per_pipeline=2, scan_count=2)
+
+
+def test_sync_reads_only_the_new_tail(history_sync, redis_client):
+    for user_id in ("a", "b", "c"):
+        redis_client.rpush(f"messages:{user_id}", *(message(user_id, i) for i in range(3)))
+    assert history_sync.sync() == (9, 0)
+    redis_client.rpush("messages:b", message("b", 3), message("b", 4))
+    assert history_sync.sync() == (2, 0)
+    assert history_sync.sync() == (0, 0)
+    assert history_sync.state.offsets == {"a": 3, "b": 5, "c": 3}
+    assert len(stored_lines(history_sync)) == 11
+
+
+def test_cleared_list_that_regrew_is_read_again(history_sync, redis_client):
+    redis_client.rpush("messages:a", *(message("a", i) for i in range(3)))
+    history_sync.sync()
+    redis_client.delete("messages:a")
+    redis_client.rpush("messages:a", *(message("a", i) for i in range(10, 15)))
+    assert history_sync.sync() == (5, 0)
+    assert stored_lines(history_sync)[3:] == [message("a", i) for i in range(10, 15)]
+
+
+def test_state_survives_a_restart(history_sync, redis_client, tmp_path):
+    redis_client.rpush("messages:a", *(message("a", i) for i in range(3)))
+    redis_client.set("user:a", json.dumps({"userId": "a", "name": "A"}))
+    assert history_sync.sync() == (3, 1)
+    restarted = HistorySync(tmp_path, redis_client)
+    redis_client.rpush("messages:a", message("a", 3))
+    assert restarted.sync() == (1, 0)
+
+
+def test_state_from_export(history_sync, redis_client, tmp_path):
+    redis_client.rpush("messages:a", *(message("a", i) for i in range(3)))
+    export_path = tmp_path / "export.jsonl"
+    export_path.write_text("".join(message("a", i) + "\n" for i in range(3)), encoding="utf-8")
+    history_sync.state = SyncState.from_export(export_path)
+    assert history_sync.sync() == (0, 0)
+    redis_client.lset("messages:a", 2, message("a", 99))  # Not what was exported, so everything is read again
+    assert history_sync.sync() == (3, 0)
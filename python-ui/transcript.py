@@ -0,0 +1,127 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from warnings import warn
+
+CHAT_LOG_DIR: Path = Path("chat_logs")
+
+
+@dataclass
+class TranscriptEntry:
+    text: str  # As shown in the chat window, ends with a newline
+    timestamp: float = field(default_factory=time.time)
+
+    @property
+    def lines(self) -> int:
+        return self.text.count("\n")
+
+    def log_line(self) -> str:
+        return time.strftime("[%Y-%m-%d %H:%M:%S] ", time.localtime(self.timestamp)) + self.text
+
+
+@dataclass
+class TranscriptLog:
+    # Appends the entries to a text file on its own thread, so the Tk main thread never waits on the disk. Entries
+    # queued together are written (and flushed) together.
+    path: Path
+    _queue: queue.Queue = field(init=False, default_factory=queue.Queue)
+    _worker: threading.Thread = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._worker = threading.Thread(target=self._run, name="transcript-log", daemon=True)
+        self._worker.start()
+
+    def write(self, entry: TranscriptEntry):
+        self._queue.put(entry)
+
+    def close(self, timeout: float = 5.0):
+        # Waits for the queued entries to be written
+        self._queue.put(None)
+        self._worker.join(timeout)
+
+    def _run(self):
+        f = None
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            stop = None in batch
+            try:
+                if f is None:
+                    self.path.parent.mkdir(parents=True, exist_ok=True)
+                    f = open(self.path, "a", encoding="utf-8")
+                f.write("".join(entry.log_line() for entry in batch if entry is not None))
+                f.flush()
+            except OSError as e:
+                warn(f"Couldn't write the chat log to {self.path}: {e}")
+        if f is not None:
+            f.close()
+
+
+@dataclass
+class Transcript:
+    # The entries of a chat session, of which the chat window shows only the latest ones: the Text widget slows down
+    # as its content grows, so long sessions keep at most window entries in it. Older entries are put back load_chunk
+    # at a time when the user scrolls to the top. The conversation history can't serve them, it's compacted over
+    # time and has no notices like cancelled replies.
+    window: int = 200
+    load_chunk: int = 50
+    log: TranscriptLog | type(None) = None
+    entries: list[TranscriptEntry] = field(init=False, default_factory=list)
+    first_shown: int = field(init=False, default=0)  # Index of the oldest entry in the widget
+
+    @property
+    def has_older(self) -> bool:
+        return self.first_shown > 0
+
+    def append(self, text: str) -> TranscriptEntry:
+        entry = TranscriptEntry(text)
+        self.entries.append(entry)
+        if self.log is not None:
+            self.log.write(entry)
+        return entry
+
+    def trim(self) -> int:
+        # Hides the oldest shown entries past the window, returns the number of lines to delete from the widget's top
+        lines = 0
+        while len(self.entries) - self.first_shown > self.window:
+            lines += self.entries[self.first_shown].lines
+            self.first_shown += 1
+        return lines
+
+    def load_older(self) -> str:
+        # The text of the next older chunk, to insert at the widget's top
+        start = max(0, self.first_shown - self.load_chunk)
+        text = "".join(entry.text for entry in self.entries[start:self.first_shown])
+        self.first_shown = start
+        return text
+
+    def clear(self):
+        # The log on disk is kept
+        self.entries.clear()
+        self.first_shown = 0
+
+    def save_in_background(self, path: Path) -> threading.Thread:
+        # Writes the whole session, e.g. for the "Save Chat Log" menu entry
+        entries = list(self.entries)
+
+        def save():
+            try:
+                Path(path).write_text("".join(entry.log_line() for entry in entries), encoding="utf-8")
+            except OSError as e:
+                warn(f"Couldn't save the chat log to {path}: {e}")
+
+        thread = threading.Thread(target=save, name="transcript-save")
+        thread.start()
+        return thread
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+
+def new_session_log(log_dir: Path = CHAT_LOG_DIR) -> TranscriptLog:
+    return TranscriptLog(Path(log_dir) / time.strftime("chat_%Y%m%d_%H%M%S.txt"))